@@ -0,0 +1,575 @@
+"""
+Pool of long-lived accompaniment worker processes (see accompaniment_worker.py).
+
+Each worker loads the model once and then takes requests over its stdin/stdout
+pipes, instead of a `conda run` and a checkpoint load per request. Requests wait
+in a bounded queue; a request that runs past its timeout or is cancelled while
+running kills its worker, which is restarted for the next request.
+"""
+import json
+import os
+import queue
+import select
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from .sessions import REDIS_URL
+from .tracing import WARNING, trace
+
+# 'piano_transformer' runs the Music Transformer in the conda environment below, 'stub' copies the melody
+ACCOMPANIMENT_BACKEND = os.environ.get('MELODY_ACCOMPANIMENT_BACKEND', 'piano_transformer')
+ACCOMPANIMENT_MODEL_PATH = os.environ.get(
+    'MELODY_ACCOMPANIMENT_MODEL_PATH',
+    '/home/kdr_aviaryhq_com/data/music_transformer/melody_conditioned_model_16.ckpt')
+ACCOMPANIMENT_CONDA_ENV = os.environ.get('MELODY_ACCOMPANIMENT_CONDA_ENV', 'magenta')
+# Worker processes, each holds its own copy of the model (in total over api.serve's workers)
+ACCOMPANIMENT_WORKERS = int(os.environ.get('MELODY_ACCOMPANIMENT_WORKERS', '1'))
+# Requests waiting for a worker beyond this are rejected (in total over api.serve's workers)
+ACCOMPANIMENT_QUEUE_SIZE = int(os.environ.get('MELODY_ACCOMPANIMENT_QUEUE_SIZE', '8'))
+# Seconds one request may run on a worker
+ACCOMPANIMENT_TIMEOUT = float(os.environ.get('MELODY_ACCOMPANIMENT_TIMEOUT', '300'))
+# Seconds finished jobs are kept for status requests
+ACCOMPANIMENT_JOB_TTL = int(os.environ.get('MELODY_ACCOMPANIMENT_JOB_TTL', '3600'))
+# 'memory' keeps the job table in this process, 'redis' shares it between the API's worker processes
+ACCOMPANIMENT_JOB_BACKEND = os.environ.get('MELODY_ACCOMPANIMENT_JOB_BACKEND', 'memory')
+# Retry-After sent with the 503 for a full queue
+RETRY_AFTER = 30
+# Seconds a worker may take to load the model
+WORKER_START_TIMEOUT = 600
+DECODE_LENGTH = 1024
+# How often a running request checks whether it was cancelled
+POLL_INTERVAL = 0.1
+# How often the status of this process' jobs is copied to a shared job table
+SYNC_INTERVAL = 0.5
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), 'accompaniment_worker.py')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+class AccompanimentError(Exception):
+    status = 500
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.message = message
+        if status is not None:
+            self.status = status
+
+class QueueFullError(AccompanimentError):
+    status = 503
+
+class AccompanimentTimeout(AccompanimentError):
+    status = 504
+
+class AccompanimentCancelled(AccompanimentError):
+    status = 409
+
+def worker_command(backend=ACCOMPANIMENT_BACKEND, model_path=ACCOMPANIMENT_MODEL_PATH,
+                   conda_env=ACCOMPANIMENT_CONDA_ENV):
+    if backend == 'stub':
+        return [sys.executable, '-u', WORKER_SCRIPT, '--backend=stub']
+    return ['conda', 'run', '--no-capture-output', '-n', conda_env, 'python', '-u', WORKER_SCRIPT,
+            '--backend=piano_transformer', f'--model_path={model_path}']
+
+class AccompanimentJob:
+    def __init__(self, melody_path, output_path, decode_length=DECODE_LENGTH, finalize=None):
+        """
+        Args:
+            finalize (callable): Called with the job on the worker thread once the output
+                file is written, its return value becomes the job's result. By default the
+                result is output_path.
+        """
+        self.id = uuid.uuid4().hex
+        self.melody_path = melody_path
+        self.output_path = output_path
+        self.decode_length = decode_length
+        self.finalize = finalize
+        self.state = QUEUED
+        self.error = None
+        self.value = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.state == CANCELLED
+
+    @property
+    def finished(self):
+        return self._done.is_set()
+
+    def cancel(self):
+        """
+        Cancels the job. A queued job is skipped, a running one kills its worker.
+
+        Returns:
+            bool: False if the job had already finished.
+        """
+        with self._lock:
+            if self.state not in (QUEUED, RUNNING):
+                return False
+            self.state = CANCELLED
+            self.error = AccompanimentCancelled('Accompaniment was cancelled')
+            self.finished_at = time.time()
+        self._done.set()
+        return True
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def result(self):
+        """
+        Returns:
+            The finalize result (the generated file's path by default), raises the AccompanimentError
+            if the job failed.
+        """
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def to_dict(self):
+        job = {'job_id': self.id, 'state': self.state, 'submitted_at': self.submitted_at,
+               'started_at': self.started_at, 'finished_at': self.finished_at}
+        if self.error is not None:
+            job['error'] = self.error.message
+        return job
+
+    def _start(self):
+        with self._lock:
+            if self.state != QUEUED:
+                return False
+            self.state = RUNNING
+            self.started_at = time.time()
+            return True
+
+    def _finish(self, error=None, value=None):
+        with self._lock:
+            if self.state != RUNNING:
+                return
+            self.state = DONE if error is None else FAILED
+            self.error = error
+            self.value = value
+            self.finished_at = time.time()
+        self._done.set()
+
+class WorkerProcess:
+    """
+    One worker process and the line buffer of its replies.
+    """
+
+    def __init__(self, command):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._buffer = b''
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def wait_ready(self, timeout):
+        self.read_reply(time.monotonic() + timeout)
+
+    def send(self, job):
+        request = {'id': job.id, 'melody_path': job.melody_path, 'output_path': job.output_path,
+                   'decode_length': job.decode_length}
+        self.process.stdin.write(json.dumps(request).encode() + b'\n')
+        self.process.stdin.flush()
+
+    def read_reply(self, deadline, job=None):
+        """
+        Reads the next reply line, giving up at deadline (time.monotonic()) or when job is cancelled.
+        """
+        fd = self.process.stdout.fileno()
+        while b'\n' not in self._buffer:
+            if job is not None and job.cancelled:
+                raise AccompanimentCancelled('Accompaniment was cancelled')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise AccompanimentTimeout('Accompaniment timed out')
+            ready, _, _ = select.select([fd], [], [], min(remaining, POLL_INTERVAL))
+            if ready:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    raise AccompanimentError(f'Accompaniment worker exited with {self.process.wait()}')
+                self._buffer += chunk
+        line, _, self._buffer = self._buffer.partition(b'\n')
+        return json.loads(line)
+
+    def kill(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+class RedisJobTable:
+    """
+    Job statuses stored as JSON strings in Redis, so that any worker process of the API
+    can answer for a job another one accepted. The accepting process keeps running the
+    job and copies its status here; a cancel from another process is stored as the
+    cancelled state, which the accepting process picks up and never overwrites.
+    """
+
+    def __init__(self, client, ttl=ACCOMPANIMENT_JOB_TTL, prefix='melody:accompaniment_job:'):
+        """
+        Args:
+            client: A redis.Redis compatible client.
+            ttl (int): Seconds a status is kept after its last change.
+            prefix (str): Key prefix.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, job_id):
+        data = self.client.get(self.prefix + job_id)
+        return None if data is None else json.loads(data)
+
+    def put(self, status):
+        """
+        Stores a job status unless the stored one was cancelled.
+
+        Returns:
+            bool: False if the job was cancelled through the table, the caller should cancel it.
+        """
+        def change(current):
+            return status if current is None or current['state'] != CANCELLED else None
+
+        return self._update(status['job_id'], change)[1]
+
+    def cancel(self, job_id):
+        """
+        Marks a job cancelled unless it already finished.
+
+        Returns:
+            tuple: (status, cancelled), status is None if the job does not exist.
+        """
+        def change(current):
+            if current is None or current['state'] not in (QUEUED, RUNNING):
+                return None
+            return dict(current, state=CANCELLED, finished_at=time.time(), queue_position=None,
+                        error='Accompaniment was cancelled')
+
+        return self._update(job_id, change)
+
+    def _update(self, job_id, change):
+        """
+        Replaces the stored status of a job in a transaction.
+
+        Args:
+            change (callable): Takes the stored status (None if there is none) and returns
+                the status to store, or None to keep it.
+
+        Returns:
+            tuple: (status now stored, whether change replaced it)
+        """
+        from redis.exceptions import WatchError
+        key = self.prefix + job_id
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    data = pipe.get(key)
+                    current = None if data is None else json.loads(data)
+                    status = change(current)
+                    if status is None:
+                        pipe.reset()
+                        return current, False
+                    pipe.multi()
+                    pipe.setex(key, self.ttl, json.dumps(status))
+                    pipe.execute()
+                    return status, True
+                except WatchError:
+                    continue
+
+class AccompanimentPool:
+    """
+    Runs accompaniment jobs on a fixed number of worker processes. Workers and their
+    processes are started on the first submit. Submitted jobs can be looked up by id
+    until ACCOMPANIMENT_JOB_TTL seconds after they finished.
+
+    With a shared job table, a thread copies the status of this pool's jobs to it every
+    SYNC_INTERVAL seconds, job_status() and cancel() then answer for the jobs of every
+    pool using the table, and the table decides whether a job was cancelled.
+    """
+
+    def __init__(self, command=None, workers=ACCOMPANIMENT_WORKERS, queue_size=ACCOMPANIMENT_QUEUE_SIZE,
+                 timeout=ACCOMPANIMENT_TIMEOUT, start_timeout=WORKER_START_TIMEOUT, job_ttl=ACCOMPANIMENT_JOB_TTL,
+                 table=None):
+        """
+        Args:
+            command (list): Worker process command line, worker_command() by default.
+            workers (int): Number of worker processes.
+            queue_size (int): Jobs that can wait for a worker, submit raises QueueFullError beyond it.
+            timeout (float): Seconds a job may run before its worker is killed.
+            start_timeout (float): Seconds a worker may take to load its model.
+            job_ttl (float): Seconds finished jobs are kept for get().
+            table (RedisJobTable): Job table shared with other processes, None to only know this pool's jobs.
+        """
+        self.command = command or worker_command()
+        self.workers = workers
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.job_ttl = job_ttl
+        self._jobs = OrderedDict()  # id -> job, in submit order
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._processes = {}
+        self._lock = threading.Lock()
+        self.table = table
+        self._published = {}  # id -> status last stored in the table, finished ones are no longer synced
+        self._publish_lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for slot in range(self.workers):
+                thread = threading.Thread(target=self._run, args=(slot,), daemon=True,
+                                          name=f'accompaniment-{slot}')
+                thread.start()
+                self._threads.append(thread)
+            if self.table is not None:
+                threading.Thread(target=self._sync, daemon=True, name='accompaniment-sync').start()
+
+    def split(self, parts):
+        """
+        Divides the pool's worker processes and queue between parts processes that each
+        run a copy of the pool, e.g. the forked workers of api.serve. Every copy keeps at
+        least one worker process and one queue slot. Only before the pool started.
+
+        Returns:
+            tuple: (worker processes, queue size) of each copy.
+        """
+        with self._lock:
+            if self._threads:
+                raise RuntimeError('The pool already started')
+            self.workers = max(1, self.workers // parts)
+            self._queue = queue.Queue(maxsize=max(1, self._queue.maxsize // parts))
+        return self.workers, self._queue.maxsize
+
+    def submit(self, melody_path, output_path, decode_length=DECODE_LENGTH, finalize=None):
+        """
+        Queues a job without waiting for it, raises QueueFullError if the queue is full.
+
+        Returns:
+            AccompanimentJob: The queued job.
+        """
+        self.start()
+        job = AccompanimentJob(melody_path, output_path, decode_length, finalize)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFullError('Too many accompaniment requests, try again later')
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        if self.table is not None:
+            self._publish(job)
+        return job
+
+    def get(self, job_id):
+        """
+        Returns:
+            AccompanimentJob: A job submitted to this pool, None if it is unknown or expired.
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def job_status(self, job_id):
+        """
+        Returns:
+            dict: The job's state and times, its queue_position while queued and its result once
+                done; None if the job is unknown or expired.
+        """
+        job = self.get(job_id)
+        if self.table is None:
+            return None if job is None else self._status(job)
+        if job is not None:
+            self._publish(job)
+        return self.table.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancels a job. A queued job is skipped, a running one kills its worker.
+
+        Returns:
+            tuple: (status, cancelled), the status is None if the job is unknown and
+                cancelled is False if the job had already finished.
+        """
+        job = self.get(job_id)
+        if self.table is None:
+            if job is None:
+                return None, False
+            cancelled = job.cancel()
+            return self._status(job), cancelled
+        if job is not None:
+            self._publish(job)
+        status, cancelled = self.table.cancel(job_id)
+        if cancelled and job is not None:
+            job.cancel()
+        return status, cancelled
+
+    def wait(self, job_id, timeout):
+        """
+        Waits up to timeout seconds for a job of this pool to finish, a job of another
+        process is waited for the full timeout.
+        """
+        job = self.get(job_id)
+        if job is None:
+            time.sleep(timeout)
+            return False
+        return job.wait(timeout)
+
+    def queue_position(self, job):
+        """
+        Returns:
+            int: Number of jobs ahead of job in the queue, None if it is not queued.
+        """
+        if job.state != QUEUED:
+            return None
+        with self._queue.mutex:
+            waiting = [j for j in self._queue.queue if j is not None and j.state == QUEUED]
+        return waiting.index(job) if job in waiting else None
+
+    def generate(self, melody_path, output_path, decode_length=DECODE_LENGTH, finalize=None, timeout=None):
+        """
+        Submits a job and waits for it, cancelling it if it does not finish within timeout
+        seconds (queueing included).
+
+        Returns:
+            The job's result, output_path once the accompaniment was written there by default.
+        """
+        job = self.submit(melody_path, output_path, decode_length, finalize)
+        if not job.wait(timeout):
+            job.cancel()
+            raise AccompanimentTimeout('Accompaniment timed out')
+        return job.result()
+
+    def status(self):
+        with self._lock:
+            running = sum(1 for process in self._processes.values() if process.alive())
+        return {'workers': self.workers, 'running_workers': running, 'queued': self._queue.qsize(),
+                'max_queued': self._queue.maxsize}
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _prune(self):
+        cutoff = time.time() - self.job_ttl
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.finished_at < cutoff:
+                del self._jobs[job_id]
+                self._published.pop(job_id, None)
+
+    def _status(self, job):
+        status = job.to_dict()
+        status['queue_position'] = self.queue_position(job)
+        if job.state == DONE:
+            status['result'] = job.value
+        return status
+
+    def _publish(self, job):
+        """
+        Stores the job's status in the table. A job cancelled through the table is
+        cancelled here too, even if it finished in the meantime.
+        """
+        with self._publish_lock:
+            status = self._status(job)
+            if self.table.put(status):
+                self._published[job.id] = status
+            else:
+                job.cancel()
+                self._published[job.id] = self._status(job)
+
+    def _sync(self):
+        failing = False
+        while not self._closed.wait(SYNC_INTERVAL):
+            with self._lock:
+                jobs = [job for job in self._jobs.values()
+                        if self._published.get(job.id, {}).get('state') in (None, QUEUED, RUNNING)]
+            try:
+                for job in jobs:
+                    self._publish(job)
+                failing = False
+            except Exception as e:
+                # the next round retries, only the first failure in a row is traced
+                if not failing:
+                    trace('accompaniment_sync_failed', WARNING, error=str(e))
+                failing = True
+
+    def _run(self, slot):
+        process = None
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if not job._start():
+                continue  # cancelled while queued
+            try:
+                if process is None or not process.alive():
+                    if process is not None:
+                        process.kill()
+                    process = WorkerProcess(self.command)
+                    with self._lock:
+                        self._processes[slot] = process
+                    process.wait_ready(self.start_timeout)
+                    if job.cancelled:
+                        continue
+                process.send(job)
+                deadline = time.monotonic() + self.timeout
+                reply = process.read_reply(deadline, job)
+                while reply.get('id') != job.id:
+                    reply = process.read_reply(deadline, job)
+            except Exception as e:
+                # the worker may be in the middle of a request, start a fresh one for the next job
+                if process is not None:
+                    process.kill()
+                    process = None
+                self._fail(job, e)
+                continue
+
+            try:
+                if 'error' in reply:
+                    raise AccompanimentError(f'Failed to generate accompaniment: {reply["error"]}')
+                job._finish(value=job.finalize(job) if job.finalize else job.output_path)
+            except Exception as e:
+                self._fail(job, e)
+        if process is not None:
+            process.kill()
+
+    def _fail(self, job, error):
+        if not isinstance(error, AccompanimentError):
+            error = AccompanimentError(str(error))
+        job._finish(error)
+        try:
+            os.remove(job.output_path)
+        except FileNotFoundError:
+            pass
+
+def create_job_table():
+    """
+    Builds the job table selected by MELODY_ACCOMPANIMENT_JOB_BACKEND, None for 'memory'.
+    """
+    if ACCOMPANIMENT_JOB_BACKEND == 'memory':
+        return None
+    if ACCOMPANIMENT_JOB_BACKEND == 'redis':
+        import redis
+        return RedisJobTable(redis.Redis.from_url(REDIS_URL))
+    raise ValueError(f'Unknown accompaniment job backend {ACCOMPANIMENT_JOB_BACKEND}')
@@ -0,0 +1,136 @@
+"""
+Long-lived accompaniment worker, started by accompaniment.AccompanimentPool.
+
+Loads the model once and then answers requests, one JSON object per line:
+
+    stdin:  {"id": ..., "melody_path": ..., "output_path": ..., "decode_length": 1024}
+    stdout: {"id": ..., "ok": true} or {"id": ..., "error": "..."}
+
+A {"ready": true} line is written once the model is loaded. Anything the model
+libraries print goes to stderr so it cannot corrupt the replies.
+
+The piano_transformer backend runs inside the magenta conda environment and keeps
+one Music Transformer estimator.predict generator open, the same way the Piano
+Transformer colab does. The stub backend copies the melody as its accompaniment,
+so the pool can be run and tested without magenta or the checkpoint:
+
+    python api/accompaniment_worker.py --backend=stub --delay=0.5
+
+This file is run as a script in another environment, so it only imports the standard
+library at the top.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+class StubBackend:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def generate(self, melody_path, output_path, decode_length):
+        time.sleep(self.delay)
+        shutil.copyfile(melody_path, output_path)
+
+class PianoTransformerBackend:
+    """
+    Melody conditioned Music Transformer, see https://github.com/Elvenson/piano_transformer
+    """
+
+    def __init__(self, model_path, num_hidden_layers=16):
+        import numpy as np
+        import note_seq
+        from magenta.models.score2perf import score2perf
+        from tensor2tensor.data_generators import text_encoder
+        from tensor2tensor.utils import decoding, trainer_lib
+
+        class MelodyToPianoPerformanceProblem(score2perf.AbsoluteMelody2PerfProblem):
+            @property
+            def add_eos_symbol(self):
+                return True
+
+        self.np = np
+        self.note_seq = note_seq
+        self.eos_id = text_encoder.EOS_ID
+        problem = MelodyToPianoPerformanceProblem()
+        self.encoders = problem.get_feature_encoders()
+
+        hparams = trainer_lib.create_hparams(hparams_set='transformer_tpu')
+        trainer_lib.add_problem_hparams(hparams, problem)
+        hparams.num_hidden_layers = num_hidden_layers
+        hparams.sampling_method = 'random'
+        decode_hparams = decoding.decode_hparams()
+        decode_hparams.alpha = 0.0
+        decode_hparams.beam_size = 1
+        run_config = trainer_lib.create_run_config(hparams)
+        estimator = trainer_lib.create_estimator('transformer', hparams, run_config, decode_hparams=decode_hparams)
+
+        # predict() reads the next request from these, so the graph and checkpoint load only once
+        self.inputs = []
+        self.decode_length = 0
+        input_fn = decoding.make_input_fn_from_generator(self._input_generator())
+        self.samples = estimator.predict(input_fn, checkpoint_path=model_path)
+        next(self.samples)
+
+    def _input_generator(self):
+        while True:
+            yield {
+                'inputs': self.np.array([[self.inputs]], dtype=self.np.int32),
+                'targets': self.np.zeros([1, 0], dtype=self.np.int32),
+                'decode_length': self.np.array(self.decode_length, dtype=self.np.int32),
+            }
+
+    def generate(self, melody_path, output_path, decode_length):
+        melody = self.note_seq.midi_file_to_note_sequence(melody_path)
+        instrument = self.note_seq.infer_melody_for_sequence(melody)
+        notes = sorted((n for n in melody.notes if n.instrument == instrument), key=lambda n: n.start_time)
+        del melody.notes[:]
+        melody.notes.extend(notes)
+        # the model expects a monophonic line, each note lasting until the next one
+        for i in range(len(melody.notes) - 1):
+            melody.notes[i].end_time = melody.notes[i + 1].start_time
+
+        self.inputs = self.encoders['inputs'].encode_note_sequence(melody)
+        self.decode_length = decode_length
+        ids = list(next(self.samples)['outputs'])
+        if self.eos_id in ids:
+            ids = ids[:ids.index(self.eos_id)]
+        # the targets encoder decodes to a temporary MIDI file
+        shutil.move(self.encoders['targets'].decode(ids), output_path)
+
+def serve(backend, requests, replies):
+    replies.write(json.dumps({'ready': True}) + '\n')
+    replies.flush()
+    for line in requests:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        try:
+            backend.generate(request['melody_path'], request['output_path'], request.get('decode_length', 1024))
+            reply = {'id': request['id'], 'ok': True}
+        except Exception as e:
+            reply = {'id': request['id'], 'error': str(e)}
+        replies.write(json.dumps(reply) + '\n')
+        replies.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Accompaniment worker, see accompaniment.AccompanimentPool.')
+    parser.add_argument('--backend', choices=['piano_transformer', 'stub'], default='piano_transformer')
+    parser.add_argument('--model_path', help='Music Transformer checkpoint (piano_transformer backend)')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds each stub request takes')
+    args = parser.parse_args(argv)
+
+    # keep the real stdout for replies, everything else printed goes to stderr
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    if args.backend == 'stub':
+        backend = StubBackend(args.delay)
+    else:
+        backend = PianoTransformerBackend(args.model_path)
+    serve(backend, sys.stdin, replies)
+
+if __name__ == '__main__':
+    main()
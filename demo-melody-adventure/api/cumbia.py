@@ -1,7 +1,12 @@
+import numpy as np
+
 import os
 import music21 as m21
 
 from .simplemelodygen.extensions import MultiInstanceTrainableMarkovChainMelodyGenerator
+from .modelstore import get_or_load_model
+from .simplemelodygen.vocabulary import VOCABULARY
+from .tracing import TRACER, WARNING, trace
 
 def get_generator_data():
     midi = m21.converter.parse(os.path.join(os.path.dirname(__file__), 'cumbia_sample.mid'))
@@ -9,33 +14,40 @@ def get_generator_data():
     for element in midi.flat:
         if isinstance(element, m21.note.Note):
             duration = round(element.quarterLength * 4) / 4
-            notes.append([str(element.pitch), duration])
-    states = set()
-    for i in range(len(notes)):
-        note = (notes[i][0], notes[i][1])
-        states.add(note)
-    training_data = []
-    for i in range(len(notes)):
-        training_data.append(m21.note.Note(notes[i][0], quarterLength=notes[i][1]))
-    return [training_data], list(states)
-
-TRAINING_DATA, STATES = get_generator_data()
-MODEL = MultiInstanceTrainableMarkovChainMelodyGenerator(list(STATES))
-MODEL.train(TRAINING_DATA)
-
-def generate_melody(notes, length=15, max_bars=10, quarter_note_per_bar=4):
-    print(notes)
-    melody = []
-    new_notes = []
-    if len(notes) > 0:
+            notes.append((str(element.pitch), duration))
+    return [notes], list(set(notes))
+
+def build_model():
+    training_data, states = get_generator_data()
+    model = MultiInstanceTrainableMarkovChainMelodyGenerator(list(states))
+    model.train_from_indexes([model.states_to_indexes(sequence) for sequence in training_data])
+    return model, {}
+
+# Uploaded phrases can add states the corpus does not have
+LEARN_NEW_STATES = True
+
+def get_model():
+    return get_or_load_model('cumbia', build_model)[0]
+
+def generate_melody(ids, length=15, max_bars=10, quarter_note_per_bar=4, end_policy='clip', learned_phrases=()):
+    """
+    Args:
+        ids (numpy.ndarray): The melody so far as int32 ids of the shared state vocabulary.
+        learned_phrases (list or LearnedPhrases): Phrases to also learn from, see with_phrases, without changing the shared model.
+
+    Returns:
+        tuple: (ids of the melody with the new notes appended, ids of the new notes)
+    """
+    model = get_model().with_phrases(learned_phrases, new_states=LEARN_NEW_STATES)
+    if len(ids) > 0:
         try:
-            melody, new_notes = MODEL.generate(length, previous_sequence=notes, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar)
+            new_ids = model.generate_ids(length, previous_ids=ids, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar, end_policy=end_policy)
         except Exception as e:
-            print(">>>>>>> Error generating melody", e)
-            _, new_notes  = MODEL.generate(length, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar)
-            melody = notes + new_notes
+            trace('generate_melody_fallback', WARNING, style='cumbia', error=str(e))
+            new_ids = model.generate_ids(length, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar, end_policy=end_policy)
     else:
-        melody, new_notes = MODEL.generate(length, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar)
-    print(melody)
+        new_ids = model.generate_ids(length, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar, end_policy=end_policy)
+    if TRACER.enabled():
+        trace('generate_melody', style='cumbia', notes=VOCABULARY.to_json(ids), new_notes=VOCABULARY.to_json(new_ids))
 
-    return melody, new_notes
\ No newline at end of file
+    return np.concatenate([ids, new_ids]), new_ids
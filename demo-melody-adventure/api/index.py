@@ -1,46 +1,354 @@
+import base64
+import math
 import os
 import uuid
-import tempfile
-import subprocess
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 import json
 import time
 
-from .utils import save_midi_file, MIDI_FOLDER, midi_to_notes, save_melody_to_midi
+import numpy as np
 
-from . import bach
-from . import hindustani
-from . import carnatic
-from . import cumbia
-from . import turkish
-from . import mozart
+from .utils import save_midi_bytes, MIDI_FOLDER, save_melody_to_midi, save_ids_to_midi
+from .accompaniment import (QUEUED, RETRY_AFTER, RUNNING, AccompanimentError, AccompanimentPool, QueueFullError,
+                            create_job_table)
+from .midiwriter import is_pitch_name, melody_to_midi_bytes
+from .metrics import (REGISTRY, REQUEST_BYTES, REQUEST_SECONDS, RESPONSE_BYTES, STAGE_SECONDS, VARIATIONS,
+                      GENERATED_NOTES, LEARNED_NOTES)
+from .midireader import MAX_UPLOAD_BYTES, MidiParseError, midi_bytes_to_notes
+
+from .registry import StyleRegistry
+from .tracing import ERROR, INFO, LEVELS, TRACER, trace
+from .sessions import create_session_store, new_session
+from .simplemelodygen.bars import END_POLICIES, meter_to_quarter_notes, split_bars
+from .simplemelodygen.extensions import LearnedPhrases
+from .simplemelodygen.vocabulary import VOCABULARY, VocabularyFull
+from .turkish import makam_midi_pitch
 
 from werkzeug.serving import WSGIRequestHandler
 
+# Generation stops once MAX_BARS bars are filled, MAX_LENGTH only caps the number of notes
 MAX_LENGTH = 100
 MAX_BARS = 2
+# Longest melody a request may send, in quarter notes, which keeps every MIDI delta time in range
+MAX_MELODY_QUARTER_NOTES = float(os.environ.get('MELODY_MAX_MELODY_QUARTER_NOTES', '16384'))
+# Most candidates one /api/batch_variations request may ask for
+MAX_BATCH_CANDIDATES = int(os.environ.get('MELODY_MAX_BATCH_CANDIDATES', '32'))
 QUARTER_NOTE_PER_BAR = 4
+# How a phrase ends on a note that overruns the last bar, see simplemelodygen/bars.py
+END_POLICY = os.environ.get('MELODY_END_POLICY', 'clip')
+# What the style models learn from uploaded phrases and seeds: 'session' (only that session's
+# generations), 'shared' (every client's generations, in this worker process) or 'off'
+LEARN_UPLOADS = os.environ.get('MELODY_LEARN_UPLOADS', 'session')
+# Most uploaded notes a session learns from, the oldest phrases are dropped first
+MAX_SESSION_LEARNED_NOTES = int(os.environ.get('MELODY_MAX_SESSION_LEARNED_NOTES', '5000'))
+# Most uploaded notes each style model of a worker learns from in 'shared' mode, the oldest
+# phrases are forgotten first, and most states the uploads may add to it
+MAX_LEARNED_NOTES = int(os.environ.get('MELODY_MAX_LEARNED_NOTES', '100000'))
+MAX_LEARNED_STATES = int(os.environ.get('MELODY_MAX_LEARNED_STATES', '10000'))
 
 WSGIRequestHandler.protocol_version = "HTTP/1.1"
 app = Flask(__name__)
 app.config['TIMEOUT'] = 300
 
-MELODY_GENERATOR_MAP = {
-    #'bach': bach.generate_melody,
-    'indian': hindustani.generate_melody,
-    'classical': bach.generate_melody,
-    'carnatic': carnatic.generate_melody,
-    'cumbia': cumbia.generate_melody,
-    'turkish': turkish.generate_melody,
-    'mozart': mozart.generate_melody,
-}
+# style -> style module, each module is imported and its model loaded on first use
+MELODY_GENERATOR_MAP = StyleRegistry({
+    #'bach': 'bach',
+    'indian': 'hindustani',
+    'classical': 'bach',
+    'carnatic': 'carnatic',
+    'cumbia': 'cumbia',
+    'turkish': 'turkish',
+    'mozart': 'mozart',
+})
+
+# Melody state of each client session, so requests only carry the variation to apply
+SESSION_STORE = create_session_store()
+
+# Load all styles in the background so the server can accept requests right away
+if os.environ.get('MELODY_WARM_UP', '1') == '1':
+    MELODY_GENERATOR_MAP.warm_up(background=True)
+
+@app.before_request
+def start_request():
+    request.start_time = time.perf_counter()
+    request.request_id = TRACER.start_request(request.headers.get('X-Request-ID'))
+
+@app.teardown_request
+def end_request(error=None):
+    TRACER.end_request()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    if endpoint != '/metrics':
+        REQUEST_SECONDS.observe(time.perf_counter() - request.start_time, endpoint=endpoint,
+                                method=request.method, status=response.status_code)
+        if request.content_length:
+            REQUEST_BYTES.inc(request.content_length, endpoint=endpoint)
+        if not response.is_streamed:
+            RESPONSE_BYTES.inc(response.content_length or 0, endpoint=endpoint)
+    response.headers['X-Request-ID'] = request.request_id
+    return response
+
+@app.route("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/api/traces")
+def traces():
+    """
+    Dumps the buffered trace events, optionally filtered by ?request_id=, ?level= and ?limit=.
+    """
+    level = request.args.get('level', 'debug')
+    if level not in LEVELS:
+        return jsonify({'error': f'Invalid level, expected one of {list(LEVELS)}'}), 400
+    limit = request.args.get('limit', type=int)
+    return jsonify({'events': TRACER.recent(limit, request.args.get('request_id'), LEVELS[level])})
+
+@app.route("/api/ready")
+def ready():
+    styles = MELODY_GENERATOR_MAP.status()
+    is_ready = MELODY_GENERATOR_MAP.is_ready()
+    return jsonify({'ready': is_ready, 'styles': styles}), 200 if is_ready else 503
+
+@app.route("/api/styles")
+def styles():
+    return jsonify(MELODY_GENERATOR_MAP.status())
+
+@app.errorhandler(MidiParseError)
+def invalid_midi(e):
+    return jsonify({'error': f'Invalid MIDI file: {e}'}), 400
+
+@app.errorhandler(VocabularyFull)
+def vocabulary_full(e):
+    return jsonify({'error': str(e)}), 503
+
+def read_uploaded_notes(midi_file):
+    """
+    Parses an uploaded MIDI file in memory, MidiParseError for files over the upload limits.
+
+    Returns:
+        bytes: The file.
+        list: (pitch, duration) state tuples of its melody.
+    """
+    data = midi_file.read(MAX_UPLOAD_BYTES + 1)
+    notes = midi_bytes_to_notes(data)
+    return data, [(pitch, float(duration)) for pitch, duration in notes]
 
 # Add route to serve MIDI files
 @app.route("/midi/<filename>")
 def serve_midi(filename):
     return send_from_directory(MIDI_FOLDER, filename)
 
+class VariationError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def read_notes(notes, field):
+    """
+    Checks the notes of a request field before anything is generated or rendered from them.
+
+    Args:
+        notes (list): [pitch, duration] pairs from the request.
+        field (str): The field name, for the error message.
+
+    Returns:
+        list: (pitch, float duration) tuples, VariationError if notes is not a list of
+            [pitch, duration] pairs with finite durations of at least 0 (zero length
+            grace notes are part of some corpora) and pitches the MIDI writer knows,
+            or the melody is too long.
+    """
+    if not isinstance(notes, list) or not all(map(is_note, notes)):
+        raise VariationError(f'Invalid {field}, expected [pitch, duration] pairs with a finite duration >= 0')
+    notes = [(pitch, float(duration)) for pitch, duration in notes]
+    if not all(map(is_pitch, {pitch for pitch, _ in notes})):
+        raise VariationError(f'Invalid {field}, expected pitch names such as "C#4" or "Rest"')
+    if sum(duration for _, duration in notes) > MAX_MELODY_QUARTER_NOTES:
+        raise VariationError(f'Invalid {field}, longer than {MAX_MELODY_QUARTER_NOTES:g} quarter notes')
+    return notes
+
+def read_is_makam_notes(flags, notes):
+    """
+    Checks the is_makam_notes field of a request against its current_notes.
+
+    Returns:
+        list: The flags, VariationError unless they are booleans, one per note.
+    """
+    if not isinstance(flags, list) or len(flags) != len(notes) or not all(isinstance(f, bool) for f in flags):
+        raise VariationError('Invalid is_makam_notes, expected one boolean per note of current_notes')
+    return flags
+
+def is_note(note):
+    return (isinstance(note, (list, tuple)) and len(note) == 2 and isinstance(note[0], str)
+            and isinstance(note[1], (int, float)) and not isinstance(note[1], bool)
+            and math.isfinite(note[1]) and note[1] >= 0)
+
+def is_pitch(pitch):
+    # the pitches of the styles include microtonal names, requests may only add plain ones
+    return pitch == 'Rest' or VOCABULARY.has_pitch(pitch) or is_pitch_name(pitch)
+
+def find_request_ids(requested_variation, *notes):
+    """
+    Returns:
+        list: VOCABULARY.find of every note list, looked up once the requested style is
+            loaded so that the states of its model are known.
+    """
+    if requested_variation in MELODY_GENERATOR_MAP:
+        try:
+            MELODY_GENERATOR_MAP.load(requested_variation)
+        except Exception:
+            pass  # generate_variation answers with the error
+    return [VOCABULARY.find(n) for n in notes]
+
+def request_notes(ids, notes):
+    """
+    Decodes ids for a response. States a request sent are looked up with VOCABULARY.find
+    rather than interned, so that requests cannot grow the vocabulary, and the ones it
+    does not have are -1; their notes are taken from notes.
+
+    Args:
+        ids (numpy.ndarray): Vocabulary ids, -1 for states of the request the vocabulary does not have.
+        notes (list): (pitch, duration) tuples at the same positions, only read where an id is -1.
+
+    Returns:
+        list: (pitch, float duration) of every id.
+    """
+    unknown = ids < 0
+    if not unknown.any():
+        return VOCABULARY.to_json(ids)
+    known = np.flatnonzero(~unknown)
+    decoded = list(notes[:len(ids)]) + [None] * (len(ids) - len(notes))
+    for position, note in zip(known.tolist(), VOCABULARY.to_json(ids[known])):
+        decoded[position] = note
+    return decoded
+
+def save_request_melody(ids, notes, is_makam_notes):
+    """
+    save_ids_to_midi, from the notes when the melody has states of the request the
+    vocabulary does not have (see request_notes).
+    """
+    if (ids < 0).any():
+        return save_melody_to_midi(notes, is_makam_notes)
+    return save_ids_to_midi(ids, is_makam_notes)
+
+def repeated_notes(requested_variation, seed_notes, recent_notes):
+    """
+    Returns:
+        list: The notes a repeat variation appends, where request_notes finds the states
+            of new ids that are -1.
+    """
+    return {'repeat-previous': recent_notes, 'repeat-seed': seed_notes}.get(requested_variation, [])
+
+def generation_options(data):
+    """
+    Reads the optional end_policy and time_signature fields of a request.
+
+    Returns:
+        tuple: (end_policy, quarter notes per bar)
+    """
+    end_policy = data.get('end_policy', END_POLICY)
+    if end_policy not in END_POLICIES:
+        raise VariationError(f'Invalid end_policy, expected one of {list(END_POLICIES)}')
+    try:
+        quarter_note_per_bar = meter_to_quarter_notes(data.get('time_signature', QUARTER_NOTE_PER_BAR))
+    except (ValueError, ZeroDivisionError):
+        raise VariationError('Invalid time_signature')
+    return end_policy, quarter_note_per_bar
+
+def learn_phrase(notes):
+    """
+    Counts uploaded notes into the models of the loaded styles, when LEARN_UPLOADS is 'shared'.
+    Styles loaded later do not learn them. Each model keeps the newest MAX_LEARNED_NOTES notes.
+
+    Args:
+        notes (list): (pitch, duration) pairs.
+    """
+    if LEARN_UPLOADS != 'shared' or not len(notes):
+        return
+    with STAGE_SECONDS.time(stage='learn'):
+        ids = VOCABULARY.encode(notes)
+        modules = {}
+        for style in MELODY_GENERATOR_MAP.ready():
+            modules.setdefault(MELODY_GENERATOR_MAP.module_name(style), style)
+        for style in modules.values():
+            module = MELODY_GENERATOR_MAP.load(style)
+            module.get_model().learn_ids(ids, new_states=module.LEARN_NEW_STATES, max_notes=MAX_LEARNED_NOTES,
+                                         max_new_states=MAX_LEARNED_STATES)
+    LEARNED_NOTES.inc(len(ids), mode='shared')
+    trace('learn_phrase', INFO, notes=len(ids), styles=list(modules.values()))
+
+def session_learned_phrases(session_id, session):
+    """
+    Returns:
+        LearnedPhrases: The session's uploaded phrases, for the styles' learned_phrases. The
+            models keep the views they build from them, so that the next generation of the
+            session only counts the phrases uploaded since.
+    """
+    return LearnedPhrases(session.get('learned_notes', []), session_id, session.get('learned_offset', 0))
+
+def add_session_phrase(session, notes):
+    """
+    Keeps an uploaded phrase in the session for its later generations, when LEARN_UPLOADS is 'session'.
+    """
+    if LEARN_UPLOADS != 'session' or not notes:
+        return
+    phrases = session.get('learned_notes', []) + [notes[-MAX_SESSION_LEARNED_NOTES:]]
+    dropped = 0
+    while len(phrases) - dropped > 1 and sum(len(p) for p in phrases[dropped:]) > MAX_SESSION_LEARNED_NOTES:
+        dropped += 1
+    session['learned_notes'] = phrases[dropped:]
+    # number of the first phrase kept, see LearnedPhrases
+    session['learned_offset'] = session.get('learned_offset', 0) + dropped
+    LEARNED_NOTES.inc(len(notes), mode='session')
+
+def apply_variation(requested_variation, seed_ids, current_ids, recent_ids, end_policy, quarter_note_per_bar,
+                    learned_phrases=()):
+    """
+    Appends the notes of a variation to the melody. Notes are int32 arrays of VOCABULARY ids.
+    learned_phrases are phrases the style models also learn from, for this variation only.
+
+    Returns:
+        tuple: (current_ids with the new notes appended, ids of the new notes, is_makam_notes flags of the new notes)
+    """
+    style = MELODY_GENERATOR_MAP.module_name(requested_variation) if requested_variation in MELODY_GENERATOR_MAP else ''
+    # the label only takes known names, the request can carry anything
+    variation = requested_variation if style or requested_variation in ('repeat-previous', 'repeat-seed') else 'invalid'
+    try:
+        with STAGE_SECONDS.time(stage='generate'):
+            current_ids, new_ids, is_makam_notes = generate_variation(
+                requested_variation, seed_ids, current_ids, recent_ids, end_policy, quarter_note_per_bar,
+                learned_phrases)
+    except Exception:
+        VARIATIONS.inc(variation=variation, style=style, outcome='error')
+        raise
+    VARIATIONS.inc(variation=variation, style=style, outcome='ok')
+    GENERATED_NOTES.inc(len(new_ids), variation=variation, style=style)
+    return current_ids, new_ids, is_makam_notes
+
+def generate_variation(requested_variation, seed_ids, current_ids, recent_ids, end_policy, quarter_note_per_bar,
+                       learned_phrases=()):
+    if requested_variation == 'repeat-previous':
+        new_ids = recent_ids
+        current_ids = np.concatenate([current_ids, new_ids])
+    elif requested_variation in MELODY_GENERATOR_MAP:
+        try:
+            generate_melody = MELODY_GENERATOR_MAP[requested_variation]
+        except Exception as e:
+            raise VariationError(f'Style {requested_variation} is not available: {e}', 503)
+        current_ids, new_ids = generate_melody(current_ids, length=MAX_LENGTH, max_bars=MAX_BARS,
+                                               quarter_note_per_bar=quarter_note_per_bar, end_policy=end_policy,
+                                               learned_phrases=learned_phrases)
+    elif requested_variation == 'repeat-seed':
+        new_ids = seed_ids
+        current_ids = np.concatenate([current_ids, new_ids])
+    else:
+        raise VariationError('Invalid variation')
+
+    return current_ids, new_ids, [requested_variation == 'turkish'] * len(new_ids)
+
 @app.route("/api/update_melody", methods=['POST'])
 def update_melody():
     # Check if this is an upload variation request
@@ -58,19 +366,23 @@ def update_melody():
         if not midi_file:
             return jsonify({'error': 'No file provided'}), 400
 
-        _, file_path = save_midi_file(midi_file)
-        
-        # Initial notes for all three note arrays
-        new_notes = midi_to_notes(file_path)
+        with STAGE_SECONDS.time(stage='decode'):
+            _, new_notes = read_uploaded_notes(midi_file)
 
-        # Get other data from form
-        seed_notes = json.loads(request.form.get('seed_notes', '[]'))
-        current_notes = json.loads(request.form.get('current_notes', '[]'))
-        variation_history = json.loads(request.form.get('variation_history', '[]'))
-        is_makam_notes = json.loads(request.form.get('is_makam_notes', '[]'))
+            # Get other data from form
+            try:
+                seed_notes = read_notes(json.loads(request.form.get('seed_notes', '[]')), 'seed_notes')
+                current_notes = read_notes(json.loads(request.form.get('current_notes', '[]')), 'current_notes')
+            except VariationError as e:
+                return jsonify({'error': e.message}), e.status
+            variation_history = json.loads(request.form.get('variation_history', '[]'))
+            is_makam_notes = json.loads(request.form.get('is_makam_notes', '[]'))
 
+        learn_phrase(new_notes)
         current_melody = list(current_notes) + list(new_notes)
         is_makam_notes = is_makam_notes + list([False] * len(new_notes))
+        VARIATIONS.inc(variation=requested_variation, style='', outcome='ok')
+        GENERATED_NOTES.inc(len(new_notes), variation=requested_variation, style='')
         
         midi_uri, _ = save_melody_to_midi(current_melody, is_makam_notes)
 
@@ -84,44 +396,40 @@ def update_melody():
         })
     
     # Handle regular JSON requests
-    data = request.json
-    if not data:
-        return jsonify({'error': 'No data provided'}), 400
-        
-    seed_notes = data.get('seed_notes', [])
-    current_notes = data.get('current_notes', [])
-    recent_notes = data.get('recent_notes', [])
+    with STAGE_SECONDS.time(stage='decode'):
+        data = request.json
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+
+        try:
+            seed_notes = read_notes(data.get('seed_notes', []), 'seed_notes')
+            current_notes = read_notes(data.get('current_notes', []), 'current_notes')
+            recent_notes = read_notes(data.get('recent_notes', []), 'recent_notes')
+            is_makam_notes = read_is_makam_notes(data.get('is_makam_notes', []), current_notes)
+        except VariationError as e:
+            return jsonify({'error': e.message}), e.status
     variation_history = data.get('variation_history', [])
     requested_variation = data.get('requested_variation', '')
-    is_makam_notes = data.get('is_makam_notes', [])
-    
-    new_notes = []
-
-    if requested_variation == 'repeat-previous':
-        new_notes = [n for n in recent_notes]
-        current_notes = list(current_notes) + list(new_notes)   
-    elif requested_variation in ['turkish', 'indian', 'classical', 'carnatic', 'cumbia', 'mozart']:
-        current_notes, new_notes = MELODY_GENERATOR_MAP[requested_variation](current_notes, length=MAX_LENGTH, max_bars=MAX_BARS, quarter_note_per_bar=QUARTER_NOTE_PER_BAR)
-    elif requested_variation == 'repeat-seed':
-        new_notes = [n for n in seed_notes]
-        current_notes = list(current_notes) + list(new_notes)   
-    else:
-        return jsonify({'error': 'Invalid variation'}), 400
+    # notes are vocabulary ids from here until the response, -1 for states no style or upload has
+    seed_ids, current_ids, recent_ids = find_request_ids(requested_variation, seed_notes, current_notes, recent_notes)
 
-    if requested_variation == 'turkish':
-        is_makam_notes = is_makam_notes + list([True] * len(new_notes))
-    else:
-        is_makam_notes = is_makam_notes + list([False] * len(new_notes))
-    
-    #print(current_notes)
-    midi_uri, _ = save_melody_to_midi(current_notes, is_makam_notes)
+    try:
+        end_policy, quarter_note_per_bar = generation_options(data)
+        current_ids, new_ids, new_is_makam_notes = apply_variation(
+            requested_variation, seed_ids, current_ids, recent_ids, end_policy, quarter_note_per_bar)
+    except VariationError as e:
+        return jsonify({'error': e.message}), e.status
+    is_makam_notes = is_makam_notes + new_is_makam_notes
 
     # for json serialization
-    current_notes = [(n[0], float(n[1])) for n in current_notes]
-    new_notes = [(n[0], float(n[1])) for n in new_notes]
+    repeated = repeated_notes(requested_variation, seed_notes, recent_notes)
+    current_notes = request_notes(current_ids, current_notes + repeated)
+    new_notes = request_notes(new_ids, repeated)
+
+    midi_uri, _ = save_request_melody(current_ids, current_notes, is_makam_notes)
     
-    print(current_notes)
-    print(len(current_notes), len(new_notes))
+    trace('update_melody', INFO, variation=requested_variation, notes=len(current_notes), new_notes=len(new_notes))
+    trace('update_melody_notes', current_notes=current_notes, new_notes=new_notes)
     response = {
         'seed_notes': seed_notes,
         'current_notes': current_notes,
@@ -131,7 +439,146 @@ def update_melody():
         'variation_history': variation_history
     }
     #print(json.dumps(response, indent=2))
-    return jsonify(response)
+    with STAGE_SECONDS.time(stage='serialize'):
+        return jsonify(response)
+
+def iter_variation(requested_variation, seed_notes, current_notes, recent_notes, end_policy, quarter_note_per_bar):
+    """
+    Like apply_variation, but style notes are sampled lazily as the returned iterator is consumed.
+
+    Returns:
+        tuple: (iterator over the new notes, whether they are makam notes)
+    """
+    if requested_variation == 'repeat-previous':
+        return iter(list(recent_notes)), False
+    if requested_variation == 'repeat-seed':
+        return iter(list(seed_notes)), False
+    if requested_variation not in MELODY_GENERATOR_MAP:
+        raise VariationError('Invalid variation')
+    try:
+        MELODY_GENERATOR_MAP.load(requested_variation)
+    except Exception as e:
+        raise VariationError(f'Style {requested_variation} is not available: {e}', 503)
+    notes = MELODY_GENERATOR_MAP.continue_melody(
+        requested_variation, 'iter_generate', current_notes, MAX_LENGTH, max_bars=MAX_BARS,
+        quarter_note_per_bar=quarter_note_per_bar, end_policy=end_policy)
+    return notes, requested_variation == 'turkish'
+
+@app.route("/api/update_melody/stream", methods=['POST'])
+def update_melody_stream():
+    """
+    Streaming /api/update_melody for JSON requests. The response is JSON lines: a
+    {"type": "bar"} line for every bar as soon as its notes are sampled, with the notes,
+    their offset in current_notes and the bar as a base64 MIDI file, then a
+    {"type": "done"} line with the same fields /api/update_melody returns, or a
+    {"type": "error"} line if generation fails after the first line went out.
+    """
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+
+    variation_history = data.get('variation_history', [])
+    requested_variation = data.get('requested_variation', '')
+
+    try:
+        seed_notes = read_notes(data.get('seed_notes', []), 'seed_notes')
+        current_notes = read_notes(data.get('current_notes', []), 'current_notes')
+        recent_notes = read_notes(data.get('recent_notes', []), 'recent_notes')
+        is_makam_notes = read_is_makam_notes(data.get('is_makam_notes', []), current_notes)
+        end_policy, quarter_note_per_bar = generation_options(data)
+        new_notes, is_makam = iter_variation(
+            requested_variation, seed_notes, current_notes, recent_notes, end_policy, quarter_note_per_bar)
+    except VariationError as e:
+        return jsonify({'error': e.message}), e.status
+
+    def lines():
+        try:
+            yield from variation_lines()
+        except Exception as e:
+            # the status line went out with the first bar, the error can only be a line too
+            trace('update_melody_stream_failed', ERROR, variation=requested_variation, error=str(e))
+            yield json.dumps({'type': 'error', 'error': f'Generation failed: {e}'}) + '\n'
+
+    def variation_lines():
+        generated = []
+        for bar, notes in split_bars(new_notes, quarter_note_per_bar):
+            notes = [(n[0], float(n[1])) for n in notes]
+            flags = [is_makam] * len(notes)
+            midi_bytes = melody_to_midi_bytes(notes, flags, makam_midi_pitch)
+            yield json.dumps({
+                'type': 'bar',
+                'bar': bar,
+                'offset': len(current_notes) + len(generated),
+                'notes': notes,
+                'is_makam_notes': flags,
+                'midi': base64.b64encode(midi_bytes).decode('ascii'),
+            }) + '\n'
+            generated += notes
+
+        melody = current_notes + generated
+        melody_is_makam_notes = is_makam_notes + [is_makam] * len(generated)
+        midi_uri, _ = save_melody_to_midi(melody, melody_is_makam_notes)
+        yield json.dumps({
+            'type': 'done',
+            'seed_notes': seed_notes,
+            'current_notes': melody,
+            'recent_notes': generated,
+            'midi_uri': midi_uri,
+            'is_makam_notes': melody_is_makam_notes,
+            'variation_history': variation_history,
+        }) + '\n'
+
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+
+@app.route("/api/batch_variations", methods=['POST'])
+def batch_variations():
+    """
+    Generates several candidate continuations of current_notes in one call. The body has
+    current_notes, requests: [{"style": ..., "count": ...}] and the optional end_policy and
+    time_signature. Each style model samples all its candidates together; every candidate
+    comes back with its notes and the MIDI URI of the continuation alone.
+    """
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+    requests = data.get('requests', [])
+    try:
+        current_notes = read_notes(data.get('current_notes', []), 'current_notes')
+        end_policy, quarter_note_per_bar = generation_options(data)
+        counts = [(r['style'], int(r.get('count', 1))) for r in requests]
+    except VariationError as e:
+        return jsonify({'error': e.message}), e.status
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Invalid requests, expected a list of {"style", "count"}'}), 400
+    if not counts or any(count < 1 for _, count in counts):
+        return jsonify({'error': 'Invalid requests, expected a list of {"style", "count"}'}), 400
+    if sum(count for _, count in counts) > MAX_BATCH_CANDIDATES:
+        return jsonify({'error': f'At most {MAX_BATCH_CANDIDATES} candidates per request'}), 400
+    for style, _ in counts:
+        if style not in MELODY_GENERATOR_MAP:
+            return jsonify({'error': f'Invalid style {style}'}), 400
+
+    candidates = []
+    for style, count in counts:
+        try:
+            MELODY_GENERATOR_MAP.load(style)
+        except Exception as e:
+            return jsonify({'error': f'Style {style} is not available: {e}'}), 503
+        phrases = MELODY_GENERATOR_MAP.continue_melody(
+            style, 'generate_candidates', current_notes, count, MAX_LENGTH, max_bars=MAX_BARS,
+            quarter_note_per_bar=quarter_note_per_bar, end_policy=end_policy)
+        for index, phrase in enumerate(phrases):
+            notes = [(n[0], float(n[1])) for n in phrase]
+            is_makam_notes = [style == 'turkish'] * len(notes)
+            midi_uri, _ = save_melody_to_midi(notes, is_makam_notes)
+            candidates.append({
+                'style': style,
+                'index': index,
+                'notes': notes,
+                'is_makam_notes': is_makam_notes,
+                'midi_uri': midi_uri,
+            })
+    return jsonify({'offset': len(current_notes), 'candidates': candidates})
 
 @app.route("/api/get_seed_notes", methods=['POST'])
 def get_seed_notes():
@@ -139,12 +586,11 @@ def get_seed_notes():
         return jsonify({'error': 'No file provided'}), 400
         
     midi_file = request.files['file']
-    midi_uri, file_path = save_midi_file(midi_file)
-    
-    # Initial notes for all three note arrays
-    initial_notes = midi_to_notes(file_path)
+    data, initial_notes = read_uploaded_notes(midi_file)
+    midi_uri, _ = save_midi_bytes(data)
+    learn_phrase(initial_notes)
 
-    initial_notes = [(n[0], float(n[1])) for n in initial_notes]
+    # Initial notes for all three note arrays
     is_makam_notes = [False] * len(initial_notes)
     
     # Mock response with initial data
@@ -157,69 +603,256 @@ def get_seed_notes():
         'variation_history': ['seed']
     })
 
-# Define constants for paths
-MODEL_PATH = "/home/kdr_aviaryhq_com/data/music_transformer/melody_conditioned_model_16.ckpt"
-OUTPUT_BASE_PATH = "/home/kdr_aviaryhq_com/github/balkon/apps/demo-melody-adventure/api/midi_files"
+def session_delta(session_id, session, offset, new_notes, new_is_makam_notes):
+    return {
+        'session_id': session_id,
+        'version': session['version'],
+        'offset': offset,
+        'recent_notes': new_notes,
+        'is_makam_notes': new_is_makam_notes,
+        'variation': session['variation_history'][-1],
+        'midi_uri': session['midi_uri'],
+    }
+
+@app.route("/api/sessions", methods=['POST'])
+def create_session():
+    """
+    Starts a session from an uploaded seed MIDI file or a JSON list of seed_notes and
+    returns the full session state once; later updates only return deltas.
+    """
+    uploaded = 'file' in request.files
+    if uploaded:
+        _, seed_notes = read_uploaded_notes(request.files['file'])
+        learn_phrase(seed_notes)
+    else:
+        data = request.get_json(silent=True) or {}
+        try:
+            seed_notes = read_notes(data.get('seed_notes', []), 'seed_notes')
+        except VariationError as e:
+            return jsonify({'error': e.message}), e.status
+
+    session_id, session = new_session(seed_notes)
+    if uploaded:
+        add_session_phrase(session, session['seed_notes'])
+    session['midi_uri'], _ = save_melody_to_midi(session['current_notes'], session['is_makam_notes'])
+    SESSION_STORE.put(session_id, session)
+    return jsonify(dict(session, session_id=session_id))
+
+@app.route("/api/sessions/<session_id>", methods=['GET'])
+def get_session(session_id):
+    session = SESSION_STORE.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify(dict(session, session_id=session_id))
+
+@app.route("/api/sessions/<session_id>", methods=['DELETE'])
+def delete_session(session_id):
+    if not SESSION_STORE.delete(session_id):
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify({'success': True})
+
+@app.route("/api/sessions/<session_id>/update_melody", methods=['POST'])
+def update_session_melody(session_id):
+    """
+    Applies one variation to a stored session. The request carries only the variation
+    (JSON {requested_variation, end_policy, time_signature, version}, or a multipart
+    upload-phrase with a file); the response carries only the appended notes, starting at
+    index offset of current_notes, and the MIDI URI of the whole melody.
+    """
+    session = SESSION_STORE.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
 
-# TODO - only works on my server, to setup make a conda environment named magenta following instructions from here and also git clone / download checkpoint and make paths simlilar to the avove constant files
+    data = request.form if request.form else (request.get_json(silent=True) or {})
+    requested_variation = data.get('requested_variation', '')
+    version = session['version']
+    if data.get('version') is not None:
+        try:
+            # through str, so that true and 1.5 are rejected rather than read as 1
+            expected_version = int(str(data['version']))
+        except ValueError:
+            return jsonify({'error': 'Invalid version, expected an integer'}), 400
+        if expected_version != version:
+            return jsonify({'error': 'Session was updated concurrently', 'version': version}), 409
+
+    offset = len(session['current_notes'])
+    # seed notes sent as JSON are stored as sent, see request_notes
+    current_ids, seed_ids, recent_ids = find_request_ids(
+        requested_variation, session['current_notes'], session['seed_notes'], session['recent_notes'])
+    if requested_variation == 'upload-phrase':
+        if 'file' not in request.files or not request.files['file']:
+            return jsonify({'error': 'No file provided'}), 400
+        _, new_notes = read_uploaded_notes(request.files['file'])
+        learn_phrase(new_notes)
+        new_ids = VOCABULARY.encode(new_notes)
+        current_ids = np.concatenate([current_ids, new_ids])
+        new_is_makam_notes = [False] * len(new_notes)
+    else:
+        try:
+            end_policy, quarter_note_per_bar = generation_options(data)
+            current_ids, new_ids, new_is_makam_notes = apply_variation(
+                requested_variation, seed_ids, current_ids, recent_ids, end_policy, quarter_note_per_bar,
+                session_learned_phrases(session_id, session))
+        except VariationError as e:
+            return jsonify({'error': e.message}), e.status
+
+    new_notes = request_notes(new_ids, repeated_notes(
+        requested_variation, [tuple(n) for n in session['seed_notes']], [tuple(n) for n in session['recent_notes']]))
+    if requested_variation == 'upload-phrase':
+        add_session_phrase(session, new_notes)
+    session['is_makam_notes'] = session['is_makam_notes'] + new_is_makam_notes
+    session['current_notes'] = session['current_notes'] + new_notes
+    session['recent_notes'] = new_notes
+    session['variation_history'] = session['variation_history'] + [requested_variation]
+    session['midi_uri'], _ = save_request_melody(
+        current_ids, [tuple(n) for n in session['current_notes']], session['is_makam_notes'])
+    session['version'] = version + 1
+
+    if not SESSION_STORE.put(session_id, session, expected_version=version):
+        return jsonify({'error': 'Session was updated concurrently'}), 409
+    return jsonify(session_delta(session_id, session, offset, new_notes, new_is_makam_notes))
+
+# Accompaniment runs on persistent worker processes that keep the model loaded.
+# TODO - the piano_transformer backend only works on my server, to setup make a conda environment named magenta
+# following the instructions from here and download the checkpoint, then point MELODY_ACCOMPANIMENT_MODEL_PATH to it
 # https://github.com/Elvenson/piano_transformer
+# MELODY_ACCOMPANIMENT_BACKEND=stub serves the melody itself as accompaniment, for development without the model
+# MELODY_ACCOMPANIMENT_JOB_BACKEND=redis shares the job table between the worker processes of api.serve
+ACCOMPANIMENT_POOL = AccompanimentPool(table=create_job_table())
+REGISTRY.gauge('melody_accompaniment_queued', 'Accompaniment jobs waiting for a worker.',
+               lambda: ACCOMPANIMENT_POOL.status()['queued'])
+# Seconds between status checks and between keep-alive comments of the job event stream
+EVENT_POLL_INTERVAL = 0.5
+EVENT_KEEP_ALIVE = 15
+
+def accompaniment_paths(data):
+    """
+    Returns:
+        str: Path of the melody MIDI file named by the request's midi_uri.
+        str: Temporary path for the worker to write the accompaniment to.
+    """
+    midi_uri = data.get('midi_uri') if data else None
+    if not midi_uri:
+        raise AccompanimentError('No MIDI URI provided', status=400)
+
+    # Construct the full path to the MIDI file
+    melody_path = os.path.join(MIDI_FOLDER, os.path.basename(midi_uri))
+    if not os.path.exists(melody_path):
+        raise AccompanimentError('MIDI file not found.', status=404)
+    return melody_path, os.path.join(MIDI_FOLDER, f'accompaniment-{uuid.uuid4().hex}.part')
+
+def store_accompaniment(job):
+    """
+    Moves a finished job's output into the MIDI store.
+
+    Returns:
+        str: URL path of the accompaniment MIDI file.
+    """
+    with open(job.output_path, 'rb') as f:
+        data = f.read()
+    os.remove(job.output_path)
+    midi_uri, _ = save_midi_bytes(data)
+    return midi_uri
+
+def accompaniment_error(e):
+    response = jsonify({'error': e.message})
+    if isinstance(e, QueueFullError):
+        response.headers['Retry-After'] = str(RETRY_AFTER)
+    return response, e.status
+
 @app.route("/api/generate_accompaniment", methods=['POST'])
 def generate_accompaniment():
+    """
+    Generates an accompaniment and waits for it, see /api/accompaniment_jobs to not hold the connection.
+    """
     try:
-        data = request.json
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
-
-        midi_uri = data.get('midi_uri')
-        if not midi_uri:
-            return jsonify({'error': 'No MIDI URI provided'}), 400
-
-        # Construct the full path to the MIDI file
-        melody_path = os.path.join(OUTPUT_BASE_PATH, os.path.basename(midi_uri))
-        if not os.path.exists(melody_path):
-            return jsonify({"error": "MIDI file not found."}), 404
-
-        # Create a temporary directory for the output
-        with tempfile.TemporaryDirectory() as tmp_output_dir:
-            # Build the command to execute the melody generation program
-            command = [
-                "conda", "run", "-n", "magenta", "python", "/home/kdr_aviaryhq_com/github/piano_transformer/melody_sample.py",
-                f"-model_path={MODEL_PATH}",
-                f"-output_dir={tmp_output_dir}",
-                "-decode_length=1024",
-                f"-melody_path={melody_path}",
-                "-num_samples=1"
-            ]
-
-            # Execute the program and wait for completion
-            try:
-                subprocess.run(command, check=True)
-            except subprocess.CalledProcessError as e:
-                return jsonify({"error": f"Failed to generate accompaniment: {str(e)}"}), 500
-
-            # Find the generated MIDI file in the output directory
-            generated_midi_file = None
-            for file_name in os.listdir(tmp_output_dir):
-                if file_name.endswith(".mid"):
-                    generated_midi_file = os.path.join(tmp_output_dir, file_name)
-                    break
-
-            if not generated_midi_file:
-                return jsonify({"error": "No accompaniment MIDI file generated."}), 500
-
-            # Generate a unique ID and move the generated MIDI file to the final location
-            midi_id = str(uuid.uuid4())
-            final_midi_path = os.path.join(OUTPUT_BASE_PATH, f"{midi_id}.mid")
-            os.rename(generated_midi_file, final_midi_path)
-
-            # Return the MIDI file URL
-            midi_url = f"/midi/{midi_id}.mid"
-            return jsonify({
-                "success": True,
-                "midi_uri": midi_url
-            })
-
+        melody_path, output_path = accompaniment_paths(request.get_json(silent=True))
+        midi_uri = ACCOMPANIMENT_POOL.generate(melody_path, output_path, finalize=store_accompaniment)
+    except AccompanimentError as e:
+        return accompaniment_error(e)
     except Exception as e:
         return jsonify({
             "error": str(e)
         }), 500
+
+    # Return the MIDI file URL
+    return jsonify({
+        "success": True,
+        "midi_uri": midi_uri
+    })
+
+def job_status(job_id):
+    """
+    Returns:
+        dict: The job status for a response, with the midi_uri of the accompaniment once done,
+            None if the job is unknown.
+    """
+    status = ACCOMPANIMENT_POOL.job_status(job_id)
+    return None if status is None else public_job_status(status)
+
+def public_job_status(status):
+    status = dict(status)
+    if 'result' in status:
+        status['midi_uri'] = status.pop('result')
+    return status
+
+@app.route("/api/accompaniment_jobs", methods=['POST'])
+def submit_accompaniment_job():
+    """
+    Queues an accompaniment for the melody at midi_uri and returns right away with the job id,
+    the job is then followed by polling its status or reading its event stream.
+    """
+    try:
+        melody_path, output_path = accompaniment_paths(request.get_json(silent=True))
+        job = ACCOMPANIMENT_POOL.submit(melody_path, output_path, finalize=store_accompaniment)
+    except AccompanimentError as e:
+        return accompaniment_error(e)
+    status = job_status(job.id)
+    status['status_uri'] = f'/api/accompaniment_jobs/{job.id}'
+    status['events_uri'] = f'/api/accompaniment_jobs/{job.id}/events'
+    return jsonify(status), 202
+
+@app.route("/api/accompaniment_jobs/<job_id>", methods=['GET'])
+def get_accompaniment_job(job_id):
+    status = job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(status)
+
+@app.route("/api/accompaniment_jobs/<job_id>", methods=['DELETE'])
+def cancel_accompaniment_job(job_id):
+    status, cancelled = ACCOMPANIMENT_POOL.cancel(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not cancelled:
+        return jsonify({'error': 'Job already finished', 'state': status['state']}), 409
+    return jsonify(public_job_status(status))
+
+@app.route("/api/accompaniment_jobs/<job_id>/events", methods=['GET'])
+def accompaniment_job_events(job_id):
+    """
+    Server-sent events with the job status: a "status" event whenever it changes, the
+    stream ends once the job finished.
+    """
+    status = job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def events(status):
+        last_status = None
+        last_event = time.monotonic()
+        while status is not None:
+            if status != last_status:
+                yield f'event: status\ndata: {json.dumps(status)}\n\n'
+                last_status = status
+                last_event = time.monotonic()
+            elif time.monotonic() - last_event >= EVENT_KEEP_ALIVE:
+                yield ': keep-alive\n\n'
+                last_event = time.monotonic()
+            if status['state'] not in (QUEUED, RUNNING):
+                return
+            ACCOMPANIMENT_POOL.wait(job_id, EVENT_POLL_INTERVAL)
+            status = job_status(job_id)
+
+    return Response(stream_with_context(events(status)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
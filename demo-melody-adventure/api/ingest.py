@@ -0,0 +1,43 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from .tracing import INFO, trace
+
+# Processes used to parse corpus files, 1 parses everything in the calling process.
+# `python -m api.train` raises it to the number of cores (see its --workers option).
+INGEST_WORKERS = int(os.environ.get('MELODY_INGEST_WORKERS', '1'))
+
+def parallel_map(function, items, workers=None, chunksize=None, desc=None):
+    """
+    Applies function to every item, fanning the calls out over a process pool.
+
+    Args:
+        function (callable): Module-level (picklable) function taking one item.
+        items (list): Items to process, e.g. corpus file paths.
+        workers (int): Number of processes, defaults to INGEST_WORKERS.
+        chunksize (int): Items sent to a worker at once, defaults to ~4 chunks per worker.
+        desc (str): Label for the progress bar and the traced timing.
+
+    Returns:
+        list: The results, in the same order as items.
+    """
+    items = list(items)
+    workers = max(1, min(INGEST_WORKERS if workers is None else workers, len(items)))
+    start = time.perf_counter()
+
+    if workers == 1:
+        results = [function(item) for item in tqdm(items, desc=desc)]
+    else:
+        chunksize = chunksize or max(1, len(items) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # executor.map yields results in submission order regardless of completion order
+            results = list(tqdm(executor.map(function, items, chunksize=chunksize), total=len(items), desc=desc))
+
+    elapsed = time.perf_counter() - start
+    rate = len(items) / elapsed if elapsed else float('inf')
+    trace('ingest', INFO, corpus=desc or 'ingest', files=len(items), seconds=round(elapsed, 1), workers=workers,
+          files_per_second=round(rate, 1))
+    return results
@@ -0,0 +1,284 @@
+"""
+In-process counters and histograms, exposed in the Prometheus text format on /metrics.
+
+Recording a value is a dict lookup and an addition under a lock; the text is only
+built when /metrics is scraped. Each process keeps its own metrics. The workers of
+api.serve also copy their counters and histograms to a shared directory (see
+MetricsRegistry.share), so a scrape of any worker reports the sum over all workers,
+while gauges come from the worker that answered.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds between the copies a process writes of its metrics, see MetricsRegistry.share
+METRICS_FLUSH_INTERVAL = float(os.environ.get('MELODY_METRICS_FLUSH_INTERVAL', '5'))
+# Seconds, from sub-millisecond stages up to slow model loads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} takes the labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self, name=None):
+        name = name or self.name
+        return [f'# HELP {name} {self.documentation}', f'# TYPE {name} {self.kind}']
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: label values -> value, a copy.
+        """
+        with self._lock:
+            return {key: self.copy(value) for key, value in self._values.items()}
+
+    @staticmethod
+    def copy(value):
+        return value
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    @staticmethod
+    def add(value, other):
+        return value + other
+
+    def render(self, values=None):
+        """
+        Args:
+            values (dict): Values to render instead of this process' ones, from snapshot().
+        """
+        values = sorted((self.snapshot() if values is None else values).items())
+        name = f'{self.name}_total'
+        return self.header(name) + [f'{name}{format_labels(self.labelnames, key)} {format_value(value)}'
+                                    for key, value in values]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # per bucket counts (the last one is +Inf), then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the seconds spent in the with block, also when it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return sum(counts[:-1]) if counts else 0
+
+    @staticmethod
+    def copy(value):
+        return list(value)
+
+    @staticmethod
+    def add(value, other):
+        return [a + b for a, b in zip(value, other)]
+
+    def render(self, values=None):
+        """
+        Args:
+            values (dict): Values to render instead of this process' ones, from snapshot().
+        """
+        values = sorted((self.snapshot() if values is None else values).items())
+        lines = self.header()
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, [('le', format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+class Gauge(Metric):
+    """
+    Value read from a function when the metrics are scraped.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def render(self, values=None):
+        return self.header() + [f'{self.name} {format_value(self.function())}']
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.directory = None
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, function):
+        return self.register(Gauge(name, documentation, function))
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Metric name -> [label values, value] pairs of every counter and histogram.
+        """
+        with self._lock:
+            metrics = [metric for metric in self._metrics.values() if not isinstance(metric, Gauge)]
+        return {metric.name: [[list(key), value] for key, value in metric.snapshot().items()] for metric in metrics}
+
+    def save(self, path):
+        """
+        Writes snapshot() as JSON, replacing path at once so readers never see a partial file.
+        """
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, path)
+
+    def share(self, directory, interval=METRICS_FLUSH_INTERVAL):
+        """
+        Writes this process' metrics to <directory>/<pid>.json every interval seconds, and
+        makes render() add up the files of the other processes writing there. Files of
+        processes that exited are kept, so counters do not go backwards when a worker is
+        restarted; a worker that dies loses at most its last interval.
+        """
+        self.directory = directory
+        path = os.path.join(directory, f'{os.getpid()}.json')
+
+        def flush():
+            while True:
+                try:
+                    self.save(path)
+                except OSError:
+                    pass  # the directory was removed on shutdown
+                time.sleep(interval)
+
+        threading.Thread(target=flush, daemon=True, name='metrics-share').start()
+
+    def shared_values(self):
+        """
+        Returns:
+            dict: Metric name -> [label values, value] pairs, from the files of the other processes.
+        """
+        values = {}
+        own = f'{os.getpid()}.json'
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, pairs in snapshot.items():
+                values.setdefault(name, []).extend(pairs)
+        return values
+
+    def render(self):
+        """
+        Returns:
+            str: All metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        shared = self.shared_values() if self.directory is not None else {}
+        lines = []
+        for metric in metrics:
+            values = None
+            if shared.get(metric.name):
+                values = metric.snapshot()
+                for key, value in shared[metric.name]:
+                    key = tuple(key)
+                    values[key] = metric.add(values[key], value) if key in values else value
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'melody_request_seconds', 'Time to answer an API request.', ['endpoint', 'method', 'status'])
+REQUEST_BYTES = REGISTRY.counter(
+    'melody_request_bytes', 'Request body bytes received.', ['endpoint'])
+RESPONSE_BYTES = REGISTRY.counter(
+    'melody_response_bytes', 'Response body bytes sent, streamed responses excluded.', ['endpoint'])
+STAGE_SECONDS = REGISTRY.histogram(
+    'melody_stage_seconds',
+    'Time spent in each stage of a melody request: decode, learn, generate, midi_render, midi_write, serialize.',
+    ['stage'])
+VARIATIONS = REGISTRY.counter(
+    'melody_variations', 'Variations requested, by variation, style module and outcome.',
+    ['variation', 'style', 'outcome'])
+GENERATED_NOTES = REGISTRY.counter(
+    'melody_generated_notes', 'Notes appended to melodies, by variation and style module.', ['variation', 'style'])
+LEARNED_NOTES = REGISTRY.counter(
+    'melody_learned_notes', 'Uploaded notes learned by the style models, by mode (shared or session).', ['mode'])
+MIDI_BYTES = REGISTRY.counter(
+    'melody_midi_bytes', 'Bytes of MIDI files written to the store.')
@@ -0,0 +1,430 @@
+"""
+Reads the melody line of an uploaded MIDI file straight from its bytes.
+
+Follows the rules of utils.midi_to_melody_note_sequence (the part named
+"Soprano", else the first part; the bass note of chords; rests between notes)
+and reproduces how music21's MIDI import lays the notes out (chord grouping,
+quantization to 16ths and triplet 8ths, measures, voices for overlapping
+notes, ties at barlines and rests filling the gaps), without converter.parse
+building a Score.
+"""
+import functools
+import math
+import os
+import struct
+from fractions import Fraction
+
+from music21.common import opFrac
+
+# Uploads larger than this many bytes are rejected before parsing
+MAX_UPLOAD_BYTES = int(os.environ.get('MELODY_MAX_UPLOAD_BYTES', str(1024 * 1024)))
+# Files with more notes than this (in all tracks) are rejected
+MAX_UPLOAD_NOTES = int(os.environ.get('MELODY_MAX_UPLOAD_NOTES', '5000'))
+# Files whose melody lasts longer than this many quarter notes, or this many bars, are rejected
+MAX_UPLOAD_QUARTER_NOTES = int(os.environ.get('MELODY_MAX_UPLOAD_QUARTER_NOTES', '8192'))
+MAX_UPLOAD_BARS = int(os.environ.get('MELODY_MAX_UPLOAD_BARS', '8192'))
+
+# music21's default quarterLengthDivisors for MIDI import
+QUARTER_LENGTH_DIVISORS = (4, 3)
+# Quantized times are counted in integer units, fine enough for the divisors and meters down to x/64
+UNITS_PER_QUARTER = 192
+PERCUSSION_CHANNEL = 9
+
+NOTE_NAMES = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+
+class MidiParseError(ValueError):
+    pass
+
+class Track:
+    def __init__(self):
+        self.name = ''
+        self.notes = []  # (start tick, end tick, MIDI key number, channel), in note on order
+        self.time_signatures = []  # (tick, numerator, denominator)
+
+def key_to_name(key):
+    """
+    music21's spelling of a MIDI key number, e.g. 61 -> "C#4", 70 -> "B-4".
+    """
+    return f'{NOTE_NAMES[key % 12]}{key // 12 - 1}'
+
+def read_variable_length(data, position):
+    value = 0
+    while True:
+        if position >= len(data):
+            raise MidiParseError('Truncated variable length number')
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, position
+
+def read_track(data, max_notes):
+    """
+    Args:
+        data (bytes): The contents of one MTrk chunk.
+        max_notes (int): Raise MidiParseError beyond this many notes.
+
+    Returns:
+        Track: The notes, name and time signatures of the track.
+    """
+    track = Track()
+    sounding = {}  # (channel, key) -> [(note on order, start tick)] of notes not released yet
+    notes = []
+    tick = 0
+    position = 0
+    status = None
+    note_ons = 0
+    while position < len(data):
+        delta, position = read_variable_length(data, position)
+        tick += delta
+        if position >= len(data):
+            raise MidiParseError('Truncated event')
+        if data[position] & 0x80:
+            status = data[position]
+            position += 1
+        elif status is None or status >= 0xF0:
+            raise MidiParseError('Running status without a previous channel event')
+
+        if status == 0xFF:
+            if position >= len(data):
+                raise MidiParseError('Truncated event')
+            meta_type = data[position]
+            length, position = read_variable_length(data, position + 1)
+            payload = data[position:position + length]
+            position += length
+            if meta_type == 0x03 and not track.name:
+                track.name = payload.decode('latin-1')
+            elif meta_type == 0x58 and len(payload) >= 2:
+                track.time_signatures.append((tick, payload[0], 2 ** payload[1]))
+            elif meta_type == 0x2F:
+                break
+            continue
+        if status in (0xF0, 0xF7):
+            length, position = read_variable_length(data, position)
+            position += length
+            continue
+
+        kind, channel = status & 0xF0, status & 0x0F
+        if kind in (0xC0, 0xD0):
+            position += 1
+            continue
+        if position + 2 > len(data):
+            raise MidiParseError('Truncated event')
+        key, velocity = data[position], data[position + 1]
+        position += 2
+        if kind == 0x90 and velocity > 0:
+            sounding.setdefault((channel, key), []).append((note_ons, tick))
+            note_ons += 1
+        elif kind == 0x80 or kind == 0x90:
+            starts = sounding.get((channel, key))
+            if starts:
+                order, start = starts.pop(0)
+                notes.append((order, (start, tick, key, channel)))
+                if len(notes) > max_notes:
+                    raise MidiParseError(f'More than {max_notes} notes')
+    track.notes = [note for _, note in sorted(notes, key=lambda n: n[0])]
+    return track
+
+def read_midi(data, max_bytes=MAX_UPLOAD_BYTES, max_notes=MAX_UPLOAD_NOTES):
+    """
+    Parses the chunks of a Standard MIDI File.
+
+    Returns:
+        tuple: (ticks per quarter note, list of Track)
+    """
+    if len(data) > max_bytes:
+        raise MidiParseError(f'MIDI file larger than {max_bytes} bytes')
+    if len(data) < 14 or data[:4] != b'MThd':
+        raise MidiParseError('Not a MIDI file')
+    header_length, _, track_count, division = struct.unpack('>IHHH', data[4:14])
+    if division & 0x8000 or division == 0:
+        raise MidiParseError('SMPTE time division is not supported')
+
+    tracks = []
+    position = 8 + header_length
+    total_notes = 0
+    while position + 8 <= len(data) and len(tracks) < track_count:
+        chunk_type = data[position:position + 4]
+        (length,) = struct.unpack('>I', data[position + 4:position + 8])
+        chunk = data[position + 8:position + 8 + length]
+        position += 8 + length
+        if chunk_type != b'MTrk':
+            continue
+        track = read_track(chunk, max_notes - total_notes)
+        total_notes += len(track.notes)
+        tracks.append(track)
+    return division, tracks
+
+def group_chords(notes, division):
+    """
+    Groups notes starting (and ending) within a 16th of each other into chords,
+    like music21's midiTrackToStream.
+
+    Returns:
+        elements (list): (offset, quarterLength, key or None for percussion), the lowest key of chords.
+        voices_required (bool): True if notes start together but end at different times.
+    """
+    tolerance = division / max(QUARTER_LENGTH_DIVISORS)
+    notes = sorted(notes, key=lambda n: n[0])
+    elements = []
+    gathered = set()
+    voices_required = False
+    for i, (start, end, key, channel) in enumerate(notes):
+        if i in gathered:
+            continue
+        chord = []
+        for j in range(i + 1, len(notes)):
+            other_start, other_end = notes[j][:2]
+            if abs(other_start - start) >= tolerance:
+                break
+            if abs(other_end - end) > tolerance:
+                voices_required = True
+                continue
+            if not chord:
+                chord = [notes[i]]
+                gathered.add(i)
+            chord.append(notes[j])
+            gathered.add(j)
+        if chord:
+            # the chord takes the duration of its last note (but keeps its first note's offset)
+            duration = chord[-1][1] - chord[-1][0]
+            key = min(n[2] for n in chord)
+            percussion = any(n[3] == PERCUSSION_CHANNEL for n in chord)
+        else:
+            duration = end - start
+            percussion = channel == PERCUSSION_CHANNEL
+        elements.append((start / division, duration / division, None if percussion else key))
+    elements.sort(key=lambda e: e[0])
+    return elements, voices_required
+
+def nearest_multiple(value, divisor):
+    # common.nearestMultiple, with the match also returned in UNITS_PER_QUARTER
+    unit = 1 / divisor
+    multiple = math.floor(value / unit)
+    low = unit * multiple
+    if low > value or value > low + unit / 2.0:
+        multiple += 1
+    match = unit * multiple
+    return multiple * UNITS_PER_QUARTER // divisor, match, abs(round(value - match, 7))
+
+@functools.lru_cache(maxsize=4096)
+def best_match(value, zero_allowed=True, gap_to_fill=0.0):
+    """
+    music21's Stream.quantize choice between the divisors: smallest remaining gap to the
+    next element, then smallest error, then smallest unit.
+
+    Returns:
+        int: The quantized value in UNITS_PER_QUARTER.
+    """
+    candidates = []
+    for divisor in QUARTER_LENGTH_DIVISORS:
+        unit = 1 / divisor
+        units, match, error = nearest_multiple(value, divisor)
+        if not zero_allowed and match == 0.0:
+            units, match = UNITS_PER_QUARTER // divisor, unit
+            error = abs(round(value - match, 7))
+        remaining_gap = 0.0 if gap_to_fill % unit == 0 else max(gap_to_fill - match, 0.0)
+        candidates.append((remaining_gap, error, unit, match, units))
+    return min(candidates)[4]
+
+def quantize(elements):
+    """
+    Quantizes offsets and durations, durations preferring values that reach the next onset.
+
+    Returns:
+        list: (offset, duration, key) with offsets and durations in UNITS_PER_QUARTER.
+    """
+    offsets = [best_match(offset) for offset, _, _ in elements]
+    quantized = []
+    following = 0
+    for i, (_, duration, key) in enumerate(elements):
+        offset = offsets[i]
+        following = max(following, i + 1)
+        while following < len(offsets) and offsets[following] <= offset:
+            following += 1
+        if following == len(offsets):
+            duration = best_match(max(duration, 0), zero_allowed=False)
+        else:
+            gap_to_fill = (offsets[following] - offset) / UNITS_PER_QUARTER
+            duration = best_match(max(duration, 0), zero_allowed=False, gap_to_fill=gap_to_fill)
+        quantized.append((offset, duration, key))
+    return quantized
+
+def bar_starts(time_signatures, division, end, max_bars=MAX_UPLOAD_BARS):
+    """
+    Returns:
+        list: (bar start, bar length) of every bar up to end, in UNITS_PER_QUARTER. MidiParseError
+            for time signatures with bars shorter than a unit (e.g. a 0 numerator) and for more
+            than max_bars bars.
+    """
+    meters = {0: 4 * UNITS_PER_QUARTER}
+    for tick, numerator, denominator in sorted(time_signatures):
+        meters[round(tick * UNITS_PER_QUARTER / division)] = 4 * numerator * UNITS_PER_QUARTER // denominator
+    changes = sorted(meters.items())
+    bars = []
+    start = 0
+    change = 0
+    while start < end or not bars:
+        while change + 1 < len(changes) and changes[change + 1][0] <= start:
+            change += 1
+        length = changes[change][1]
+        if length <= 0:
+            raise MidiParseError('Invalid time signature')
+        if len(bars) == max_bars:
+            raise MidiParseError(f'More than {max_bars} bars')
+        bars.append((start, length))
+        start += length
+    return bars
+
+def fill_rests(elements, bar_length):
+    """
+    Adds rests for the parts of a bar no element sounds in, like makeRests(fillGaps=True).
+
+    Args:
+        elements (list): (offset, duration, pitch) sorted by offset.
+
+    Returns:
+        list: The rests as (offset, duration, 'Rest').
+    """
+    rests = []
+    position = 0
+    for offset, duration, _ in sorted(elements, key=lambda e: e[0]):
+        if offset > position:
+            rests.append((position, offset - position, 'Rest'))
+        position = max(position, offset + duration)
+    if position < bar_length:
+        rests.append((position, bar_length - position, 'Rest'))
+    return rests
+
+def overlaps(elements):
+    end = None
+    for offset, duration, _ in sorted(elements, key=lambda e: e[0]):
+        if end is not None and offset < end:
+            return True
+        end = offset + duration if end is None else max(end, offset + duration)
+    return False
+
+def make_voices(notes):
+    """
+    Spreads overlapping notes over voices like Measure.makeVoices: each note goes to the
+    first voice that is free at its offset.
+    """
+    voices = []
+    ends = []
+    for note in notes:
+        index = next((i for i, end in enumerate(ends) if end <= note[0]), None)
+        if index is None:
+            voices.append([])
+            ends.append(0)
+            index = len(voices) - 1
+        voices[index].append(note)
+        ends[index] = max(ends[index], note[0] + note[1])
+    return voices
+
+def layout(elements, bars, voices_required):
+    """
+    Places elements into bars like makeMeasures, makeVoices, makeTies and makeRests do
+    and flattens the result in music21's order.
+
+    Returns:
+        list: (pitch or 'Rest' or None, duration in UNITS_PER_QUARTER) in flat order.
+    """
+    # per bar: [voices, measure level elements], elements are (offset in bar, duration, pitch)
+    measures = [[[], []] for _ in bars]
+    bar_index = 0
+    for offset, duration, pitch in elements:
+        while bar_index + 1 < len(bars) and bars[bar_index + 1][0] <= offset:
+            bar_index += 1
+        measures[bar_index][1].append((offset - bars[bar_index][0], duration, pitch))
+
+    if voices_required:
+        for measure in measures:
+            if overlaps(measure[1]):
+                measure[0], measure[1] = make_voices(measure[1]), []
+
+    # makeTies: the rest of a note crossing the barline continues at the start of the next bar
+    index = 0
+    while index < len(measures):
+        voices, level = measures[index]
+        bar_length = bars[index][1]
+        if index + 1 == len(measures):
+            next_measure = [[], []]
+            next_bar = (bars[index][0] + bar_length, bar_length)
+        else:
+            next_measure, next_bar = measures[index + 1], None
+        next_has_voices = bool(next_measure[0])
+        for container in (voices or [level]):
+            container.sort(key=lambda e: e[0])
+            for i, (offset, duration, pitch) in enumerate(container):
+                if offset + duration <= bar_length:
+                    continue
+                container[i] = (offset, bar_length - offset, pitch)
+                remainder = (0, offset + duration - bar_length, pitch)
+                if next_has_voices:
+                    # music21 cannot match the voice ids, so voiced notes continue outside the voices
+                    destination = next_measure[1] if voices else next_measure[0][0]
+                elif voices:
+                    next_measure[0].append(next_measure[1])
+                    next_measure[1] = []
+                    destination = next_measure[0][-1]
+                else:
+                    destination = next_measure[1]
+                destination.append(remainder)
+                if next_bar is not None:
+                    measures.append(next_measure)
+                    bars.append(next_bar)
+                    next_bar = None
+        index += 1
+
+    flat = []
+    for (bar_start, bar_length), (voices, level) in zip(bars, measures):
+        if len(voices) == 1:
+            # flattenUnnecessaryVoices
+            level, voices = voices[0] + level, []
+        for voice in voices:
+            voice.extend(fill_rests(voice, bar_length))
+        if not voices:
+            level = level + fill_rests(level, bar_length)
+        ranked = [(offset, rank, i, pitch, duration)
+                  for rank, container in enumerate(voices + [level])
+                  for i, (offset, duration, pitch) in enumerate(sorted(container, key=lambda e: e[0]))]
+        flat.extend((pitch, duration) for _, _, _, pitch, duration in sorted(ranked, key=lambda e: e[:3]))
+    return flat
+
+@functools.lru_cache(maxsize=None)
+def quarter_length(units):
+    return opFrac(Fraction(units, UNITS_PER_QUARTER))
+
+def midi_bytes_to_notes(data, max_bytes=MAX_UPLOAD_BYTES, max_notes=MAX_UPLOAD_NOTES,
+                        max_quarter_notes=MAX_UPLOAD_QUARTER_NOTES, max_bars=MAX_UPLOAD_BARS):
+    """
+    Extracts the melody of a MIDI file as state tuples, the same list utils.midi_to_notes returns.
+
+    Args:
+        data (bytes): The MIDI file.
+        max_bytes (int): Size limit, larger files raise MidiParseError.
+        max_notes (int): Note count limit, files with more notes raise MidiParseError.
+        max_quarter_notes (int): Length limit of the melody, longer files raise MidiParseError.
+        max_bars (int): Bar count limit of the melody, files with more bars raise MidiParseError.
+
+    Returns:
+        list: (pitch nameWithOctave or 'Rest', quarterLength) tuples.
+    """
+    division, tracks = read_midi(data, max_bytes, max_notes)
+    parts = [track for track in tracks if track.notes]
+    if not parts:
+        return []
+    part = next((track for track in parts if 'Soprano' in track.name), parts[0])
+    if max(end for _, end, _, _ in part.notes) > max_quarter_notes * division:
+        # checked before laying out the bars, whose number is only bounded by the length
+        raise MidiParseError(f'Melody longer than {max_quarter_notes} quarter notes')
+
+    elements, voices_required = group_chords(part.notes, division)
+    elements = [(offset, duration, None if key is None else key_to_name(key))
+                for offset, duration, key in quantize(elements)]
+    end = max(offset + duration for offset, duration, _ in elements)
+    time_signatures = [signature for track in tracks for signature in track.time_signatures]
+    bars = bar_starts(time_signatures, division, end, max_bars)
+
+    return [(pitch, quarter_length(duration)) for pitch, duration in layout(elements, bars, voices_required)
+            if pitch is not None]
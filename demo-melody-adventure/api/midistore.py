@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .metrics import MIDI_BYTES, STAGE_SECONDS
+from .simplemelodygen.vocabulary import VOCABULARY
+
+# Disk budget of the MIDI folder, the least recently used files are deleted beyond it
+MIDI_STORE_MAX_BYTES = int(os.environ.get('MELODY_MIDI_MAX_BYTES', str(512 * 1024 * 1024)))
+# Files not written or requested for this many seconds are deleted
+MIDI_STORE_MAX_AGE = int(os.environ.get('MELODY_MIDI_MAX_AGE', str(7 * 24 * 3600)))
+# Minimum seconds between two age checks of the whole folder
+EVICTION_INTERVAL = 60
+
+# Bump when the rendered MIDI for the same notes changes, so old files are not reused
+RENDER_VERSION = 1
+
+def melody_key(melody, is_makam_notes=None):
+    """
+    Content address of a rendered melody: a hash of the notes and, for pitched
+    notes, whether they are tuned to the makam.
+
+    Args:
+        melody (list): (pitch or 'Rest', duration) pairs.
+        is_makam_notes (list): Per note flags as passed to save_melody_to_midi.
+
+    Returns:
+        str: 32 hex characters.
+    """
+    notes = [
+        [pitch, float(duration), pitch != 'Rest' and is_makam_notes is not None and bool(is_makam_notes[i])]
+        for i, (pitch, duration) in enumerate(melody)
+    ]
+    payload = json.dumps([RENDER_VERSION, notes], separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+def ids_key(ids, is_makam_notes=None, vocabulary=VOCABULARY):
+    """
+    melody_key of the melody of a sequence of state ids, built from JSON fragments
+    cached per state instead of serializing every note.
+
+    Args:
+        ids (array-like of int): State ids of the vocabulary.
+        is_makam_notes (list): Per note flags as passed to save_melody_to_midi.
+
+    Returns:
+        str: The same key as melody_key(vocabulary.decode(ids), is_makam_notes).
+    """
+    fragments = vocabulary.state_values(note_fragment, ids)
+    if is_makam_notes is not None:
+        makam_fragments = vocabulary.state_values(makam_note_fragment, ids)
+        fragments = [makam_fragments[i] if is_makam_notes[i] else fragment for i, fragment in enumerate(fragments)]
+    payload = f'[{RENDER_VERSION},[{",".join(fragments)}]]'
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+def note_fragment(pitch, duration):
+    return json.dumps([pitch, float(duration), False], separators=(',', ':'))
+
+def makam_note_fragment(pitch, duration):
+    return json.dumps([pitch, float(duration), pitch != 'Rest'], separators=(',', ':'))
+
+def bytes_key(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+class MidiStore:
+    """
+    Content-addressed folder of MIDI files named <key>.mid. A file's mtime is
+    refreshed whenever it is looked up, so eviction removes the least recently
+    used files first. Several server processes can share one folder: files are
+    written atomically and deleting a file another process already deleted is fine.
+    """
+
+    def __init__(self, folder, max_bytes=MIDI_STORE_MAX_BYTES, max_age=MIDI_STORE_MAX_AGE):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._bytes = sum(size for _, size, _ in self._files())
+        self._last_eviction = 0
+
+    def path(self, key):
+        return os.path.join(self.folder, f'{key}.mid')
+
+    def uri(self, key):
+        return f'/midi/{key}.mid'
+
+    def contains(self, key):
+        """
+        Returns True if the file exists, marking it as recently used.
+        """
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def put(self, key, data):
+        """
+        Writes the file for key (atomically) and evicts old files if needed.
+
+        Returns:
+            tuple: (URI, file path)
+        """
+        path = self.path(key)
+        tmp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+        with STAGE_SECONDS.time(stage='midi_write'):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        MIDI_BYTES.inc(len(data))
+        with self._lock:
+            self._bytes += len(data)
+        self.evict()
+        return self.uri(key), path
+
+    def get_or_render(self, key, render):
+        """
+        Returns the stored file for key, calling render() for its bytes only if it is not stored yet.
+
+        Returns:
+            tuple: (URI, file path)
+        """
+        if self.contains(key):
+            return self.uri(key), self.path(key)
+        return self.put(key, render())
+
+    def evict(self, force=False):
+        """
+        Deletes files older than max_age, then the least recently used files until
+        the folder fits in max_bytes. The folder is only scanned when it may be over
+        budget or EVICTION_INTERVAL seconds passed since the last scan.
+        """
+        now = time.time()
+        with self._lock:
+            if not force and self._bytes <= self.max_bytes and now - self._last_eviction < EVICTION_INTERVAL:
+                return
+            self._last_eviction = now
+
+        files = sorted(self._files(), key=lambda f: f[2])  # least recently used first
+        total = sum(size for _, size, _ in files)
+        for path, size, mtime in files:
+            if total <= self.max_bytes and now - mtime <= self.max_age:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self._lock:
+            self._bytes = total
+
+    def _files(self):
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.mid'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
@@ -0,0 +1,252 @@
+"""
+Encodes melodies straight to Standard MIDI File bytes.
+
+Produces the same file music21 writes for a one part Score of Notes and Rests
+(midi.translate.music21ObjectToMidiFile), without building any music21 objects.
+"""
+import functools
+import re
+import struct
+
+import numpy as np
+from music21.pitch import Pitch
+
+from .simplemelodygen.vocabulary import VOCABULARY
+
+# Same values as music21's defaults
+TICKS_PER_QUARTER = 10080
+TEMPO_MICROSECONDS_PER_QUARTER = 500000  # 120 bpm
+VELOCITY = 90
+CHANNEL = 0  # music21's channel 1
+PITCH_BEND_RANGE_CENTS = 200
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+PITCH_BEND = 0xE0
+# Largest delta time a variable length quantity can hold
+MAX_DELTA_TICKS = 0x0FFFFFFF
+
+NOTE_ON_EVENTS = [bytes((NOTE_ON | CHANNEL, key, VELOCITY)) for key in range(128)]
+NOTE_OFF_EVENTS = [bytes((NOTE_OFF | CHANNEL, key, 0)) for key in range(128)]
+
+PITCH_NAME = re.compile(r'^([A-G])(#{1,2}|-{1,2})?(-?\d+)$')
+STEP_SEMITONES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+ACCIDENTAL_SEMITONES = {None: 0, '#': 1, '##': 2, '-': -1, '--': -2}
+
+@functools.lru_cache(maxsize=None)
+def pitch_to_midi(name):
+    """
+    Args:
+        name (str): A pitch nameWithOctave, e.g. "C#4" or "B-3".
+
+    Returns:
+        tuple: (MIDI key number, cents the pitch is above/below that key)
+    """
+    match = PITCH_NAME.match(name)
+    if match is None:
+        # Microtonal accidentals etc., let music21 work out the rounding
+        pitch = Pitch(name)
+        return pitch.midi, pitch.getCentShiftFromMidi()
+    step, accidental, octave = match.groups()
+    return (int(octave) + 1) * 12 + STEP_SEMITONES[step] + ACCIDENTAL_SEMITONES[accidental], 0
+
+def is_pitch_name(name):
+    """
+    Returns:
+        bool: Whether name is a plain pitch nameWithOctave of a MIDI key (0-127), such as
+            "C#4", which pitch_to_midi converts without music21.
+    """
+    match = PITCH_NAME.match(name) if len(name) <= 6 else None
+    if match is None:
+        return False
+    step, accidental, octave = match.groups()
+    return 0 <= (int(octave) + 1) * 12 + STEP_SEMITONES[step] + ACCIDENTAL_SEMITONES[accidental] <= 127
+
+def pitch_bend_bytes(cents):
+    """
+    The two data bytes of a pitch bend by cents (GM +-2 semitone range),
+    rounded the way music21's MidiEvent.setPitchBend rounds.
+    """
+    cents = max(-PITCH_BEND_RANGE_CENTS, min(PITCH_BEND_RANGE_CENTS, cents))
+    span = 0x3FFF - 0x2000 if cents > 0 else 0x2000
+    value = 0x2000 + int(round(cents / PITCH_BEND_RANGE_CENTS * span))
+    return bytes((value & 0x7F, (value >> 7) & 0x7F))
+
+@functools.lru_cache(maxsize=4096)
+def variable_length(value):
+    """
+    Encodes a delta time, ValueError if it is negative or longer than MAX_DELTA_TICKS.
+    """
+    if not 0 <= value <= MAX_DELTA_TICKS:
+        raise ValueError(f'Delta time of {value} ticks is out of the MIDI range')
+    data = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        data.insert(0, 0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(data)
+
+def encode_track(events):
+    """
+    Args:
+        events (list): (tick, event bytes) pairs sorted by tick.
+
+    Returns:
+        bytes: An MTrk chunk.
+    """
+    data = bytearray()
+    previous_tick = 0
+    for tick, event in events:
+        data += variable_length(tick - previous_tick)
+        data += event
+        previous_tick = tick
+    return b'MTrk' + struct.pack('>I', len(data)) + bytes(data)
+
+def melody_to_midi_bytes(melody, is_makam_notes=None, makam_pitch=None):
+    """
+    Encodes a melody as a format 1 MIDI file: a conductor track (tempo and 4/4 time
+    signature) and one track with the notes. Microtonal notes are preceded by a pitch
+    bend and followed by a bend back to center. The only difference to music21's file is
+    that a microtonal first note gets its bend after the initial center bend, music21
+    writes them the other way around so that note plays untuned.
+
+    Args:
+        melody (list): (pitch or 'Rest', duration in quarter notes) pairs.
+        is_makam_notes (list): Per note flag, True notes are tuned with makam_pitch.
+        makam_pitch (callable): Pitch name -> (MIDI key number, cents), used for makam notes.
+
+    Returns:
+        bytes: The MIDI file.
+    """
+    notes = []
+    offset = 0
+    for i, (pitch, duration) in enumerate(melody):
+        if duration == 0:
+            # music21 writes zero length (grace) notes and rests as a quarter note
+            duration = 1.0
+        start = int(round(offset * TICKS_PER_QUARTER))
+        offset += duration
+        if pitch == 'Rest':
+            continue
+        if is_makam_notes is not None and is_makam_notes[i]:
+            key, cents = makam_pitch(pitch)
+        else:
+            key, cents = pitch_to_midi(pitch)
+        notes.append((start, start + int(round(duration * TICKS_PER_QUARTER)), key, cents))
+    return notes_to_midi_bytes(notes)
+
+def ids_to_midi_bytes(ids, is_makam_notes=None, makam_pitch=None, vocabulary=VOCABULARY):
+    """
+    Same as melody_to_midi_bytes for a melody given as vocabulary ids. Ticks are computed
+    for all notes at once and MIDI keys are looked up per pitch id.
+
+    Args:
+        ids (array-like of int): State ids of vocabulary.
+        is_makam_notes (list): Per note flag, True notes are tuned with makam_pitch.
+        makam_pitch (callable): Pitch name -> (MIDI key number, cents), used for makam notes.
+        vocabulary (StateVocabulary): The vocabulary of the ids.
+
+    Returns:
+        bytes: The MIDI file.
+    """
+    ids = np.asarray(ids, dtype=np.int32)
+    durations = vocabulary.durations(ids)
+    # music21 writes zero length (grace) notes and rests as a quarter note
+    durations = np.where(durations == 0, 1.0, durations)
+    offsets = np.zeros(len(durations))
+    np.cumsum(durations[:-1], out=offsets[1:])
+    starts = np.rint(offsets * TICKS_PER_QUARTER).astype(np.int64)
+    ends = starts + np.rint(durations * TICKS_PER_QUARTER).astype(np.int64)
+
+    pitch_ids = vocabulary.pitch_ids(ids)
+    pitched = np.flatnonzero(~np.array(vocabulary.pitch_values(is_rest, pitch_ids), dtype=bool))
+    pitched_ids = pitch_ids[pitched]
+    tuning = vocabulary.pitch_values(pitch_to_midi, pitched_ids)
+    if is_makam_notes is not None:
+        makam = [i for i, note in enumerate(pitched.tolist()) if is_makam_notes[note]]
+        if makam:
+            makam_tuning = vocabulary.pitch_values(makam_pitch, pitched_ids[makam])
+            for i, key_cents in zip(makam, makam_tuning):
+                tuning[i] = key_cents
+    notes = [(start, end, key, cents)
+             for start, end, (key, cents) in zip(starts[pitched].tolist(), ends[pitched].tolist(), tuning)]
+    return notes_to_midi_bytes(notes)
+
+def is_rest(pitch):
+    return pitch == 'Rest'
+
+def notes_to_midi_bytes(notes):
+    """
+    Args:
+        notes (list): (start tick, end tick, MIDI key number, cents) of every pitched note, in order.
+
+    Returns:
+        bytes: The MIDI file, see melody_to_midi_bytes. ValueError for notes that end
+            before they start or delta times MIDI cannot hold.
+    """
+    track = direct_track(notes)
+    if track is None:
+        # rounding to ticks can end a note a tick after the next one starts, music21
+        # then writes the events in tick order
+        track = sorted_track(notes)
+
+    conductor = encode_track([
+        (0, b'\xff\x51\x03' + TEMPO_MICROSECONDS_PER_QUARTER.to_bytes(3, 'big')),
+        (0, b'\xff\x58\x04\x04\x02\x18\x08'),
+        (TICKS_PER_QUARTER, b'\xff\x2f\x00'),
+    ])
+    header = b'MThd' + struct.pack('>IHHH', 6, 1, 2, TICKS_PER_QUARTER)
+    return header + conductor + track
+
+BEND = bytes((PITCH_BEND | CHANNEL,))
+CENTER_BEND = BEND + pitch_bend_bytes(0)
+
+def direct_track(notes):
+    """
+    Writes the track in one pass, the common case where every note ends before the next starts.
+
+    Returns:
+        bytes: The MTrk chunk, None if a note overlaps the previous one.
+    """
+    data = bytearray(b'\x00\xff\x03\x00')
+    if notes:
+        data += b'\x00' + CENTER_BEND
+    previous_tick = 0
+    last_tick = 0
+    for start, end, key, cents in notes:
+        if start < previous_tick:
+            return None
+        if end < start:
+            raise ValueError('Notes cannot have a negative duration')
+        if cents:
+            data += variable_length(start - previous_tick) + BEND + pitch_bend_bytes(cents)
+            previous_tick = start
+        data += variable_length(start - previous_tick) + NOTE_ON_EVENTS[key]
+        data += variable_length(end - start) + NOTE_OFF_EVENTS[key]
+        previous_tick = end
+        if cents:
+            data += b'\x00' + CENTER_BEND
+        last_tick = max(last_tick, end)
+    data += variable_length(last_tick + TICKS_PER_QUARTER - previous_tick) + b'\xff\x2f\x00'
+    return b'MTrk' + struct.pack('>I', len(data)) + bytes(data)
+
+def sorted_track(notes):
+    """
+    Writes the track from all its events sorted by tick, events at the same tick keep their order.
+
+    Returns:
+        bytes: The MTrk chunk.
+    """
+    events = [(0, b'\xff\x03\x00'), (0, CENTER_BEND)]
+    for start, end, key, cents in notes:
+        if end < start:
+            raise ValueError('Notes cannot have a negative duration')
+        if cents:
+            events.append((start, BEND + pitch_bend_bytes(cents)))
+        events.append((start, NOTE_ON_EVENTS[key]))
+        events.append((end, NOTE_OFF_EVENTS[key]))
+        if cents:
+            events.append((end, CENTER_BEND))
+    events.sort(key=lambda event: event[0])
+    events.append((max(end for _, end, _, _ in notes) + TICKS_PER_QUARTER, b'\xff\x2f\x00'))
+    return encode_track(events)
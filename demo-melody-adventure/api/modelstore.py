@@ -0,0 +1,43 @@
+import os
+import threading
+
+from .simplemelodygen.persistence import load_model
+
+# Trained model artifacts, written by `python -m api.train`
+MODELS_FOLDER = os.environ.get('MELODY_MODELS_FOLDER', os.path.join(os.path.dirname(__file__), 'models'))
+
+_models = {}
+_locks = {}
+_locks_lock = threading.Lock()
+
+def model_path(name):
+    return os.path.join(MODELS_FOLDER, name)
+
+def has_saved_model(name):
+    return os.path.exists(os.path.join(model_path(name), 'manifest.json'))
+
+def get_or_load_model(name, build_model):
+    """
+    Returns the model of a style, loading it on first use: from its memory mapped
+    artifact in MODELS_FOLDER when one exists, otherwise by training it in-process.
+
+    Args:
+        name (str): Style module name, also the artifact directory name.
+        build_model (callable): Trains the model from its corpus, returns (model, metadata).
+
+    Returns:
+        tuple: (model, metadata dict)
+    """
+    if name in _models:
+        return _models[name]
+
+    with _locks_lock:
+        lock = _locks.setdefault(name, threading.Lock())
+
+    with lock:
+        if name not in _models:
+            if has_saved_model(name):
+                _models[name] = load_model(model_path(name))
+            else:
+                _models[name] = build_model()
+    return _models[name]
@@ -0,0 +1,121 @@
+import importlib
+import threading
+import time
+
+from .tracing import WARNING, trace
+
+NOT_LOADED = 'not_loaded'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+
+class StyleRegistry:
+    """
+    Maps style names to their generate_melody functions, importing the style module
+    and loading its model only when the style is first requested (or warmed up).
+    """
+
+    def __init__(self, styles):
+        """
+        Args:
+            styles (dict): Style name -> style module name (relative to this package).
+        """
+        self._modules = dict(styles)
+        self._status = {style: {'state': NOT_LOADED} for style in styles}
+        self._lock = threading.Lock()
+
+    def __contains__(self, style):
+        return style in self._modules
+
+    def __iter__(self):
+        return iter(self._modules)
+
+    def module_name(self, style):
+        return self._modules[style]
+
+    def __getitem__(self, style):
+        return self.load(style).generate_melody
+
+    def load(self, style):
+        """
+        Imports the style module and loads its model, blocking until it is ready.
+
+        Args:
+            style (str): Style name.
+
+        Returns:
+            module: The loaded style module.
+        """
+        module_name = self._modules[style]
+        with self._lock:
+            if self._status[style]['state'] != READY:
+                self._status[style] = {'state': LOADING}
+        start = time.perf_counter()
+        try:
+            module = importlib.import_module(f'.{module_name}', __package__)
+            module.get_model()
+        except Exception as e:
+            with self._lock:
+                self._status[style] = {'state': FAILED, 'error': str(e)}
+            raise
+        with self._lock:
+            if self._status[style]['state'] != READY:
+                self._status[style] = {'state': READY, 'load_seconds': round(time.perf_counter() - start, 3)}
+        return module
+
+    def continue_melody(self, style, method, notes, *args, **options):
+        """
+        Calls a generation method of the style's model on a melody so far, falling back
+        to a fresh phrase when the model cannot continue it (its last note is unknown
+        to the model), like the styles' generate_melody.
+
+        Args:
+            style (str): Style name.
+            method (str): Name of a model method taking previous_sequence, e.g. 'iter_generate'
+                or 'generate_candidates'.
+            notes (list): The melody so far as (pitch, duration) tuples.
+
+        Returns:
+            The method's result.
+        """
+        generate = getattr(self.load(style).get_model(), method)
+        try:
+            return generate(*args, previous_sequence=notes, **options)
+        except Exception as e:
+            trace('generate_melody_fallback', WARNING, style=style, error=str(e))
+            return generate(*args, **options)
+
+    def status(self):
+        with self._lock:
+            return {style: dict(status) for style, status in self._status.items()}
+
+    def ready(self):
+        """
+        Returns:
+            list: The styles whose model is loaded.
+        """
+        return [style for style, status in self.status().items() if status['state'] == READY]
+
+    def is_ready(self):
+        return all(status['state'] == READY for status in self.status().values())
+
+    def warm_up(self, background=True):
+        """
+        Loads every style that is not loaded yet, one after another. Failures are
+        recorded in the status and do not stop the remaining styles.
+
+        Args:
+            background (bool): Run in a daemon thread and return it instead of blocking.
+        """
+        if background:
+            thread = threading.Thread(target=self.warm_up, kwargs={'background': False},
+                                      name='style-warm-up', daemon=True)
+            thread.start()
+            return thread
+
+        for style in self._modules:
+            try:
+                self.load(style)
+            except Exception as e:
+                # failures are in the status too, warnings are also written to stderr
+                trace('style_load_failed', WARNING, style=style, error=str(e))
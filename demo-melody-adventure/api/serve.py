@@ -0,0 +1,208 @@
+"""
+Production entry point: loads every style model once in a master process, then
+forks worker processes that serve the Flask app from one shared listening socket.
+
+    python -m api.serve                      # one worker per core on port 5328 (one without Redis jobs)
+    python -m api.serve --workers 4 --port 5328
+    python -m api.serve --workers 4 --report-memory
+
+Forked workers share the master's memory copy-on-write. Model arrays are made
+read-only and gc.freeze() moves everything loaded so far out of the garbage
+collector's reach, so the workers do not write to (and thereby copy) those pages.
+Dead workers are restarted; SIGTERM or Ctrl-C stops the master and its workers.
+More than one worker needs MELODY_ACCOMPANIMENT_JOB_BACKEND=redis, so that every
+worker can answer for the accompaniment jobs the others accepted; without it the
+default is a single worker. Every worker runs its own accompaniment pool, started on
+its first accompaniment request, with MELODY_ACCOMPANIMENT_WORKERS and
+MELODY_ACCOMPANIMENT_QUEUE_SIZE divided between the workers (at least one each). The workers copy
+their metrics to MELODY_METRICS_DIR (a temporary directory by default), and /metrics
+on any of them reports the sum over all workers.
+"""
+import argparse
+import gc
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+# The master loads the styles itself, a warm-up thread would not survive the fork
+os.environ.setdefault('MELODY_WARM_UP', '0')
+
+import numpy as np
+from werkzeug.serving import make_server
+
+from .accompaniment import ACCOMPANIMENT_JOB_BACKEND, ACCOMPANIMENT_WORKERS
+from .index import ACCOMPANIMENT_POOL, app, MELODY_GENERATOR_MAP
+from .metrics import REGISTRY
+from .sessions import SESSION_BACKEND
+from .simplemelodygen.vocabulary import StateVocabulary
+
+DEFAULT_PORT = 5328
+# Directory the workers copy their metrics to, a temporary one removed on exit by default
+METRICS_DIR = os.environ.get('MELODY_METRICS_DIR')
+
+def freeze_arrays(obj, seen=None):
+    """
+    Marks the numpy arrays of a model (and of its sampler and tables) read-only.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, StateVocabulary):
+        # shared by all models and still growing while serving
+        return
+    if isinstance(obj, np.ndarray):
+        obj.flags.writeable = False
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            freeze_arrays(item, seen)
+    elif type(obj).__module__.startswith(f'{__package__}.simplemelodygen'):
+        for value in vars(obj).values():
+            freeze_arrays(value, seen)
+
+def load_models():
+    """
+    Loads every style and precomputes what generation would otherwise build lazily in
+    each worker (samplers, duration tables), then freezes the model arrays.
+    """
+    start = time.perf_counter()
+    MELODY_GENERATOR_MAP.warm_up(background=False)
+    for style, status in MELODY_GENERATOR_MAP.status().items():
+        if status['state'] != 'ready':
+            continue
+        module = MELODY_GENERATOR_MAP.load(style)
+        model = module.get_model()
+        if model.sampler is None:
+            model.compile()
+        model._state_durations()
+        if hasattr(module, 'get_pitch_map'):
+            module.get_pitch_map()
+        freeze_arrays(model)
+    print(f'Loaded styles in {time.perf_counter() - start:.1f}s: {MELODY_GENERATOR_MAP.status()}')
+
+def memory_usage(pid):
+    """
+    Returns:
+        dict: Rss, Pss and private (unshared) memory of a process in MB, from /proc/<pid>/smaps_rollup.
+    """
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {'rss': fields['Rss'], 'pss': fields['Pss'],
+            'private': fields['Private_Clean'] + fields['Private_Dirty']}
+
+def report_memory(pids):
+    print(f'{"process":>10} {"rss MB":>8} {"pss MB":>8} {"private MB":>11}')
+    for name, pid in [('master', os.getpid())] + [(f'worker {i}', pid) for i, pid in enumerate(pids)]:
+        usage = memory_usage(pid)
+        print(f'{name:>10} {usage["rss"]:>8.1f} {usage["pss"]:>8.1f} {usage["private"]:>11.1f}')
+
+def run_worker(sock, host, port, metrics_dir):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    REGISTRY.share(metrics_dir)
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the melody API from pre-forked worker processes.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'port to listen on (default: {DEFAULT_PORT})')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: number of cores, 1 with the memory accompaniment job backend)')
+    parser.add_argument('--report-memory', action='store_true',
+                        help='print the memory use of the master and every worker once they started')
+    args = parser.parse_args(argv)
+
+    if args.workers is None:
+        args.workers = 1 if ACCOMPANIMENT_JOB_BACKEND == 'memory' else os.cpu_count() or 1
+        if ACCOMPANIMENT_JOB_BACKEND == 'memory' and (os.cpu_count() or 1) > 1:
+            print('Serving with 1 worker, set MELODY_ACCOMPANIMENT_JOB_BACKEND=redis to use one per core')
+    if args.workers > 1 and ACCOMPANIMENT_JOB_BACKEND == 'memory':
+        # the shared socket hands a job's status requests to any worker, not the one running it
+        parser.error('accompaniment jobs are kept per worker process, set MELODY_ACCOMPANIMENT_JOB_BACKEND=redis '
+                     'to share them or run --workers 1')
+    if args.workers > 1 and SESSION_BACKEND == 'memory':
+        print('Warning: sessions are kept per worker process, set MELODY_SESSION_BACKEND=redis to share them')
+    processes, queue_size = ACCOMPANIMENT_POOL.split(args.workers)
+    if processes * args.workers > ACCOMPANIMENT_WORKERS:
+        print(f'Warning: each worker runs {processes} accompaniment process(es), up to '
+              f'{processes * args.workers} copies of the accompaniment model in total; '
+              f'MELODY_ACCOMPANIMENT_WORKERS={ACCOMPANIMENT_WORKERS}')
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    metrics_dir = METRICS_DIR or tempfile.mkdtemp(prefix='melody-metrics-')
+    os.makedirs(metrics_dir, exist_ok=True)
+    for filename in os.listdir(metrics_dir):
+        # counters of an earlier run
+        if filename.endswith('.json'):
+            os.remove(os.path.join(metrics_dir, filename))
+
+    load_models()
+    gc.collect()
+    gc.freeze()
+
+    workers = {}
+    running = True
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(sock, args.host, args.port, metrics_dir)
+            finally:
+                os._exit(0)
+        workers[pid] = time.time()
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(args.workers):
+        spawn()
+    print(f'Serving on http://{args.host}:{args.port} with {args.workers} workers')
+    if args.report_memory:
+        time.sleep(2)
+        report_memory(list(workers))
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = workers.pop(pid, None)
+        if running and started is not None:
+            print(f'Worker {pid} exited with status {status}, restarting it')
+            if time.time() - started < 1:
+                # do not spin if workers die right away
+                time.sleep(1)
+            spawn()
+    sock.close()
+    if METRICS_DIR is None:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
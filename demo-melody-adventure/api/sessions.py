@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Sessions not touched for this many seconds are dropped
+SESSION_TTL = int(os.environ.get('MELODY_SESSION_TTL', '3600'))
+# The in-process store evicts the least recently used session beyond this many
+SESSION_MAX = int(os.environ.get('MELODY_SESSION_MAX', '1000'))
+# 'memory' keeps sessions in this process, 'redis' shares them between workers
+SESSION_BACKEND = os.environ.get('MELODY_SESSION_BACKEND', 'memory')
+REDIS_URL = os.environ.get('MELODY_REDIS_URL', 'redis://localhost:6379/0')
+
+def new_session(seed_notes, is_makam_notes=None, variation_history=None):
+    """
+    Args:
+        seed_notes (list): The seed melody as (pitch, duration) pairs.
+        is_makam_notes (list): Per note flag, defaults to all False.
+        variation_history (list): Defaults to ['seed'].
+
+    Returns:
+        tuple: (session id, session dict)
+    """
+    seed_notes = [(n[0], float(n[1])) for n in seed_notes]
+    session = {
+        'version': 0,
+        'seed_notes': seed_notes,
+        'current_notes': list(seed_notes),
+        'recent_notes': list(seed_notes),
+        'is_makam_notes': list(is_makam_notes) if is_makam_notes is not None else [False] * len(seed_notes),
+        'variation_history': list(variation_history) if variation_history is not None else ['seed'],
+        'midi_uri': None,
+        # uploaded phrases the session's generations learn from, see MELODY_LEARN_UPLOADS
+        'learned_notes': [],
+        'learned_offset': 0,
+    }
+    return uuid.uuid4().hex, session
+
+class MemorySessionStore:
+    """
+    Sessions kept in this process, evicted after SESSION_TTL seconds of inactivity
+    or when more than SESSION_MAX sessions exist (least recently used first).
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=SESSION_MAX):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # id -> (expires_at, session), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """
+        Returns:
+            dict: A copy of the session, None if it does not exist or expired.
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._sessions[session_id]
+                return None
+            self._sessions[session_id] = (time.monotonic() + self.ttl, entry[1])
+            self._sessions.move_to_end(session_id)
+            return json.loads(entry[1])
+
+    def put(self, session_id, session, expected_version=None):
+        """
+        Stores a session, refreshing its TTL.
+
+        Args:
+            session_id (str): Session id.
+            session (dict): JSON-serializable session.
+            expected_version (int): If given, only store when the stored session still has this
+                version, so two concurrent updates of one session cannot overwrite each other.
+
+        Returns:
+            bool: False if expected_version did not match.
+        """
+        data = json.dumps(session)
+        with self._lock:
+            if expected_version is not None:
+                entry = self._sessions.get(session_id)
+                if entry is None or json.loads(entry[1])['version'] != expected_version:
+                    return False
+            self._sessions[session_id] = (time.monotonic() + self.ttl, data)
+            self._sessions.move_to_end(session_id)
+            self._evict()
+        return True
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        with self._lock:
+            self._evict()
+            return len(self._sessions)
+
+    def _evict(self):
+        now = time.monotonic()
+        expired = [session_id for session_id, (expires_at, _) in self._sessions.items() if expires_at < now]
+        for session_id in expired:
+            del self._sessions[session_id]
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+class RedisSessionStore:
+    """
+    Sessions stored as JSON strings in Redis (or anything speaking its protocol),
+    expired by Redis itself, so every worker process sees the same sessions.
+    """
+
+    def __init__(self, client, ttl=SESSION_TTL, prefix='melody:session:'):
+        """
+        Args:
+            client: A redis.Redis compatible client.
+            ttl (int): Seconds of inactivity before a session expires.
+            prefix (str): Key prefix.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, session_id):
+        key = self.prefix + session_id
+        data = self.client.get(key)
+        if data is None:
+            return None
+        self.client.expire(key, self.ttl)
+        return json.loads(data)
+
+    def put(self, session_id, session, expected_version=None):
+        key = self.prefix + session_id
+        data = json.dumps(session)
+        if expected_version is None:
+            self.client.setex(key, self.ttl, data)
+            return True
+
+        from redis.exceptions import WatchError
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                current = pipe.get(key)
+                if current is None or json.loads(current)['version'] != expected_version:
+                    return False
+                pipe.multi()
+                pipe.setex(key, self.ttl, data)
+                pipe.execute()
+            except WatchError:
+                return False
+        return True
+
+    def delete(self, session_id):
+        return bool(self.client.delete(self.prefix + session_id))
+
+def create_session_store():
+    """
+    Builds the store selected by MELODY_SESSION_BACKEND.
+    """
+    if SESSION_BACKEND == 'memory':
+        return MemorySessionStore()
+    if SESSION_BACKEND == 'redis':
+        import redis
+        return RedisSessionStore(redis.Redis.from_url(REDIS_URL))
+    raise ValueError(f'Unknown session backend {SESSION_BACKEND}')
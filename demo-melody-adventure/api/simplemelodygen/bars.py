@@ -1,3 +1,74 @@
+from fractions import Fraction
+
+# How generate() ends a phrase whose last sampled note overruns the bar budget:
+#   clip     - shorten the note to the remaining duration (what enforce_bars does)
+#   resample - draw again for a note that fits, clipping if none is found
+#   rest     - drop the note and fill the remaining duration with a rest
+END_POLICIES = ('clip', 'resample', 'rest')
+
+# Durations closer than this (in quarter notes) are considered equal, float
+# quarterLengths such as 1/3 never add up to the budget exactly
+DURATION_TOLERANCE = 1e-6
+
+def meter_to_quarter_notes(meter):
+    """
+    Converts a time signature to the number of quarter notes in one bar.
+
+    Args:
+        meter (str or number): A time signature such as "4/4", "6/8" or "7/8", or already a number of quarter notes.
+
+    Returns:
+        Fraction or number: Quarter notes per bar, e.g. 7/2 for "7/8".
+    """
+    if isinstance(meter, str):
+        numerator, denominator = meter.split('/')
+        quarter_notes = Fraction(4 * int(numerator), int(denominator))
+    elif isinstance(meter, (int, float, Fraction)) and not isinstance(meter, bool):
+        quarter_notes = meter
+    else:
+        raise ValueError(f'Invalid meter {meter!r}')
+    if quarter_notes <= 0:
+        raise ValueError(f'Invalid meter {meter!r}')
+    return quarter_notes
+
+def bar_budget(num_bars, quarter_note_per_bar=4):
+    """
+    Args:
+        num_bars (int): The number of bars.
+        quarter_note_per_bar (number or str): Quarter notes per bar, or a time signature such as "7/8".
+
+    Returns:
+        number: The total duration of num_bars bars in quarter notes.
+    """
+    return num_bars * meter_to_quarter_notes(quarter_note_per_bar)
+
+def split_bars(notes, quarter_note_per_bar=4):
+    """
+    Groups notes by the bar they start in, yielding each bar as soon as a note reaches
+    its end, so a lazily generated sequence can be consumed bar by bar.
+
+    Args:
+        notes (iterable): Tuples of a pitch/rest string and duration in quarter notes.
+        quarter_note_per_bar (number or str): Quarter notes per bar, or a time signature such as "7/8".
+
+    Returns:
+        iterator of tuples: (bar index, list of the notes starting in that bar); bars covered
+        entirely by a note started earlier are skipped.
+    """
+    bar_length = meter_to_quarter_notes(quarter_note_per_bar)
+    bar = 0
+    position = 0
+    pending = []
+    for note in notes:
+        pending.append(note)
+        position += note[1]
+        if position >= (bar + 1) * bar_length - DURATION_TOLERANCE:
+            yield bar, pending
+            pending = []
+            bar = int((position + DURATION_TOLERANCE) // bar_length)
+    if pending:
+        yield bar, pending
+
 def enforce_bars(sequence, num_bars, quarter_note_per_bar=4):
     """
     Adjusts the sequence to fit within a specific number of bars by clipping and extending notes.
@@ -5,12 +76,12 @@ def enforce_bars(sequence, num_bars, quarter_note_per_bar=4):
     Args:
         sequence (list): List of tuples, where each tuple contains a pitch/rest string and duration in quarter notes.
         num_bars (int): The number of bars the sequence should fit into.
-        quarter_note_per_bar (int): Number of quarter notes in a single bar (default is 4 for 4/4 time).
+        quarter_note_per_bar (number or str): Number of quarter notes in a single bar (default is 4 for 4/4 time), or a time signature such as "7/8".
 
     Returns:
         list: Adjusted sequence fitting the specified number of bars.
     """
-    target_duration = num_bars * quarter_note_per_bar
+    target_duration = bar_budget(num_bars, quarter_note_per_bar)
     adjusted_sequence = []
     current_duration = 0
 
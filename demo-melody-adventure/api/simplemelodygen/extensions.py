@@ -1,8 +1,38 @@
 # Add extensions specific to melody generation
 
+import copy
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+
 from .markovchain import MarkovChainMelodyGenerator
+from .online import OnlineCounts, OnlineSampler
+
+from .bars import END_POLICIES, DURATION_TOLERANCE, bar_budget
+
+# Draws generate(end_policy='resample') makes for a last note that fits before clipping
+RESAMPLE_ATTEMPTS = 8
+
+# Serializes learning into shared models, sampling does not take it
+_LEARN_LOCK = threading.Lock()
+# Views with_phrases keeps per model for LearnedPhrases, least recently used ones are dropped
+VIEW_CACHE_SIZE = 64
+
+class LearnedPhrases(list):
+    """
+    Phrases of (pitch, duration) states learned in one place, e.g. one session, oldest
+    first, for with_phrases. key names the place and first is the number of the first
+    phrase: phrases are only appended and dropped from the front, so the phrase with a
+    given number never changes. A view of the same place then only counts the phrases
+    appended since it was built.
+    """
+
+    def __init__(self, phrases, key, first=0):
+        super().__init__(phrases)
+        self.key = key
+        self.first = first
 
-from .bars import enforce_bars
 class MultiInstanceTrainableMarkovChainMelodyGenerator(MarkovChainMelodyGenerator):
     """
     Represents a Markov Chain model for melody generation that is trainable with multiple sequence/example instances
@@ -10,17 +40,15 @@ class MultiInstanceTrainableMarkovChainMelodyGenerator(MarkovChainMelodyGenerato
     Also allows for rests
     """
 
-    def _calculate_transition_matrix(self, examples):
-        """
-        Calculate the transition matrix from the provided notes.
-
-        Parameters:
-            notes (list): A list of music21.note.Note objects.
-        """
-        for notes in examples:
-            for i in range(len(notes) - 1):
-                self._increment_transition_count(notes[i], notes[i + 1])
-        self._normalize_transition_matrix()
+    # Longest context learn_ids counts, see VariableOrderMarkovChainMelodyGenerator
+    max_order = 1
+    # Counts of phrases learned after training, see learn_ids and with_phrases
+    learned_counts = None
+    overlay_counts = None
+    # Phrases in learned_counts as state indexes, oldest first, and the number of states there were before
+    learned_phrases = None
+    trained_states = None
+    _views = None
 
     def _note_to_state(self, note):    
         if note.isRest:
@@ -29,64 +57,368 @@ class MultiInstanceTrainableMarkovChainMelodyGenerator(MarkovChainMelodyGenerato
             state = (note.pitch.nameWithOctave, note.duration.quarterLength)
         return state
     
-    def _increment_initial_probability_count(self, note):
+    def train(self, examples):
         """
-        Increment the probability count for a given note.
+        Train the model based on a list of notes.
 
         Parameters:
-            note (music21.note.Note): A note object.
+            examples (list): A list of <list of music21.note.Note objects>, each representing an example phrase/song
         """
-        state = self._note_to_state(note)
-        self.initial_probabilities[self._state_indexes[state]] += 1
+        self.train_from_indexes(
+            [self.states_to_indexes(map(self._note_to_state, notes)) for notes in examples]
+        )
 
-    def _increment_transition_count(self, current_note, next_note):
+    def learn(self, sequence, new_states=True):
         """
-        Increment the transition count from current_note to next_note.
+        Same as learn_ids for a phrase of (pitch, duration) tuples.
+        """
+        self.learn_ids(self.vocabulary.encode(sequence), new_states)
+
+    def learn_ids(self, ids, new_states=True, max_notes=None, max_new_states=None):
+        """
+        Add an example phrase to the trained model in O(len(ids)): its counts are kept
+        next to the trained ones and the rows they change are renormalized lazily, the
+        next time they are sampled. Safe to call while other threads generate.
 
         Parameters:
-            current_note (music21.note.Note): The current note object.
-            next_note (music21.note.Note): The next note object.
-        """
-        state = self._note_to_state(current_note)        
-        next_state = self._note_to_state(next_note)            
-        self.transition_matrix[
-            self._state_indexes[state], self._state_indexes[next_state]
-        ] += 1
-        
-    def train(self, examples):
+            ids (array-like of int): The phrase as ids of self.vocabulary.
+            new_states (bool): Add states the model does not know yet, otherwise they are skipped.
+            max_notes (int): Most learned notes to keep, the oldest phrases are forgotten beyond it
+                (the newest phrase is always kept).
+            max_new_states (int): Most states learning may add to the trained ones, notes of
+                further new states are skipped.
         """
-        Train the model based on a list of notes.
+        with _LEARN_LOCK:
+            if self.learned_counts is None:
+                self._check_trained()
+                self.learned_counts = OnlineCounts()
+                self.learned_phrases = deque()
+                self.trained_states = len(self.states)
+            if max_new_states is not None:
+                max_new_states = max(0, self.trained_states + max_new_states - len(self.states))
+            indexes = self._learned_indexes(ids, new_states, max_new_states)
+            self.learned_counts.add(indexes, self.max_order)
+            self.learned_phrases.append(indexes)
+            while max_notes is not None and self.learned_counts.notes > max_notes and len(self.learned_phrases) > 1:
+                self.learned_counts.remove(self.learned_phrases.popleft(), self.max_order)
+            self._use_learned_counts()
+
+    def with_phrases(self, phrases, new_states=True):
+        """
+        A view of the model that also learned phrases, e.g. the ones uploaded in one
+        session. The view shares the trained arrays and a snapshot of the model's own
+        learned counts, the model itself is not modified and what it learns later does
+        not change the view.
+
+        A LearnedPhrases gets the view built for its key last time, when the model did not
+        change since and only phrases were appended; only those are counted then.
 
         Parameters:
-            examples (list): A list of <list of music21.note.Note objects>, each representing an example phrase/song
+            phrases (list or LearnedPhrases): Phrases as arrays of ids of self.vocabulary, or
+                a LearnedPhrases of (pitch, duration) phrases.
+            new_states (bool): Add states the model does not know yet to the view, otherwise they are skipped.
+
+        Returns:
+            MultiInstanceTrainableMarkovChainMelodyGenerator: The view, the model itself if phrases is empty.
+        """
+        if not len(phrases):
+            return self
+        self._check_trained()
+        if not isinstance(phrases, LearnedPhrases):
+            with _LEARN_LOCK:
+                return self._new_view([(ids, new_states) for ids in phrases])
+
+        end = phrases.first + len(phrases)
+        with _LEARN_LOCK:
+            if self._views is None:
+                self._views = OrderedDict()
+            learned = None if self.learned_counts is None else self.learned_counts.versions.get(())
+            model = (self.sampler, self.states, learned)
+            cached = self._views.pop(phrases.key, None)
+            if cached is not None and cached[:2] == (model, phrases.first) and cached[2] <= end:
+                view = cached[3]
+                for notes in phrases[cached[2] - phrases.first:]:
+                    view.overlay_counts.add(
+                        view._learned_indexes(self.vocabulary.encode(notes), new_states), view.max_order)
+            else:
+                view = self._new_view([(self.vocabulary.encode(notes), new_states) for notes in phrases])
+            self._views[phrases.key] = (model, phrases.first, end, view)
+            while len(self._views) > VIEW_CACHE_SIZE:
+                self._views.popitem(last=False)
+        return view
+
+    def _new_view(self, phrases):
+        # under _LEARN_LOCK: the snapshot of the learned counts must match the states copied with
+        # the model, the states the model learns later take the same indexes as the view's new ones
+        view = copy.copy(self)
+        if self.learned_counts is not None:
+            view.learned_counts = self.learned_counts.copy()
+        view.overlay_counts = OnlineCounts()
+        for ids, new_states in phrases:
+            view.overlay_counts.add(view._learned_indexes(ids, new_states), view.max_order)
+        view._use_learned_counts()
+        return view
+
+    def compile(self):
+        super().compile()
+        self._use_learned_counts()
+
+    def _check_trained(self):
+        if self.transition_counts is None or self.sampler is None:
+            raise ValueError("Only trained models can learn phrases")
+
+    def _learned_indexes(self, ids, new_states, max_new_states=None):
+        """
+        Returns:
+            list of int: The state index of every id, -1 for unknown states unless new_states
+                adds them (at most max_new_states of them).
         """
-        notes = [x for xs in examples for x in xs] #flatten list of list to single list of notes
-        self._calculate_initial_probabilities(notes)
-        self._calculate_transition_matrix(examples)
+        ids = np.asarray(ids, dtype=np.int32)
+        indexes = self.ids_to_indexes(ids)
+        if new_states and max_new_states != 0 and (indexes < 0).any():
+            self._add_state_ids(list(dict.fromkeys(ids[indexes < 0].tolist()))[:max_new_states])
+            indexes = self.ids_to_indexes(ids)
+        return indexes.tolist()
 
-    def generate(self, length, previous_sequence=[], max_bars=10, quarter_note_per_bar=4):
+    def _add_state_ids(self, ids):
         """
-        Generate a melody of a given length.
+        Append states to the model. The attributes are replaced rather than modified, in the
+        order that lets concurrent readers (and views sharing them) keep using the old ones.
+        """
+        self.states = self.states + self.vocabulary.decode(ids)
+        self.state_ids = np.concatenate([self.state_ids, np.asarray(ids, dtype=np.int32)])
+        index_of_id = np.full(len(self.vocabulary), -1, dtype=np.int32)
+        index_of_id[self.state_ids] = np.arange(len(self.states), dtype=np.int32)
+        self._index_of_id = index_of_id
+
+    def _use_learned_counts(self):
+        """
+        Sample through an OnlineSampler once phrases were learned.
+        """
+        layers = [counts for counts in (self.learned_counts, self.overlay_counts) if counts is not None]
+        if not layers or self.sampler is None:
+            return
+        base = self.sampler.base if isinstance(self.sampler, OnlineSampler) else self.sampler
+        if isinstance(self.sampler, OnlineSampler) and self.sampler.layers == layers:
+            return
+        self.sampler = OnlineSampler(base, self.initial_counts, self.transition_counts, layers)
+
+    def generate(self, length, previous_sequence=[], max_bars=10, quarter_note_per_bar=4, end_policy='clip'):
+        """
+        Generate a melody that fills max_bars bars, sampling only as many notes as the bars can hold.
 
         Parameters:
-            length (int): The length of the sequence to generate.
+            length (int): The maximum number of states to generate, a safety cap; generation normally stops when the bars are full.
             previous_sequence (list of tuples): previous melody to continue from, if not specified will start from random stae
+            max_bars (int): The number of bars to fill.
+            quarter_note_per_bar (number or str): Quarter notes per bar, or a time signature such as "7/8".
+            end_policy (str): How to end on a note that overruns the last bar, one of bars.END_POLICIES.
 
         Returns:
             full_melody (list of tuples): A list of generated states append to end of previous_sequence 
             melody (list of tuples): A list of generated states, only containing generated new pice of melody
         """
-        print('>>>>>>>> length', length)
-        print('>>>>>>>> previous_sequence', previous_sequence)
-
         previous_sequence = [tuple(x) for x in previous_sequence]
-        if len(previous_sequence) == 0:
-            full_melody = [self._generate_starting_state()]
+        new = list(self.iter_generate(length, previous_sequence, max_bars, quarter_note_per_bar, end_policy))
+        return previous_sequence + new, new
+
+    def iter_generate(self, length, previous_sequence=[], max_bars=10, quarter_note_per_bar=4, end_policy='clip'):
+        """
+        Same as generate, but returns an iterator over the new notes that samples each one
+        only when it is consumed. The context is checked right away, so an unknown last
+        note of previous_sequence raises here rather than on the first next().
+
+        Returns:
+            iterator of tuples: The generated states.
+        """
+        ids = self.iter_generate_ids(length, self._find_ids(previous_sequence), max_bars,
+                                     quarter_note_per_bar, end_policy)
+        states = self.vocabulary.states
+        return (states[state_id] for state_id in ids)
+
+    def generate_ids(self, length, previous_ids=(), max_bars=10, quarter_note_per_bar=4, end_policy='clip'):
+        """
+        Same as generate, on vocabulary ids instead of (pitch, duration) tuples.
+
+        Parameters:
+            previous_ids (array-like of int): previous melody as ids of self.vocabulary, -1 for unknown states.
+
+        Returns:
+            numpy.ndarray: The int32 vocabulary ids of the generated states.
+        """
+        return np.fromiter(self.iter_generate_ids(length, previous_ids, max_bars, quarter_note_per_bar, end_policy),
+                           dtype=np.int32)
+
+    def iter_generate_ids(self, length, previous_ids=(), max_bars=10, quarter_note_per_bar=4, end_policy='clip'):
+        """
+        Same as iter_generate, on vocabulary ids.
+
+        Returns:
+            iterator of int: The vocabulary ids of the generated states.
+        """
+        if end_policy not in END_POLICIES:
+            raise ValueError(f"Unknown end policy {end_policy}, expected one of {END_POLICIES}")
+
+        indexes = self._context_indexes(previous_ids) if len(previous_ids) else []
+        return self._sample_ids(length, indexes, bar_budget(max_bars, quarter_note_per_bar), end_policy)
+
+    def _sample_ids(self, length, indexes, remaining, end_policy):
+        durations = self._state_durations()
+        count = 0
+        while count < length and remaining > DURATION_TOLERANCE:
+            index = self._generate_next_index_after(indexes) if indexes else self._generate_starting_index()
+            if durations[index] > remaining + DURATION_TOLERANCE and end_policy == 'resample':
+                index = self._resample_fitting_index(indexes, remaining, durations, default=index)
+            pitch, duration = self.states[index]
+            if durations[index] > remaining + DURATION_TOLERANCE:
+                # Last note overruns the budget, end the phrase here
+                yield self.vocabulary.intern(('Rest' if end_policy == 'rest' else pitch, remaining))
+                return
+            indexes.append(index)
+            count += 1
+            remaining -= duration
+            yield int(self.state_ids[index])
+
+        # Hit the length cap before the bars were full
+        if remaining > DURATION_TOLERANCE:
+            yield self.vocabulary.intern(('Rest', remaining))
+
+    def generate_candidates(self, n, length, previous_sequence=[], max_bars=10, quarter_note_per_bar=4, end_policy='clip'):
+        """
+        Generate n independent continuations that each fill max_bars bars, like n calls of
+        generate, with all chains sampled together by generate_batch.
+
+        Parameters:
+            n (int): The number of continuations.
+            length (int): The maximum number of states per continuation.
+            previous_sequence (list of tuples): previous melody every continuation starts from.
+            max_bars (int): The number of bars to fill.
+            quarter_note_per_bar (number or str): Quarter notes per bar, or a time signature such as "7/8".
+            end_policy (str): How to end on a note that overruns the last bar, one of bars.END_POLICIES.
+
+        Returns:
+            list: n lists of generated states.
+        """
+        if end_policy not in END_POLICIES:
+            raise ValueError(f"Unknown end policy {end_policy}, expected one of {END_POLICIES}")
+        previous_ids = self._find_ids(previous_sequence)
+        budget = float(bar_budget(max_bars, quarter_note_per_bar))
+        durations = self._state_durations()
+
+        # enough positions for the shortest notes to fill the bars, plus the overrunning one
+        shortest = durations[durations > 0].min() if (durations > 0).any() else budget
+        positions = int(min(length, np.ceil(budget / shortest) + 1))
+        batch = self._generate_batch_after(n, positions, previous_ids)
+        ends = np.cumsum(durations[batch], axis=1)
+        # notes ending within the budget, durations are non-negative so they are a prefix of each row
+        fitting = (ends <= budget + DURATION_TOLERANCE).sum(axis=1)
+
+        context = self._context_indexes(previous_ids) if len(previous_ids) else []
+        candidates = []
+        for row, count, row_ends in zip(batch, fitting, ends):
+            melody = self.states_from_indexes(row[:count])
+            remaining = budget - (float(row_ends[count - 1]) if count else 0.0)
+            if remaining > DURATION_TOLERANCE:
+                # finish the phrase one note at a time, the end policy applies from here on
+                indexes = context + row[:count].tolist()
+                melody += self.vocabulary.decode(list(self._sample_ids(length - count, indexes, remaining, end_policy)))
+            candidates.append(melody)
+        return candidates
+
+    def _state_durations(self):
+        """
+        Returns:
+            numpy.ndarray: The duration in quarter notes of every state, as float64.
+        """
+        if getattr(self, '_durations', None) is None or len(self._durations) != len(self.states):
+            self._durations = self.vocabulary.durations(self.state_ids)
+        return self._durations
+
+    def _resample_fitting_index(self, indexes, remaining, durations, default):
+        """
+        Draw the next state again, up to RESAMPLE_ATTEMPTS times, until one fits in the remaining duration.
+
+        Returns:
+            int: The first fitting state index, or default if none was drawn.
+        """
+        for _ in range(RESAMPLE_ATTEMPTS):
+            index = self._generate_next_index_after(indexes) if indexes else self._generate_starting_index()
+            if durations[index] <= remaining + DURATION_TOLERANCE:
+                return index
+        return default
+
+    def _context_indexes(self, previous_ids):
+        """
+        Encode the part of previous_ids the model conditions on, for a first
+        order chain that is only the last state.
+
+        Parameters:
+            previous_ids (array-like of int): previous melody as vocabulary ids, must not be empty.
+
+        Returns:
+            list of int: State indexes, the last state must be known to the model.
+        """
+        return [self._known_index(previous_ids[-1])]
+
+    def _find_ids(self, previous_sequence):
+        """
+        Returns:
+            numpy.ndarray: The vocabulary ids of previous_sequence, -1 for unknown states; raises KeyError if the last one is unknown.
+        """
+        ids = self.vocabulary.find(previous_sequence)
+        if len(ids) and ids[-1] < 0:
+            raise KeyError(tuple(previous_sequence[-1]))
+        return ids
+
+    def _known_index(self, state_id):
+        """
+        Returns:
+            int: The index of a vocabulary id into self.states, raises KeyError if it is not a state of the model.
+        """
+        index = int(self.ids_to_indexes([state_id])[0])
+        if index < 0:
+            raise KeyError(self.vocabulary.states[state_id] if state_id >= 0 else 'unknown state')
+        return index
+
+    def _generate_next_index_after(self, indexes):
+        """
+        Generate the index of the next state given the indexes generated so far.
+
+        Parameters:
+            indexes (list of int): The melody so far as state indexes.
+
+        Returns:
+            int: The index of the next state.
+        """
+        return self._generate_next_index(indexes[-1])
+
+    def generate_batch(self, n, length, previous_sequence=[]):
+        """
+        Generate many independent melodies at once, advancing all chains in
+        lockstep with one vectorized sampling step per position.
+
+        Parameters:
+            n (int): The number of melodies to generate.
+            length (int): The number of states to generate per melody.
+            previous_sequence (list of tuples): previous melody every chain continues from, if not specified each chain will start from a random state
+
+        Returns:
+            numpy.ndarray: An (n, length) int32 array of state indexes, use states_from_indexes to turn rows back into (pitch, duration) tuples.
+        """
+        return self._generate_batch_after(n, length, self._find_ids(previous_sequence))
+
+    def _generate_batch_after(self, n, length, previous_ids):
+        if self.sampler is None:
+            self.compile()
+        melodies = np.empty((n, length), dtype=np.int32)
+        if length == 0:
+            return melodies
+
+        if len(previous_ids) == 0:
+            melodies[:, 0] = self.sampler.sample_initial_batch(n)
         else:
-            full_melody = [s for s in previous_sequence]
-        for _ in range(1, length):
-            full_melody.append(self._generate_next_state(full_melody[-1]))
-        
-        previous, new = full_melody[:len(previous_sequence)], full_melody[len(previous_sequence):]
-        new = enforce_bars(new, max_bars, quarter_note_per_bar)
-        return previous + new, new
\ No newline at end of file
+            previous_index = self._known_index(previous_ids[-1])
+            melodies[:, 0] = self.sampler.sample_next_batch(np.full(n, previous_index, dtype=np.int32))
+        for position in range(1, length):
+            melodies[:, position] = self.sampler.sample_next_batch(melodies[:, position - 1])
+        return melodies
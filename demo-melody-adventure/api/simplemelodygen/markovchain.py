@@ -4,24 +4,46 @@ From: https://github.com/musikalkemist/generativemusicaicourse/blob/main/12.%20M
 import numpy as np
 from music21 import metadata, note, stream
 
+from .sampling import CompiledSampler
+from .sparse import CSRMatrix, SparseVector
+from .vocabulary import VOCABULARY
+
 
 class MarkovChainMelodyGenerator:
     """
     Represents a Markov Chain model for melody generation.
     """
 
-    def __init__(self, states):
+    def __init__(self, states, sparse=False, vocabulary=VOCABULARY):
         """
         Initialize the MarkovChain with a list of states.
 
         Parameters:
             states (list of tuples): A list of possible (pitch, duration)
                 pairs.
+            sparse (bool): Store the initial probabilities and the transition
+                matrix in compressed sparse form, so memory grows with the
+                number of observed transitions instead of len(states) ** 2.
+            vocabulary (StateVocabulary): Shared vocabulary the states are
+                interned in. The model indexes its matrices by position in
+                states and translates to vocabulary ids with two int32 arrays.
         """
         self.states = states
-        self.initial_probabilities = np.zeros(len(states))
-        self.transition_matrix = np.zeros((len(states), len(states)))
-        self._state_indexes = {state: i for (i, state) in enumerate(states)}
+        self.sparse = sparse
+        self.vocabulary = vocabulary
+        # position in states -> vocabulary id, and vocabulary id -> position (-1 if not a state)
+        self.state_ids = vocabulary.encode(states)
+        self._index_of_id = np.full(len(vocabulary), -1, dtype=np.int32)
+        self._index_of_id[self.state_ids] = np.arange(len(states), dtype=np.int32)
+        if sparse:
+            self.initial_probabilities = SparseVector(len(states))
+            self.transition_matrix = CSRMatrix((len(states), len(states)))
+        else:
+            self.initial_probabilities = np.zeros(len(states))
+            self.transition_matrix = np.zeros((len(states), len(states)))
+        self.initial_counts = None
+        self.transition_counts = None
+        self.sampler = None
 
     def train(self, notes):
         """
@@ -30,8 +52,73 @@ class MarkovChainMelodyGenerator:
         Parameters:
             notes (list): A list of music21.note.Note objects.
         """
-        self._calculate_initial_probabilities(notes)
-        self._calculate_transition_matrix(notes)
+        self.train_from_indexes([self.states_to_indexes(map(self._note_to_state, notes))])
+
+    def train_from_indexes(self, sequences):
+        """
+        Train the model from sequences that are already encoded as state
+        indexes, counting every initial state and transition in one
+        vectorized pass without any music21 objects.
+
+        Parameters:
+            sequences (list): A list of int32 arrays of indexes into self.states,
+                each representing an example phrase/song.
+        """
+        sequences = [np.asarray(s, dtype=np.int32) for s in sequences]
+        self._calculate_initial_probabilities(sequences)
+        self._calculate_transition_matrix(sequences)
+        self.compile()
+
+    def states_to_indexes(self, states):
+        """
+        Parameters:
+            states (iterable of tuples): (pitch, duration) states known to the model.
+
+        Returns:
+            numpy.ndarray: The int32 index of every state.
+        """
+        states = list(states)
+        indexes = self.ids_to_indexes(self.vocabulary.find(states))
+        unknown = np.flatnonzero(indexes < 0)
+        if len(unknown):
+            raise KeyError(tuple(states[unknown[0]]))
+        return indexes
+
+    def ids_to_indexes(self, ids):
+        """
+        Parameters:
+            ids (array-like of int): Vocabulary ids, -1 for unknown states.
+
+        Returns:
+            numpy.ndarray: The int32 index of every id into self.states, -1 for ids that are not states of the model.
+        """
+        ids = np.asarray(ids, dtype=np.int32)
+        known = (ids >= 0) & (ids < len(self._index_of_id))
+        return np.where(known, self._index_of_id[np.where(known, ids, 0)], -1).astype(np.int32)
+
+    def indexes_to_ids(self, indexes):
+        """
+        Returns:
+            numpy.ndarray: The vocabulary id of every state index.
+        """
+        return self.state_ids[indexes]
+
+    def state_index(self, state):
+        """
+        Returns:
+            int: The index of state into self.states, raises KeyError if the model does not know it.
+        """
+        return int(self.states_to_indexes([state])[0])
+
+    def states_from_indexes(self, indexes):
+        """
+        Parameters:
+            indexes (iterable of int): State indexes, e.g. a row returned by generate_batch.
+
+        Returns:
+            list of tuples: The matching (pitch, duration) states.
+        """
+        return [self.states[i] for i in indexes]
 
     def generate(self, length):
         """
@@ -43,72 +130,64 @@ class MarkovChainMelodyGenerator:
         Returns:
             melody (list of tuples): A list of generated states.
         """
-        melody = [self._generate_starting_state()]
+        indexes = [self._generate_starting_index()]
         for _ in range(1, length):
-            melody.append(self._generate_next_state(melody[-1]))
-        return melody
+            indexes.append(self._generate_next_index(indexes[-1]))
+        return self.states_from_indexes(indexes)
 
-    def _calculate_initial_probabilities(self, notes):
-        """
-        Calculate the initial probabilities from the provided notes.
+    def _note_to_state(self, note):
+        return (note.pitch.nameWithOctave, note.duration.quarterLength)
 
-        Parameters:
-            notes (list): A list of music21.note.Note objects.
-        """
-        for note in notes:
-            self._increment_initial_probability_count(note)
-        self._normalize_initial_probabilities()
-
-    def _increment_initial_probability_count(self, note):
+    def _calculate_initial_probabilities(self, sequences):
         """
-        Increment the probability count for a given note.
+        Calculate the initial probabilities from the provided sequences. Like
+        the original implementation, every note counts, not only the first
+        note of each sequence.
 
         Parameters:
-            note (music21.note.Note): A note object.
+            sequences (list): A list of int32 arrays of state indexes.
         """
-        state = (note.pitch.nameWithOctave, note.duration.quarterLength)
-        self.initial_probabilities[self._state_indexes[state]] += 1
+        self.initial_counts = np.bincount(
+            np.concatenate(sequences + [np.zeros(0, dtype=np.int32)]),
+            minlength=len(self.states),
+        ).astype(np.float64)
+        if self.sparse:
+            self.initial_probabilities = SparseVector.from_dense(self.initial_counts)
+        else:
+            self.initial_probabilities = self.initial_counts.copy()
+        self._normalize_initial_probabilities()
 
     def _normalize_initial_probabilities(self):
         """
         Normalize the initial probabilities array such that the sum of all
         probabilities equals 1.
         """
+        if self.sparse:
+            self.initial_probabilities.normalize()
+            return
         total = np.sum(self.initial_probabilities)
         if total:
             self.initial_probabilities /= total
         self.initial_probabilities = np.nan_to_num(self.initial_probabilities)
 
-    def _calculate_transition_matrix(self, notes):
-        """
-        Calculate the transition matrix from the provided notes.
-
-        Parameters:
-            notes (list): A list of music21.note.Note objects.
-        """
-        for i in range(len(notes) - 1):
-            self._increment_transition_count(notes[i], notes[i + 1])
-        self._normalize_transition_matrix()
-
-    def _increment_transition_count(self, current_note, next_note):
+    def _calculate_transition_matrix(self, sequences):
         """
-        Increment the transition count from current_note to next_note.
+        Calculate the transition matrix from the provided sequences.
 
         Parameters:
-            current_note (music21.note.Note): The current note object.
-            next_note (music21.note.Note): The next note object.
+            sequences (list): A list of int32 arrays of state indexes.
         """
-        state = (
-            current_note.pitch.nameWithOctave,
-            current_note.duration.quarterLength,
+        current = np.concatenate([s[:-1] for s in sequences] + [np.zeros(0, dtype=np.int32)])
+        following = np.concatenate([s[1:] for s in sequences] + [np.zeros(0, dtype=np.int32)])
+        # Raw counts are kept (always sparse) next to the normalized matrix
+        self.transition_counts = CSRMatrix.from_coo(
+            current, following, np.ones(len(current)), (len(self.states), len(self.states))
         )
-        next_state = (
-            next_note.pitch.nameWithOctave,
-            next_note.duration.quarterLength,
-        )
-        self.transition_matrix[
-            self._state_indexes[state], self._state_indexes[next_state]
-        ] += 1
+        if self.sparse:
+            self.transition_matrix = self.transition_counts.copy()
+        else:
+            self.transition_matrix = self.transition_counts.toarray()
+        self._normalize_transition_matrix()
 
     def _normalize_transition_matrix(self):
         """
@@ -117,6 +196,11 @@ class MarkovChainMelodyGenerator:
         of the matrix to represent probability distributions of
         transitioning from one state to the next.
         """
+        if self.sparse:
+            # Rows without transitions are not stored at all, so there is no
+            # zero division to guard against.
+            self.transition_matrix.normalize_rows()
+            return
 
         # Calculate the sum of each row in the transition matrix.
         # These sums represent the total count of transitions from each state
@@ -139,6 +223,17 @@ class MarkovChainMelodyGenerator:
                 0,  # False case: Keep as zero if sum is zero.
             )
 
+    def compile(self):
+        """
+        Freeze the trained probabilities into precomputed sampling tables
+        (see CompiledSampler), so generating a note no longer costs O(number
+        of states). Called at the end of train(); must be called again if
+        the probabilities are modified afterwards.
+        """
+        self.sampler = CompiledSampler.from_probabilities(
+            self.initial_probabilities, self.transition_matrix
+        )
+
     def _generate_starting_state(self):
         """
         Generate a starting state based on the initial probabilities.
@@ -146,10 +241,24 @@ class MarkovChainMelodyGenerator:
         Returns:
             A state from the list of states.
         """
-        initial_index = np.random.choice(
-            list(self._state_indexes.values()), p=self.initial_probabilities
+        return self.states[self._generate_starting_index()]
+
+    def _generate_starting_index(self):
+        """
+        Generate the index of a starting state based on the initial probabilities.
+
+        Returns:
+            int: An index into the list of states.
+        """
+        if self.sampler is not None:
+            return self.sampler.sample_initial()
+        if self.sparse:
+            return np.random.choice(
+                self.initial_probabilities.indices, p=self.initial_probabilities.data
+            )
+        return np.random.choice(
+            np.arange(len(self.states)), p=self.initial_probabilities
         )
-        return self.states[initial_index]
 
     def _generate_next_state(self, current_state):
         """
@@ -162,13 +271,30 @@ class MarkovChainMelodyGenerator:
         Returns:
             The next state in the Markov Chain.
         """
-        if self._does_state_have_subsequent(current_state):
-            index = np.random.choice(
-                list(self._state_indexes.values()),
-                p=self.transition_matrix[self._state_indexes[current_state]],
+        return self.states[self._generate_next_index(self.state_index(current_state))]
+
+    def _generate_next_index(self, current_index):
+        """
+        Generate the index of the next state based on the transition matrix
+        and the index of the current state.
+
+        Parameters:
+            current_index (int): The index of the current state.
+
+        Returns:
+            int: The index of the next state.
+        """
+        if self.sampler is not None:
+            return self.sampler.sample_next(current_index)
+        if self._does_index_have_subsequent(current_index):
+            if self.sparse:
+                indices, probabilities = self.transition_matrix.row(current_index)
+                return np.random.choice(indices, p=probabilities)
+            return np.random.choice(
+                np.arange(len(self.states)),
+                p=self.transition_matrix[current_index],
             )
-            return self.states[index]
-        return self._generate_starting_state()
+        return self._generate_starting_index()
 
     def _does_state_have_subsequent(self, state):
         """
@@ -180,8 +306,15 @@ class MarkovChainMelodyGenerator:
         Returns:
             True if the state has a subsequent state, False otherwise.
         """
-        return self.transition_matrix[self._state_indexes[state]].sum() > 0
-
+        return self._does_index_have_subsequent(self.state_index(state))
+
+    def _does_index_have_subsequent(self, index):
+        if self.sampler is not None:
+            return self.sampler.has_successor_at(index)
+        if self.sparse:
+            indices, _ = self.transition_matrix.row(index)
+            return len(indices) > 0
+        return self.transition_matrix[index].sum() > 0
 
 def create_training_data():
     """
@@ -0,0 +1,237 @@
+"""
+Learning phrases after training without rebuilding the model.
+
+A trained model keeps its raw counts (transition_counts, initial_counts and the
+context tables' counts) next to the compiled sampling tables. Phrases learned
+later are counted in OnlineCounts, which only costs a few dict increments per
+note. OnlineSampler samples from the trained counts plus any number of such
+layers: rows nothing was learned for go straight to the compiled tables, the
+others are merged and renormalized the first time they are sampled after they
+changed, so learning never touches the rows it does not affect. Phrases can be
+unlearned again, so that a model that keeps learning can forget its oldest phrases.
+"""
+import threading
+
+import numpy as np
+
+# Merged rows an OnlineSampler keeps, the cache starts over beyond it
+MAX_CACHED_ROWS = 1 << 16
+
+class OnlineCounts:
+    """
+    Initial and successor counts of learned phrases, for contexts of every order
+    up to the model's max_order. Contexts are tuples of state indexes, a first
+    order context is a 1-tuple.
+    """
+
+    def __init__(self):
+        self.initial = {}  # state index -> count
+        self.successors = {}  # context -> {next state index: count}
+        self.versions = {}  # context -> stamp of its last update, () for the initial counts
+        self.notes = 0
+        self._stamp = 0
+        self._lock = threading.Lock()
+
+    def add(self, indexes, max_order=1):
+        """
+        Count one phrase, O(len(indexes) * max_order).
+
+        Parameters:
+            indexes (list of int): The phrase as state indexes, -1 for states that are not
+                counted (they also break the contexts they are part of).
+            max_order (int): Longest context to count.
+        """
+        with self._lock:
+            self._update(indexes, max_order, 1)
+
+    def remove(self, indexes, max_order=1):
+        """
+        Uncount a phrase counted by add with the same max_order, O(len(indexes) * max_order).
+        """
+        with self._lock:
+            self._update(indexes, max_order, -1)
+
+    def _update(self, indexes, max_order, step):
+        # stamps are never reused, so a context learned, forgotten and learned again
+        # does not match a row merged before
+        self._stamp += 1
+        for position, index in enumerate(indexes):
+            if index < 0:
+                continue
+            self._count(self.initial, index, step)
+            self.notes += step
+            for order in range(1, min(max_order, position) + 1):
+                context = tuple(indexes[position - order:position])
+                if context[0] < 0:
+                    # longer contexts contain it as well
+                    break
+                row = self.successors.setdefault(context, {})
+                self._count(row, index, step)
+                if row:
+                    self.versions[context] = self._stamp
+                else:
+                    del self.successors[context]
+                    self.versions.pop(context, None)
+        self.versions[()] = self._stamp
+
+    @staticmethod
+    def _count(row, index, step):
+        count = row.get(index, 0) + step
+        if count > 0:
+            row[index] = count
+        else:
+            row.pop(index, None)
+
+    def copy(self):
+        """
+        Returns:
+            OnlineCounts: A snapshot of the counts, later updates of these do not change it.
+        """
+        with self._lock:
+            counts = OnlineCounts()
+            counts.initial = dict(self.initial)
+            counts.successors = {context: dict(row) for context, row in self.successors.items()}
+            counts.versions = dict(self.versions)
+            counts.notes = self.notes
+            counts._stamp = self._stamp
+            return counts
+
+    def counts(self, context):
+        """
+        Returns:
+            list of tuples: (state index, count) pairs learned for context, () for the initial counts.
+        """
+        with self._lock:
+            row = self.initial if context == () else self.successors.get(context, {})
+            return list(row.items())
+
+
+class OnlineSampler:
+    """
+    Drop-in replacement for a model's CompiledSampler that also samples the
+    counts of learned phrases (one or more OnlineCounts layers).
+    """
+
+    def __init__(self, base, initial_counts, transition_counts, layers):
+        """
+        Parameters:
+            base (CompiledSampler): The sampler compiled from the trained probabilities.
+            initial_counts (numpy.ndarray): Trained initial counts of every state.
+            transition_counts (CSRMatrix): Trained transition counts.
+            layers (list of OnlineCounts): Learned counts, added to the trained ones.
+        """
+        self.base = base
+        self.initial_counts = initial_counts
+        self.transition_counts = transition_counts
+        self.layers = list(layers)
+        self._rows = {}  # context -> (layer versions, merged row)
+        self._initial_indices = np.flatnonzero(initial_counts)
+        self._initial_values = np.asarray(initial_counts)[self._initial_indices]
+
+    def touched(self, context):
+        """
+        Returns:
+            bool: Whether any layer learned successors of context.
+        """
+        return any(context in layer.successors for layer in self.layers)
+
+    def merged(self, context, base_indices, base_counts):
+        """
+        Trained counts of a row plus the learned ones, normalized into cumulative
+        probabilities. Cached until one of the layers learns something for context.
+
+        Parameters:
+            context (tuple): The context, () for the initial distribution.
+            base_indices (numpy.ndarray): State indexes of the trained counts of the row.
+            base_counts (numpy.ndarray): The trained counts.
+
+        Returns:
+            tuple: (int32 state indexes, cumulative probabilities), None if the row is empty.
+        """
+        versions = tuple(layer.versions.get(context, 0) for layer in self.layers)
+        cached = self._rows.get(context)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+
+        counts = dict(zip(np.asarray(base_indices).tolist(), np.asarray(base_counts).tolist()))
+        for layer in self.layers:
+            for index, count in layer.counts(context):
+                counts[index] = counts.get(index, 0) + count
+        row = None
+        if counts:
+            indices = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+            cumulative = np.cumsum(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+            cumulative /= cumulative[-1]
+            cumulative[-1] = 1.0
+            row = (indices, cumulative)
+        if len(self._rows) >= MAX_CACHED_ROWS:
+            # rows of forgotten contexts are never asked for again
+            self._rows.clear()
+        self._rows[context] = (versions, row)
+        return row
+
+    def sample_row(self, row):
+        """
+        Parameters:
+            row (tuple): A row returned by merged.
+
+        Returns:
+            int: A state index drawn from the row.
+        """
+        indices, cumulative = row
+        position = np.searchsorted(cumulative, np.random.random(), side="right")
+        return int(indices[min(position, len(indices) - 1)])
+
+    def _initial_row(self):
+        """
+        Returns:
+            tuple: The merged initial row, None when no layer learned initial counts.
+        """
+        if not any(layer.initial for layer in self.layers):
+            return None
+        return self.merged((), self._initial_indices, self._initial_values)
+
+    def _successor_row(self, index):
+        if index < self.transition_counts.shape[0]:
+            return self.merged((index,), *self.transition_counts.row(index))
+        return self.merged((index,), (), ())
+
+    def _is_trained_row(self, index):
+        return index < len(self.base.has_successor) and self.base.has_successor[index] and not self.touched((index,))
+
+    def sample_initial(self):
+        row = self._initial_row()
+        if row is None:
+            return self.base.sample_initial()
+        return self.sample_row(row)
+
+    def sample_next(self, index):
+        if self._is_trained_row(index):
+            return self.base.sample_next(index)
+        row = self._successor_row(index)
+        if row is None:
+            return self.sample_initial()
+        return self.sample_row(row)
+
+    def sample_initial_batch(self, n):
+        row = self._initial_row()
+        if row is None:
+            return self.base.sample_initial_batch(n)
+        indices, cumulative = row
+        positions = np.searchsorted(cumulative, np.random.random(n), side="right")
+        return indices[np.minimum(positions, len(indices) - 1)]
+
+    def sample_next_batch(self, indexes):
+        """
+        Chains on trained rows are advanced together by the compiled sampler, the others one by one.
+        """
+        indexes = np.asarray(indexes)
+        trained = np.fromiter((self._is_trained_row(i) for i in indexes.tolist()), dtype=bool, count=len(indexes))
+        next_indexes = np.empty(len(indexes), dtype=np.int32)
+        next_indexes[trained] = self.base.sample_next_batch(indexes[trained])
+        for position in np.flatnonzero(~trained).tolist():
+            next_indexes[position] = self.sample_next(int(indexes[position]))
+        return next_indexes
+
+    def has_successor_at(self, index):
+        return bool(index < len(self.base.has_successor) and self.base.has_successor[index]) or self.touched((index,))
@@ -0,0 +1,165 @@
+"""
+Save trained models as a directory of .npy arrays plus a JSON manifest.
+
+Arrays are stored uncompressed so load_model can memory map them: loading is
+just opening files, and several processes loading the same artifact share
+the physical pages through the OS page cache.
+"""
+import json
+import os
+import shutil
+from fractions import Fraction
+
+import numpy as np
+
+from .extensions import MultiInstanceTrainableMarkovChainMelodyGenerator
+from .sampling import CompiledSampler
+from .sparse import CSRMatrix, SparseVector
+from .variableorder import ContextTable, VariableOrderMarkovChainMelodyGenerator
+
+FORMAT_VERSION = 1
+MANIFEST_FILENAME = "manifest.json"
+
+SAMPLER_ARRAYS = ("initial_indices", "initial_cumulative", "indptr", "indices", "cumulative")
+CONTEXT_ARRAYS = ("keys", "indptr", "indices", "cumulative", "counts")
+
+
+def duration_to_str(duration):
+    """
+    Encode a quarterLength without losing precision; music21 uses Fractions
+    for tuplets (e.g. 1/3), which must survive a round trip to stay equal to
+    the training states.
+    """
+    if isinstance(duration, Fraction):
+        return f"{duration.numerator}/{duration.denominator}"
+    return repr(float(duration))
+
+
+def duration_from_str(value):
+    if "/" in value:
+        return Fraction(value)
+    return float(value)
+
+
+def save_model(model, directory, metadata=None):
+    """
+    Write a trained model to a directory, replacing any previous artifact.
+
+    Parameters:
+        model (MarkovChainMelodyGenerator): A trained (and compiled) model.
+        directory (str): Target directory.
+        metadata (dict): Extra JSON-serializable data stored in the manifest.
+    """
+    if model.sampler is None or model.transition_counts is None:
+        raise ValueError("Only trained models can be saved")
+    if getattr(model, "learned_counts", None) is not None or getattr(model, "overlay_counts", None) is not None:
+        raise ValueError("Models that learned phrases after training cannot be saved, retrain them instead")
+
+    tmp_directory = f"{directory}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    def save(name, array):
+        np.save(os.path.join(tmp_directory, f"{name}.npy"), np.ascontiguousarray(array))
+
+    counts = model.transition_counts
+    save("initial_counts", model.initial_counts)
+    save("transition_indptr", counts.indptr)
+    save("transition_indices", counts.indices)
+    save("transition_counts", counts.data)
+
+    # Normalized probabilities share the sparsity pattern of the counts
+    if model.sparse:
+        save("initial_probabilities", model.initial_probabilities.toarray())
+        save("transition_probabilities", model.transition_matrix.data)
+    else:
+        save("initial_probabilities", model.initial_probabilities)
+        save("transition_probabilities", model.transition_matrix[counts.row_ids(), counts.indices])
+
+    for name in SAMPLER_ARRAYS:
+        save(f"sampler_{name}", getattr(model.sampler, name))
+
+    variable_order = None
+    if isinstance(model, VariableOrderMarkovChainMelodyGenerator):
+        variable_order = {
+            "max_order": model.max_order,
+            "min_count": model.min_count,
+            "max_contexts": model.max_contexts,
+        }
+        for table in model.context_tables:
+            for name in CONTEXT_ARRAYS:
+                save(f"context{table.order}_{name}", getattr(table, name))
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "sparse": model.sparse,
+        "variable_order": variable_order,
+        "states": [[pitch, duration_to_str(duration)] for pitch, duration in model.states],
+        "metadata": metadata or {},
+    }
+    with open(os.path.join(tmp_directory, MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+
+def load_model(directory, model_class=MultiInstanceTrainableMarkovChainMelodyGenerator, mmap_mode="r"):
+    """
+    Load a model written by save_model.
+
+    Parameters:
+        directory (str): The artifact directory.
+        model_class (type): The generator class to instantiate, ignored for
+            variable-order models which always load as VariableOrderMarkovChainMelodyGenerator.
+        mmap_mode (str): Passed to numpy.load; the default "r" memory maps the
+            arrays read-only, None reads them into private memory.
+
+    Returns:
+        model (MarkovChainMelodyGenerator): The trained, compiled model.
+        metadata (dict): The metadata stored with the model.
+    """
+    with open(os.path.join(directory, MANIFEST_FILENAME)) as f:
+        manifest = json.load(f)
+    if manifest["format_version"] != FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported model format {manifest['format_version']} in {directory}, retrain it"
+        )
+
+    def load(name):
+        return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+
+    states = [(pitch, duration_from_str(duration)) for pitch, duration in manifest["states"]]
+    variable_order = manifest.get("variable_order")
+    if variable_order:
+        model = VariableOrderMarkovChainMelodyGenerator(states, sparse=manifest["sparse"], **variable_order)
+        model.context_tables = [
+            ContextTable(order, *(load(f"context{order}_{name}") for name in CONTEXT_ARRAYS))
+            for order in range(2, model.max_order + 1)
+        ]
+    else:
+        model = model_class(states, sparse=manifest["sparse"])
+    shape = (len(states), len(states))
+
+    model.initial_counts = load("initial_counts")
+    model.transition_counts = CSRMatrix(shape)
+    model.transition_counts.indptr = load("transition_indptr")
+    model.transition_counts.indices = load("transition_indices")
+    model.transition_counts.data = load("transition_counts")
+
+    if model.sparse:
+        model.initial_probabilities = SparseVector.from_dense(load("initial_probabilities"))
+        model.transition_matrix = CSRMatrix(shape)
+        model.transition_matrix.indptr = model.transition_counts.indptr
+        model.transition_matrix.indices = model.transition_counts.indices
+        model.transition_matrix.data = load("transition_probabilities")
+    else:
+        model.initial_probabilities = np.array(load("initial_probabilities"))
+        probabilities = CSRMatrix(shape)
+        probabilities.indptr = model.transition_counts.indptr
+        probabilities.indices = model.transition_counts.indices
+        probabilities.data = load("transition_probabilities")
+        model.transition_matrix = probabilities.toarray()
+
+    model.sampler = CompiledSampler(*(load(f"sampler_{name}") for name in SAMPLER_ARRAYS))
+    return model, manifest["metadata"]
@@ -0,0 +1,160 @@
+"""
+Precomputed sampling tables for trained Markov chain models.
+"""
+import numpy as np
+
+from .sparse import CSRMatrix, SparseVector
+
+
+class CompiledSampler:
+    """
+    Frozen, read-only sampling tables built once from a trained model.
+
+    Every transition row is stored as cumulative probabilities over its
+    non-zero entries only. To let a single ``np.searchsorted`` call find the
+    sampled entry of any row, row ``i`` is offset by ``i``: its cumulative
+    values run from just above ``i`` up to exactly ``i + 1``, so drawing
+    ``u`` in [0, 1) and searching for ``i + u`` lands inside row ``i``. That
+    makes a sampling step O(log nnz) with no allocation, independent of the
+    number of states.
+    """
+
+    def __init__(self, initial_indices, initial_cumulative, indptr, indices, cumulative):
+        """
+        Initialize the sampler from already computed tables.
+
+        Parameters:
+            initial_indices (numpy.ndarray): State ids with a non-zero initial probability.
+            initial_cumulative (numpy.ndarray): Cumulative initial probabilities of those states.
+            indptr (numpy.ndarray): CSR row pointers of the transition table.
+            indices (numpy.ndarray): Next-state id of every stored transition.
+            cumulative (numpy.ndarray): Row-offset cumulative probability of every stored transition.
+        """
+        self.initial_indices = initial_indices
+        self.initial_cumulative = initial_cumulative
+        self.indptr = indptr
+        self.indices = indices
+        self.cumulative = cumulative
+        self.has_successor = np.diff(indptr) > 0
+        for array in (self.initial_indices, self.initial_cumulative, self.indptr,
+                      self.indices, self.cumulative, self.has_successor):
+            array.flags.writeable = False
+
+    @classmethod
+    def from_probabilities(cls, initial_probabilities, transition_matrix):
+        """
+        Build the sampling tables from normalized model probabilities.
+
+        Parameters:
+            initial_probabilities (numpy.ndarray or SparseVector): Initial state distribution.
+            transition_matrix (numpy.ndarray or CSRMatrix): Row-normalized transition matrix.
+
+        Returns:
+            CompiledSampler: The frozen sampler.
+        """
+        if isinstance(initial_probabilities, SparseVector):
+            initial_indices = initial_probabilities.indices
+            initial_values = initial_probabilities.data
+        else:
+            initial_indices = np.flatnonzero(initial_probabilities).astype(np.int32)
+            initial_values = initial_probabilities[initial_indices]
+
+        if isinstance(transition_matrix, CSRMatrix):
+            row_ids = transition_matrix.row_ids()
+            indptr = transition_matrix.indptr
+            indices = transition_matrix.indices
+            values = transition_matrix.data
+        else:
+            row_ids, indices = np.nonzero(transition_matrix)
+            values = transition_matrix[row_ids, indices]
+            indptr = np.zeros(len(transition_matrix) + 1, dtype=np.int64)
+            indptr[1:] = np.cumsum(np.bincount(row_ids, minlength=len(transition_matrix)))
+            indices = indices.astype(np.int32)
+
+        return cls(
+            np.array(initial_indices, dtype=np.int32),
+            _cumulative(initial_values, np.array([0, len(initial_values)])),
+            np.array(indptr, dtype=np.int64),
+            np.array(indices, dtype=np.int32),
+            _cumulative(values, indptr) + np.asarray(row_ids, dtype=np.float64),
+        )
+
+    def sample_initial(self):
+        """
+        Returns:
+            int: A state id drawn from the initial distribution.
+        """
+        position = np.searchsorted(self.initial_cumulative, np.random.random(), side="right")
+        return self.initial_indices[min(position, len(self.initial_indices) - 1)]
+
+    def sample_next(self, index):
+        """
+        Draw the successor of a state, falling back to the initial distribution
+        for states that were never followed by anything.
+
+        Parameters:
+            index (int): The current state id.
+
+        Returns:
+            int: The next state id.
+        """
+        if not self.has_successor[index]:
+            return self.sample_initial()
+        position = np.searchsorted(self.cumulative, index + np.random.random(), side="right")
+        # index + u can round up to index + 1 for u close to 1
+        return self.indices[min(position, self.indptr[index + 1] - 1)]
+
+    def has_successor_at(self, index):
+        """
+        Returns:
+            bool: Whether the state was followed by anything.
+        """
+        return bool(self.has_successor[index])
+
+    def sample_initial_batch(self, n):
+        """
+        Parameters:
+            n (int): The number of states to draw.
+
+        Returns:
+            numpy.ndarray: n state ids drawn independently from the initial distribution.
+        """
+        positions = np.searchsorted(self.initial_cumulative, np.random.random(n), side="right")
+        return self.initial_indices[np.minimum(positions, len(self.initial_indices) - 1)]
+
+    def sample_next_batch(self, indexes):
+        """
+        Vectorized sample_next: draw one successor for each of many chains.
+
+        Parameters:
+            indexes (numpy.ndarray): The current state id of every chain.
+
+        Returns:
+            numpy.ndarray: The next state id of every chain.
+        """
+        next_indexes = np.empty(len(indexes), dtype=np.int32)
+        continuing = self.has_successor[indexes]
+        current = indexes[continuing]
+        positions = np.searchsorted(
+            self.cumulative, current + np.random.random(len(current)), side="right"
+        )
+        next_indexes[continuing] = self.indices[np.minimum(positions, self.indptr[current + 1] - 1)]
+        next_indexes[~continuing] = self.sample_initial_batch(len(indexes) - len(current))
+        return next_indexes
+
+
+def _cumulative(values, indptr):
+    """
+    Per-row cumulative sums of CSR values, with the last entry of every row
+    pinned to exactly 1 so rounding can never leave a gap at the end.
+    """
+    cumulative = np.cumsum(values, dtype=np.float64)
+    if len(cumulative) == 0:
+        return cumulative
+    starts = np.asarray(indptr[:-1])
+    ends = np.asarray(indptr[1:])
+    non_empty = ends > starts
+    row_offsets = np.concatenate([[0.0], cumulative])[starts]
+    cumulative -= np.repeat(row_offsets, ends - starts)
+    cumulative[ends[non_empty] - 1] = 1.0
+    return cumulative
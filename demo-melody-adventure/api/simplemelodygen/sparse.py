@@ -0,0 +1,203 @@
+"""
+Minimal compressed sparse storage for Markov chain counts and probabilities.
+
+Only the handful of operations the melody generators need are implemented
+(building from coordinates or dense arrays, row normalization and row access
+while sampling), so numpy remains the only dependency.
+"""
+import numpy as np
+
+
+class SparseVector:
+    """
+    A 1-D vector that only stores its non-zero entries, in the sorted
+    ``indices`` / ``data`` arrays.
+    """
+
+    def __init__(self, size):
+        """
+        Initialize an all-zero vector.
+
+        Parameters:
+            size (int): The length of the vector.
+        """
+        self.size = size
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.data = np.zeros(0)
+
+    @classmethod
+    def from_dense(cls, array):
+        """
+        Parameters:
+            array (numpy.ndarray): A dense 1-D array.
+
+        Returns:
+            SparseVector: The same values, keeping only the non-zero entries.
+        """
+        vector = cls(len(array))
+        vector.indices = np.flatnonzero(array).astype(np.int32)
+        vector.data = np.asarray(array, dtype=np.float64)[vector.indices]
+        return vector
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        position = np.searchsorted(self.indices, index)
+        if position < len(self.indices) and self.indices[position] == index:
+            return self.data[position]
+        return 0.0
+
+    def sum(self):
+        return self.data.sum()
+
+    def normalize(self):
+        """
+        Scale the stored values so that they sum up to 1 (no-op if empty).
+        """
+        total = self.sum()
+        if total:
+            self.data = self.data / total
+
+    def toarray(self):
+        """
+        Returns:
+            numpy.ndarray: The dense representation of the vector.
+        """
+        dense = np.zeros(self.size)
+        dense[self.indices] = self.data
+        return dense
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.data.nbytes
+
+
+class CSRMatrix:
+    """
+    A 2-D matrix in compressed sparse row (CSR) layout.
+
+    Row ``i`` occupies ``indices[indptr[i]:indptr[i + 1]]`` (column ids, sorted)
+    and the matching slice of ``data``. Matrices are built in one pass with
+    ``from_coo``.
+    """
+
+    def __init__(self, shape):
+        """
+        Initialize an all-zero matrix.
+
+        Parameters:
+            shape (tuple of int): (number of rows, number of columns).
+        """
+        self.shape = shape
+        self.indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.data = np.zeros(0)
+
+    @classmethod
+    def from_coo(cls, rows, cols, values, shape):
+        """
+        Build a matrix from coordinate triplets, summing duplicate entries.
+
+        Parameters:
+            rows (array-like of int): Row index of each entry.
+            cols (array-like of int): Column index of each entry.
+            values (array-like of float): Value of each entry.
+            shape (tuple of int): (number of rows, number of columns).
+
+        Returns:
+            CSRMatrix: The compressed matrix.
+        """
+        matrix = cls(shape)
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if len(rows) == 0:
+            return matrix
+
+        # Flatten (row, col) into a single key so duplicates can be summed
+        # with one np.unique pass; the keys come back sorted row-major.
+        keys, inverse = np.unique(rows * shape[1] + cols, return_inverse=True)
+        summed = np.bincount(inverse, weights=values, minlength=len(keys))
+        nonzero = summed != 0
+        keys, summed = keys[nonzero], summed[nonzero]
+
+        key_rows = keys // shape[1]
+        matrix.indices = (keys % shape[1]).astype(np.int32)
+        matrix.data = summed
+        matrix.indptr[1:] = np.cumsum(np.bincount(key_rows, minlength=shape[0]))
+        return matrix
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            row, col = key
+            indices, data = self.row(row)
+            position = np.searchsorted(indices, col)
+            if position < len(indices) and indices[position] == col:
+                return data[position]
+            return 0.0
+        # A single index returns the dense row, mirroring numpy semantics
+        dense = np.zeros(self.shape[1])
+        indices, data = self.row(key)
+        dense[indices] = data
+        return dense
+
+    def row(self, row):
+        """
+        Get the stored entries of a row.
+
+        Parameters:
+            row (int): The row index.
+
+        Returns:
+            indices (numpy.ndarray): Column ids of the non-zero entries.
+            data (numpy.ndarray): The matching values.
+        """
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def row_ids(self):
+        """
+        Returns:
+            numpy.ndarray: The row index of every stored entry.
+        """
+        return np.repeat(np.arange(self.shape[0], dtype=np.int32), np.diff(self.indptr))
+
+    def sum(self, axis=None):
+        if axis is None:
+            return self.data.sum()
+        if axis == 1:
+            return np.bincount(self.row_ids(), weights=self.data, minlength=self.shape[0])
+        return np.bincount(self.indices, weights=self.data, minlength=self.shape[1])
+
+    def normalize_rows(self):
+        """
+        Scale every non-empty row so that its values sum up to 1. Empty rows
+        are simply not stored, so no division by zero can happen.
+        """
+        row_sums = self.sum(axis=1)
+        self.data = self.data / row_sums[self.row_ids()]
+
+    def copy(self):
+        other = CSRMatrix(self.shape)
+        other.indptr = self.indptr.copy()
+        other.indices = self.indices.copy()
+        other.data = self.data.copy()
+        return other
+
+    def toarray(self):
+        """
+        Returns:
+            numpy.ndarray: The dense representation of the matrix.
+        """
+        dense = np.zeros(self.shape)
+        dense[self.row_ids(), self.indices] = self.data
+        return dense
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
@@ -0,0 +1,241 @@
+"""
+Variable-order (back-off) Markov chain melody generation.
+"""
+import numpy as np
+
+from .extensions import MultiInstanceTrainableMarkovChainMelodyGenerator
+from .online import OnlineSampler
+from .sampling import _cumulative
+
+
+class ContextTable:
+    """
+    Hashed n-gram table for one context length (order).
+
+    A context of ``order`` state indexes is packed into a single int64 key
+    (base len(states) digits). Keys are stored sorted, so looking a context up
+    is one binary search, and the successors of context row ``r`` are stored
+    CSR-style with row-offset cumulative probabilities exactly like
+    CompiledSampler, so sampling is a second binary search. Only contexts that
+    were observed in training take memory.
+    """
+
+    def __init__(self, order, keys, indptr, indices, cumulative, counts):
+        """
+        Parameters:
+            order (int): The number of states in a context.
+            keys (numpy.ndarray): Sorted int64 context keys, one per row.
+            indptr (numpy.ndarray): Row pointers into indices / cumulative.
+            indices (numpy.ndarray): Next state index of every stored transition.
+            cumulative (numpy.ndarray): Row-offset cumulative probability of every stored transition.
+            counts (numpy.ndarray): Raw count of every stored transition.
+        """
+        self.order = order
+        self.keys = keys
+        self.indptr = indptr
+        self.indices = indices
+        self.cumulative = cumulative
+        self.counts = counts
+        for array in (self.keys, self.indptr, self.indices, self.cumulative, self.counts):
+            array.flags.writeable = False
+
+    @classmethod
+    def from_sequences(cls, sequences, order, num_states, min_count=1, max_contexts=None):
+        """
+        Count every (context, next state) pair of the given order in one vectorized pass.
+
+        Parameters:
+            sequences (list): A list of int32 arrays of state indexes.
+            order (int): The number of states in a context.
+            num_states (int): The size of the state vocabulary.
+            min_count (int): Drop contexts observed fewer times than this.
+            max_contexts (int): Keep at most this many contexts, the most frequent ones.
+
+        Returns:
+            ContextTable: The table.
+        """
+        powers = num_states ** np.arange(order - 1, -1, -1, dtype=np.int64)
+        keys, following = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for sequence in sequences:
+            if len(sequence) <= order:
+                continue
+            windows = np.lib.stride_tricks.sliding_window_view(sequence[:-1].astype(np.int64), order)
+            keys.append(windows @ powers)
+            following.append(sequence[order:].astype(np.int64))
+        keys, following = np.concatenate(keys), np.concatenate(following)
+        if len(keys) == 0:
+            empty = np.zeros(0)
+            return cls(order, empty.astype(np.int64), np.zeros(1, dtype=np.int64),
+                       empty.astype(np.int32), empty, empty.copy())
+
+        # Group identical (context, next) pairs
+        sort_order = np.lexsort((following, keys))
+        keys, following = keys[sort_order], following[sort_order]
+        pair_starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]) | (following[1:] != following[:-1])])
+        pair_counts = np.diff(np.r_[pair_starts, len(keys)]).astype(np.float64)
+        pair_keys, pair_following = keys[pair_starts], following[pair_starts]
+
+        # Group pairs by context
+        context_ids = np.cumsum(np.r_[True, pair_keys[1:] != pair_keys[:-1]]) - 1
+        context_totals = np.bincount(context_ids, weights=pair_counts)
+        keep = context_totals >= min_count
+        if max_contexts is not None and keep.sum() > max_contexts:
+            threshold_order = np.argsort(-context_totals, kind="stable")[:max_contexts]
+            keep = np.zeros(len(context_totals), dtype=bool)
+            keep[threshold_order] = True
+        kept_pairs = keep[context_ids]
+        pair_counts, pair_keys, pair_following = pair_counts[kept_pairs], pair_keys[kept_pairs], pair_following[kept_pairs]
+        context_ids = (np.cumsum(keep) - 1)[context_ids[kept_pairs]]
+        context_totals = context_totals[keep]
+
+        indptr = np.zeros(len(context_totals) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(context_ids, minlength=len(context_totals)))
+        probabilities = pair_counts / context_totals[context_ids]
+        return cls(
+            order,
+            pair_keys[indptr[:-1]],
+            indptr,
+            pair_following.astype(np.int32),
+            _cumulative(probabilities, indptr) + context_ids,
+            pair_counts,
+        )
+
+    def find(self, keys):
+        """
+        Parameters:
+            keys (numpy.ndarray): int64 context keys.
+
+        Returns:
+            numpy.ndarray: The row of every key, -1 for contexts not in the table.
+        """
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1)
+        rows = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[rows] == keys, rows, -1)
+
+    def sample(self, rows):
+        """
+        Parameters:
+            rows (numpy.ndarray): Rows returned by find (all must be found).
+
+        Returns:
+            numpy.ndarray: A next state index for every row.
+        """
+        positions = np.searchsorted(self.cumulative, rows + np.random.random(len(rows)), side="right")
+        return self.indices[np.minimum(positions, self.indptr[rows + 1] - 1)]
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.keys, self.indptr, self.indices, self.cumulative, self.counts))
+
+
+class VariableOrderMarkovChainMelodyGenerator(MultiInstanceTrainableMarkovChainMelodyGenerator):
+    """
+    Markov chain that conditions on up to max_order previous states, backing off to
+    shorter contexts (down to the first-order chain) whenever the longer context was
+    not seen in training. Continuations therefore stay close to the phrase they continue.
+    """
+
+    def __init__(self, states, sparse=True, max_order=3, min_count=1, max_contexts=None):
+        """
+        Parameters:
+            states (list of tuples): A list of possible (pitch, duration) pairs.
+            sparse (bool): Storage mode of the first-order chain.
+            max_order (int): Longest context used for generation.
+            min_count (int): Contexts of order >= 2 seen fewer times are not stored.
+            max_contexts (int): Optional bound on the number of stored contexts per order.
+        """
+        super().__init__(states, sparse=sparse)
+        if max_order > 1 and len(states) ** max_order >= 2 ** 63:
+            raise ValueError(f"Contexts of {max_order} states over {len(states)} states do not fit in int64 keys")
+        self.max_order = max_order
+        self.min_count = min_count
+        self.max_contexts = max_contexts
+        self.context_tables = []
+        # Base of the context keys, states learned after training are not in the tables
+        self.context_base = len(states)
+
+    def train_from_indexes(self, sequences):
+        """
+        Train the first-order chain and the context tables of every order up to max_order.
+
+        Parameters:
+            sequences (list): A list of int32 arrays of state indexes, each representing an example phrase/song.
+        """
+        super().train_from_indexes(sequences)
+        sequences = [np.asarray(s, dtype=np.int32) for s in sequences]
+        self.context_base = len(self.states)
+        self.context_tables = [
+            ContextTable.from_sequences(sequences, order, len(self.states), self.min_count, self.max_contexts)
+            for order in range(2, self.max_order + 1)
+        ]
+
+    def _context_indexes(self, previous_ids):
+        """
+        Encode the last max_order states of previous_ids. Only the last state must be
+        known to the model, unknown earlier states are encoded as -1 and simply make longer
+        contexts that include them unusable.
+        """
+        context = self.ids_to_indexes(previous_ids[-self.max_order:-1]).tolist()
+        return context + [self._known_index(previous_ids[-1])]
+
+    def _generate_next_index_after(self, indexes):
+        learned = isinstance(self.sampler, OnlineSampler)
+        for table in reversed(self.context_tables):
+            context = indexes[-table.order:]
+            if len(context) < table.order or min(context) < 0:
+                continue
+            row = None
+            if max(context) < self.context_base:
+                key = 0
+                for index in context:
+                    key = key * self.context_base + index
+                row = table.find(np.array([key], dtype=np.int64))
+                if row[0] < 0:
+                    row = None
+            if learned and self.sampler.touched(tuple(context)):
+                start, end = (table.indptr[row[0]], table.indptr[row[0] + 1]) if row is not None else (0, 0)
+                merged = self.sampler.merged(tuple(context), table.indices[start:end], table.counts[start:end])
+                return self.sampler.sample_row(merged)
+            if row is not None:
+                return int(table.sample(row)[0])
+        return self._generate_next_index(indexes[-1])
+
+    def _generate_batch_after(self, n, length, previous_ids):
+        """
+        Vectorized generation with back-off, see MultiInstanceTrainableMarkovChainMelodyGenerator.generate_batch.
+        """
+        if self.sampler is None:
+            self.compile()
+        context = self._context_indexes(previous_ids) if len(previous_ids) else []
+        if isinstance(self.sampler, OnlineSampler):
+            # learned contexts are merged row by row, advance the chains one at a time
+            melodies = np.empty((n, length), dtype=np.int32)
+            for chain in range(n):
+                indexes = list(context)
+                for position in range(length):
+                    indexes.append(self._generate_next_index_after(indexes) if indexes
+                                   else self._generate_starting_index())
+                    melodies[chain, position] = indexes[-1]
+            return melodies
+        history = np.empty((n, len(context) + length), dtype=np.int64)
+        history[:, :len(context)] = context
+
+        for position in range(len(context), history.shape[1]):
+            if position == 0:
+                history[:, 0] = self.sampler.sample_initial_batch(n)
+                continue
+            next_indexes = self.sampler.sample_next_batch(history[:, position - 1])
+            resolved = np.zeros(n, dtype=bool)
+            for table in reversed(self.context_tables):
+                if position < table.order:
+                    continue
+                window = history[:, position - table.order:position]
+                candidates = np.flatnonzero(~resolved & (window >= 0).all(axis=1))
+                powers = self.context_base ** np.arange(table.order - 1, -1, -1, dtype=np.int64)
+                rows = table.find(window[candidates] @ powers)
+                found = rows >= 0
+                next_indexes[candidates[found]] = table.sample(rows[found])
+                resolved[candidates[found]] = True
+            history[:, position] = next_indexes
+        return history[:, len(context):].astype(np.int32)
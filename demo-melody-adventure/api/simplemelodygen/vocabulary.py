@@ -0,0 +1,196 @@
+"""
+Shared vocabulary interning (pitch, duration) states as dense int32 ids.
+
+Every model registers its states here, and melodies are passed around as id
+arrays, so per-note work becomes array indexing: durations are a float64 array,
+pitches a second int32 id, and whatever is derived from a state or a pitch (MIDI
+key numbers, JSON fragments) is computed once per id and looked up afterwards.
+Strings and tuples are only needed at the boundaries (JSON requests and
+responses, training corpora).
+
+Ids are only meaningful within one process, never store or send them.
+"""
+import threading
+
+import numpy as np
+
+# Bound on the number of interned states, requests can carry arbitrary durations
+MAX_STATES = 1 << 18
+
+class VocabularyFull(ValueError):
+    pass
+
+class StateVocabulary:
+    """
+    Interns states to ids 0, 1, 2, ... in first seen order. States compare as tuples
+    do, so ('C4', 1.0) and ('C4', Fraction(1)) share an id and decode to the first seen.
+    Interning takes a lock, lookups do not: ids are published only once their
+    duration and pitch are stored.
+    """
+
+    def __init__(self, states=(), max_states=MAX_STATES):
+        """
+        Parameters:
+            states (iterable of tuples): (pitch, duration) states to intern right away.
+            max_states (int): intern raises VocabularyFull beyond this many states.
+        """
+        self.max_states = max_states
+        self.states = []  # id -> (pitch, duration)
+        self.pitches = []  # pitch id -> pitch name
+        self._ids = {}
+        self._pitch_ids = {}
+        self._durations = np.zeros(64)
+        self._pitch_of = np.zeros(64, dtype=np.int32)
+        self._tables = {}
+        self._lock = threading.Lock()
+        self.encode(states)
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, state):
+        return (state[0], state[1]) in self._ids
+
+    def has_pitch(self, pitch):
+        """
+        Returns:
+            bool: Whether a state with this pitch was interned.
+        """
+        return pitch in self._pitch_ids
+
+    def intern(self, state):
+        """
+        Parameters:
+            state (tuple or list): A (pitch, duration) pair.
+
+        Returns:
+            int: The id of the state, adding it if it is new.
+        """
+        state = (state[0], state[1])
+        state_id = self._ids.get(state)
+        if state_id is None:
+            state_id = self._add(state)
+        return state_id
+
+    def _add(self, state):
+        with self._lock:
+            state_id = self._ids.get(state)
+            if state_id is not None:
+                return state_id
+            state_id = len(self.states)
+            if state_id >= self.max_states:
+                raise VocabularyFull(f'More than {self.max_states} distinct notes')
+            pitch, duration = state
+            pitch_id = self._pitch_ids.get(pitch)
+            if pitch_id is None:
+                pitch_id = len(self.pitches)
+                self.pitches.append(pitch)
+                self._pitch_ids[pitch] = pitch_id
+            if state_id == len(self._durations):
+                # grow into new arrays, readers may still hold the old ones
+                self._durations = np.concatenate([self._durations, np.zeros(state_id)])
+                self._pitch_of = np.concatenate([self._pitch_of, np.zeros(state_id, dtype=np.int32)])
+            self._durations[state_id] = float(duration)
+            self._pitch_of[state_id] = pitch_id
+            self.states.append(state)
+            self._ids[state] = state_id
+            return state_id
+
+    def encode(self, states):
+        """
+        Parameters:
+            states (iterable): (pitch, duration) tuples or lists, e.g. notes from a JSON request.
+
+        Returns:
+            numpy.ndarray: The int32 id of every state, new states are added.
+        """
+        get = self._ids.get
+
+        def lookup(state):
+            state = (state[0], state[1])
+            state_id = get(state)
+            return self._add(state) if state_id is None else state_id
+
+        return np.fromiter(map(lookup, states), dtype=np.int32)
+
+    def find(self, states):
+        """
+        Like encode, without adding anything.
+
+        Returns:
+            numpy.ndarray: The int32 id of every state, -1 for states that were never interned.
+        """
+        get = self._ids.get
+        return np.fromiter((get((s[0], s[1]), -1) for s in states), dtype=np.int32)
+
+    def decode(self, ids):
+        """
+        Returns:
+            list of tuples: The (pitch, duration) state of every id.
+        """
+        states = self.states
+        return [states[i] for i in np.asarray(ids).tolist()]
+
+    def durations(self, ids):
+        """
+        Returns:
+            numpy.ndarray: The duration in quarter notes of every id, as float64.
+        """
+        return self._durations[:len(self.states)][ids]
+
+    def pitch_ids(self, ids):
+        """
+        Returns:
+            numpy.ndarray: The int32 pitch id of every id, index into self.pitches.
+        """
+        return self._pitch_of[:len(self.states)][ids]
+
+    def state_values(self, function, ids):
+        """
+        Parameters:
+            function (callable): (pitch, duration) -> value, called once per state id.
+            ids (iterable of int): State ids.
+
+        Returns:
+            list: function(state) of every id.
+        """
+        return self._memoized(('state', function), self.states, lambda state: function(*state), ids)
+
+    def pitch_values(self, function, pitch_ids):
+        """
+        Parameters:
+            function (callable): pitch name -> value, called once per pitch id.
+            pitch_ids (iterable of int): Pitch ids, e.g. from pitch_ids().
+
+        Returns:
+            list: function(pitch) of every pitch id.
+        """
+        return self._memoized(('pitch', function), self.pitches, function, pitch_ids)
+
+    def _memoized(self, key, items, function, ids):
+        table = self._tables.get(key)
+        if table is None:
+            table = self._tables.setdefault(key, [])
+        if len(table) < len(items):
+            table.extend([None] * (len(items) - len(table)))
+        ids = np.asarray(ids).tolist()
+        values = list(map(table.__getitem__, ids))
+        if None in values:
+            for position, i in enumerate(ids):
+                if values[position] is None:
+                    if table[i] is None:
+                        table[i] = function(items[i])
+                    values[position] = table[i]
+        return values
+
+    def to_json(self, ids):
+        """
+        Returns:
+            list of tuples: (pitch, float duration) of every id, ready for JSON responses.
+        """
+        return self.state_values(json_state, ids)
+
+def json_state(pitch, duration):
+    return (pitch, float(duration))
+
+VOCABULARY = StateVocabulary()
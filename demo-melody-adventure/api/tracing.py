@@ -0,0 +1,118 @@
+"""
+Structured request tracing kept in memory instead of printed.
+
+Each request gets an id (taken from its X-Request-ID header or generated) and a
+sampling decision. trace() records an event with keyword fields into a ring
+buffer of the last MELODY_TRACE_BUFFER events: warnings and errors always,
+info events of every request, and debug events (the notes of a request, which
+are large) only for the sampled fraction MELODY_TRACE_SAMPLE_RATE of requests.
+Recording keeps references to the fields, they are only serialized when the
+buffer is dumped (GET /api/traces), so tracing does no I/O on the request path.
+Events at MELODY_TRACE_ECHO_LEVEL or above are also written to stderr.
+"""
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+# Events below this level are dropped, debug events of sampled requests are kept regardless
+TRACE_LEVEL = LEVELS[os.environ.get('MELODY_TRACE_LEVEL', 'info')]
+# Fraction of requests whose debug events (inputs and generated notes) are kept
+TRACE_SAMPLE_RATE = float(os.environ.get('MELODY_TRACE_SAMPLE_RATE', '0.01'))
+# Events kept in memory for /api/traces
+TRACE_BUFFER_SIZE = int(os.environ.get('MELODY_TRACE_BUFFER', '2000'))
+# Events at this level or above are also written to stderr as JSON lines
+TRACE_ECHO_LEVEL = LEVELS[os.environ.get('MELODY_TRACE_ECHO_LEVEL', 'warning')]
+
+class Tracer:
+    def __init__(self, level=TRACE_LEVEL, sample_rate=TRACE_SAMPLE_RATE, buffer_size=TRACE_BUFFER_SIZE,
+                 echo_level=TRACE_ECHO_LEVEL, stream=None):
+        """
+        Args:
+            level (int): Events below it are dropped, except debug events of sampled requests.
+            sample_rate (float): Fraction of requests whose debug events are kept.
+            buffer_size (int): Events kept, the oldest are dropped first.
+            echo_level (int): Events at or above it are also written to stream (stderr by default).
+        """
+        self.level = level
+        self.sample_rate = sample_rate
+        self.echo_level = echo_level
+        self.stream = stream
+        self._events = deque(maxlen=buffer_size)
+        self._context = contextvars.ContextVar('trace_request', default=(None, False))
+        self._lock = threading.Lock()
+
+    def start_request(self, request_id=None, sampled=None):
+        """
+        Starts tracing a request in the current context.
+
+        Args:
+            request_id (str): The request's id, a new one is generated if not given.
+            sampled (bool): Whether to keep the request's debug events, decided by sample_rate if not given.
+
+        Returns:
+            str: The request id.
+        """
+        request_id = request_id or uuid.uuid4().hex
+        if sampled is None:
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        self._context.set((request_id, sampled))
+        return request_id
+
+    def end_request(self):
+        self._context.set((None, False))
+
+    @property
+    def request_id(self):
+        return self._context.get()[0]
+
+    def enabled(self, level=DEBUG):
+        """
+        Whether an event at level would be kept, to skip building expensive fields.
+        """
+        return level >= self.level or self._context.get()[1]
+
+    def trace(self, event, level=DEBUG, **fields):
+        request_id, sampled = self._context.get()
+        if level < self.level and not sampled:
+            return
+        record = {'time': time.time(), 'level': level, 'event': event, 'request_id': request_id,
+                  'fields': fields}
+        self._events.append(record)
+        if level >= self.echo_level:
+            stream = self.stream or sys.stderr
+            with self._lock:
+                stream.write(json.dumps(serialize(record), default=str) + '\n')
+
+    def recent(self, limit=None, request_id=None, level=DEBUG):
+        """
+        Returns:
+            list of dict: The buffered events, oldest first, filtered by request id and minimum level.
+        """
+        events = [e for e in list(self._events)
+                  if e['level'] >= level and (request_id is None or e['request_id'] == request_id)]
+        if limit is not None:
+            events = events[-limit:] if limit > 0 else []
+        return [serialize(e) for e in events]
+
+    def clear(self):
+        self._events.clear()
+
+def serialize(record):
+    return dict(record, level=LEVEL_NAMES.get(record['level'], record['level']),
+                fields=json.loads(json.dumps(record['fields'], default=str)))
+
+TRACER = Tracer()
+trace = TRACER.trace
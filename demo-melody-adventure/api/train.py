@@ -0,0 +1,52 @@
+"""
+Offline training of the style models.
+
+Trains each style from its corpus and saves it under MODELS_FOLDER, where the
+server picks it up (memory mapped) instead of parsing and training at startup:
+
+    python -m api.train                 # all styles
+    python -m api.train bach turkish    # only some styles
+"""
+import argparse
+import importlib
+import os
+import time
+
+from . import ingest
+from .modelstore import MODELS_FOLDER
+from .simplemelodygen.persistence import save_model
+from .tracing import INFO, TRACER
+
+STYLE_MODULES = ['bach', 'mozart', 'turkish', 'hindustani', 'carnatic', 'cumbia']
+
+def train_style(style, output_folder):
+    module = importlib.import_module(f'.{style}', __package__)
+    start = time.perf_counter()
+    model, metadata = module.build_model()
+    save_model(model, os.path.join(output_folder, style), metadata)
+    print(f'{style}: {len(model.states)} states, {model.transition_counts.nnz} transitions, '
+          f'trained in {time.perf_counter() - start:.1f}s')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train style models and save them as memory-mappable artifacts.')
+    parser.add_argument('styles', nargs='*', metavar='style',
+                        help=f'style to train, one of {", ".join(STYLE_MODULES)} (default: all)')
+    parser.add_argument('--output', default=MODELS_FOLDER,
+                        help=f'artifact folder (default: {MODELS_FOLDER})')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes used to parse corpus files (default: number of cores)')
+    args = parser.parse_args(argv)
+    unknown = [style for style in args.styles if style not in STYLE_MODULES]
+    if unknown:
+        parser.error(f'unknown styles: {", ".join(unknown)}')
+
+    ingest.INGEST_WORKERS = args.workers
+    # show the corpus timings the server only traces
+    TRACER.level = min(TRACER.level, INFO)
+    TRACER.echo_level = INFO
+    os.makedirs(args.output, exist_ok=True)
+    for style in args.styles or STYLE_MODULES:
+        train_style(style, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,134 @@
-from tqdm import tqdm
+import hashlib
+import json
+import os
+
 from music21 import corpus, note
 
-def corpus_to_training_data(composer):
+from .ingest import parallel_map
+from .simplemelodygen.persistence import duration_from_str, duration_to_str
+
+# Extracted state sequences of corpus files, see cached_score_state_sequence
+CORPUS_CACHE_FOLDER = os.environ.get('MELODY_CORPUS_CACHE_FOLDER', os.path.join(os.path.dirname(__file__), 'corpus_cache'))
+
+# Part of every cache key: bump the version whenever score_to_state_sequence or
+# part_to_state_sequence change what they extract, so stale entries are ignored
+EXTRACTION_PARAMS = {'version': 1, 'part': 'Soprano', 'fallback_part': 0, 'chord': 'bass'}
+
+def part_to_state_sequence(part):
+    """
+    Extracts the melody line of a part as (pitch, duration) states. Chords are
+    reduced to their bass note.
+
+    Args:
+        part (music21.stream.Part): The part to extract.
+
+    Returns:
+        list: List of (pitch/'Rest', quarterLength) tuples.
+    """
+    notes_sequence = []
+    for element in part.flat.notesAndRests:  # Include notes and rests
+        if element.isNote:
+            notes_sequence.append((element.pitch.nameWithOctave, element.quarterLength))
+        elif element.isChord:
+            # If there's a chord, take the highest note (melodic line usually uses the top note)
+            #notes_sequence.append((element.highestNote.nameWithOctave, element.quarterLength))
+
+            # Get the bass (lowest) note of the chord
+            bass_note = element.bass()
+            notes_sequence.append((bass_note.nameWithOctave, element.quarterLength))
+        elif element.isRest:
+            notes_sequence.append(('Rest', element.quarterLength))
+    return notes_sequence
+
+def score_to_state_sequence(s):
+    soprano_part = None
+    for part in s.parts:
+        if "Soprano" in (part.partName or ""):  # Check for 'Soprano' in the part name
+            soprano_part = part
+            break
+
+    # Fallback if no explicit Soprano part is named
+    if soprano_part is None:
+        # Assume the first part is the Soprano if no explicit naming is found
+        soprano_part = s.parts[0]
+
+    return part_to_state_sequence(soprano_part)
+
+def parse_score_state_sequence(path):
+    return score_to_state_sequence(corpus.parse(path))
+
+def _cache_path(path):
+    stat = os.stat(path)
+    key = json.dumps({
+        'path': os.path.abspath(path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'params': EXTRACTION_PARAMS,
+    }, sort_keys=True)
+    return os.path.join(CORPUS_CACHE_FOLDER, f"{hashlib.sha256(key.encode()).hexdigest()}.json")
+
+def cached_score_state_sequence(path):
+    """
+    Returns the soprano state sequence of a corpus file, only parsing the file with
+    music21 when there is no cache entry for its current path, mtime, size and the
+    current EXTRACTION_PARAMS.
+
+    Args:
+        path (str or pathlib.Path): Corpus file path.
+
+    Returns:
+        list: List of (pitch/'Rest', quarterLength) tuples.
+    """
+    cache_path = _cache_path(path)
+    try:
+        with open(cache_path) as f:
+            return [(pitch, duration_from_str(duration)) for pitch, duration in json.load(f)]
+    except (OSError, ValueError):
+        pass
+
+    notes_sequence = parse_score_state_sequence(path)
+
+    os.makedirs(CORPUS_CACHE_FOLDER, exist_ok=True)
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump([[pitch, duration_to_str(duration)] for pitch, duration in notes_sequence], f)
+    os.replace(tmp_path, cache_path)
+    return notes_sequence
+
+def corpus_to_state_sequences(composer, use_cache=True, workers=None):
+    """
+    Extracts the soprano line of every corpus score of a composer.
+
+    Args:
+        composer (str): Composer name as understood by music21.corpus.getComposer.
+        use_cache (bool): Reuse sequences cached in CORPUS_CACHE_FOLDER for files that did not change.
+        workers (int): Number of processes parsing files in parallel, defaults to ingest.INGEST_WORKERS.
+
+    Returns:
+        tuple: (list of state sequences, one per score, list of all distinct states)
+    """
     paths = corpus.getComposer(composer)
 
+    extract = cached_score_state_sequence if use_cache else parse_score_state_sequence
+    sequences = parallel_map(extract, paths, workers=workers, desc=f'{composer} corpus')
+
     all_states = set()
-    all_pitches = set()
-    all_durations = set()
+    for notes_sequence in sequences:
+        all_states.update(notes_sequence)
+
+    return sequences, list(all_states)
+
+def corpus_to_training_data(composer):
+    sequences, all_states = corpus_to_state_sequences(composer)
+
     training_data = []
-    chord_occurence_count = 0
-    note_count = 0
-    for p in tqdm(paths):
-        # Load the score
-        s = corpus.parse(p)
-        
-        soprano_part = None
-        for part in s.parts:
-            if "Soprano" in (part.partName or ""):  # Check for 'Soprano' in the part name
-                soprano_part = part
-                break
-        
-        # Fallback if no explicit Soprano part is named
-        if soprano_part is None:
-            # Assume the first part is the Soprano if no explicit naming is found
-            soprano_part = s.parts[0]
-        
-        # Extract notes and rests (pitch and duration)
-        notes_sequence = []
-        for element in soprano_part.flat.notesAndRests:  # Include notes and rests
-            if element.isNote:
-                notes_sequence.append((element.pitch.nameWithOctave, element.quarterLength))
-            elif element.isChord:        
-                # If there's a chord, take the highest note (melodic line usually uses the top note)
-                #notes_sequence.append((element.highestNote.nameWithOctave, element.quarterLength))
-    
-                # Get the bass (lowest) note of the chord
-                bass_note = element.bass()
-                notes_sequence.append((bass_note.nameWithOctave, element.quarterLength))
-    
-                chord_occurence_count += 1
-            elif element.isRest:
-                notes_sequence.append(('Rest', element.quarterLength))
-    
+    for notes_sequence in sequences:
         notes = []
-        for pitch, duration in notes_sequence:    
-            all_pitches.add(pitch)
-            all_durations.add(duration)
-            s = (pitch, duration)
+        for pitch, duration in notes_sequence:
             if pitch == 'Rest':
-                notes.append(note.Rest(quarterLength=s[1]))
-                #ignore rests for now
-                #pass
+                notes.append(note.Rest(quarterLength=duration))
             else:
-                notes.append(note.Note(s[0], quarterLength=s[1]))        
-            all_states.add(s)    
+                notes.append(note.Note(pitch, quarterLength=duration))
         training_data.append(notes)
-        note_count += len(notes)
 
-    #print(f'note_count: {note_count}\nskipped_chord_occurence_count: {chord_occurence_count}\ntraining_data_examples: {len(training_data)}\nall_states: {len(all_states)}, all_pitches: {len(all_pitches)}')        
-    return training_data, list(all_states)
\ No newline at end of file
+    return training_data, all_states
@@ -1,15 +1,22 @@
+import functools
+from collections import Counter
 from enum import Enum
+from fractions import Fraction
 from os import walk, listdir
 
 import os.path
 
-from tqdm import tqdm
-from music21.note import Note, Rest
+import numpy as np
+from music21.common import opFrac
+from music21.note import Note
 from music21.pitch import Pitch
-from music21.duration import Duration
 from music21.tempo import MetronomeMark
 
 from .simplemelodygen.extensions import MultiInstanceTrainableMarkovChainMelodyGenerator
+from .modelstore import get_or_load_model
+from .ingest import parallel_map
+from .simplemelodygen.vocabulary import VOCABULARY
+from .tracing import INFO, TRACER, WARNING, trace
 
 class Columns(Enum):
     Sira = 0
@@ -34,114 +41,95 @@ TRAINING_MAKAM = "hicaz"
 
 SYMBTR_TXT_FOLDER = os.path.join(os.path.dirname(__file__), 'makamtxt')
 
-def parse_symbtr_txt(filename):
-    '''Parses given symbtr, returns music21 (Note, Duration)'''
-
-    note_list = []
-    # tempo (can be used later)
-    bpm = None
-    
-    file = open(filename)
-    for index, line in enumerate(file):
-        if (index == 0):
-            continue
-
-        split_line = line.strip().split("\t")
-
-        # time signature
-        ts_num=None
-        ts_denum=None
-        if (index == 1):
-            ts_num = int(split_line[Columns.Pay.value])
-            ts_denum = int(split_line[Columns.Payda.value])
-
-        # reading notes
-        if (int(split_line[Columns.Kod.value])) == CODE_NOTE:
+def iter_symbtr_records(filename):
+    '''Streams the notes of a symbtr txt file as compact (pitch name, cents offset, quarterLength)
+    records, without building music21 objects. The pitch name is the nameWithOctave of the
+    makam pitch (microtones are only carried in the cents offset) or 'Rest'.'''
+
+    with open(filename) as file:
+        next(file, None)  # header
+        for line in file:
+            # the note columns all come before Ms, no need to split the lyrics etc.
+            split_line = line.rstrip("\n").split("\t", Columns.Ms.value)
+
+            if int(split_line[Columns.Kod.value]) != CODE_NOTE:
+                continue
+
             parsed_note = split_line[Columns.NotaAE.value]
-    
-            # note name
-            note_name = parsed_note[:2]
-            accidental = None
-    
-            if (len(parsed_note) > 2):
-                parsed_note_for_accidental = split_line[Columns.Nota53.value]
-                accidental = parsed_note_for_accidental[-2:]        
-    
-            # note length
-            pay = int(split_line[Columns.Pay.value])
-            payda = int(split_line[Columns.Payda.value])
-
-            if pay == 1 and payda == 4 and bpm == None:
-                bpm = 60000 / int(split_line[Columns.Ms.value])
-                
+            quarter_length = opFrac(Fraction(4 * int(split_line[Columns.Pay.value]), int(split_line[Columns.Payda.value])))
+
+            if parsed_note == CODE_REST:
+                yield ("Rest", 0.0, quarter_length)
+                continue
+
             # calculate microtone
-            if (accidental):
+            cents = 0.0
+            if len(parsed_note) > 2:
+                accidental = split_line[Columns.Nota53.value][-2:]
                 signature = 1 if accidental[0] == "#" else -1
-                microtone = signature * int(accidental[1]) * OneCommaInCents
-
-            if (parsed_note == CODE_REST):
-                note = Rest()
-            else:
-                note = Pitch(step=parsed_note[0], 
-                             octave=int(parsed_note[1]),
-                             accidental=None,
-                             microtone=microtone if accidental else None)
-
-            duration = Duration()
-            duration.quarterLength = (pay/payda) / (1/4)
-            note_list.append((note, duration))
-    file.close()
-    
-    return note_list
-
-
-def parse_symbtr_corpus(makam):
-    parsed_data = []
-    states = set()
-    makam_pitches = set()
-
-    scores = [symbtr for symbtr in listdir(SYMBTR_TXT_FOLDER) if symbtr.split("--")[0] == makam]
-    composition_count = 0
-    note_count = 0
-    
-    for score_file in tqdm(scores):
-        composition_count += 1
-        note_list = parse_symbtr_txt(os.path.join(SYMBTR_TXT_FOLDER, score_file))
-        
-        for note_pair in note_list:
-            note_count += 1
-            makam_pitches.add(note_pair[0])
-            states.add((note_pair[0].nameWithOctave if note_pair[0].name != "rest" else "Rest", note_pair[1].quarterLength))
-        
-        parsed_data.append(note_list)
-
-    print("For {0} in total {1} compositions and {2} notes".format(TRAINING_MAKAM, composition_count, note_count))
-    return parsed_data, states, makam_pitches
-
-def train_model(parsed_makam_data, states):
-    training_data=[]
-    for composition in parsed_makam_data:
-        note_list = []
-        note = None
-    
-        for pitch, duration in composition:
-            if (pitch.name == "rest"):
-                note = Rest(duration=duration)
-            else:
-                note = Note(pitch, duration=duration)
-
-            if (note):
-                note_list.append(note)
-
-        training_data.append(note_list)
-    
+                cents = signature * int(accidental[1]) * OneCommaInCents
+
+            # note name and octave, e.g. "B4" for "B4b1"
+            yield (parsed_note[:2], cents, quarter_length)
+
+
+def parse_symbtr_file(filename):
+    return list(iter_symbtr_records(filename))
+
+
+def parse_symbtr_corpus(makam, workers=None):
+    '''Parses all symbtr files of a makam.
+
+    Returns:
+        sequences (list): int32 state index array per composition
+        states (list): (pitch name, quarterLength) state of every index
+        makam_pitches (dict): pitch name -> cents offset, the most frequent one when a
+            pitch name occurs with several microtones
+    '''
+    state_indexes = {}
+    pitch_counts = Counter()
+    sequences = []
+
+    # sorted so that the training data does not depend on directory listing order
+    scores = sorted(symbtr for symbtr in listdir(SYMBTR_TXT_FOLDER) if symbtr.split("--")[0] == makam)
+
+    record_lists = parallel_map(parse_symbtr_file, [os.path.join(SYMBTR_TXT_FOLDER, score_file) for score_file in scores],
+                                workers=workers, desc=f'{makam} SymbTr corpus')
+    for records in record_lists:
+        sequences.append(np.fromiter(
+            (state_indexes.setdefault((name, quarter_length), len(state_indexes)) for name, _, quarter_length in records),
+            dtype=np.int32, count=len(records)))
+        pitch_counts.update((name, cents) for name, cents, _ in records if name != "Rest")
+
+    makam_pitches = {}
+    for (name, cents), _ in pitch_counts.most_common():
+        makam_pitches.setdefault(name, cents)
+
+    trace('makam_corpus', INFO, makam=makam, compositions=len(sequences), notes=sum(map(len, sequences)))
+    return sequences, list(state_indexes), makam_pitches
+
+def train_model(sequences, states):
     model = MultiInstanceTrainableMarkovChainMelodyGenerator(list(states))
-    model.train(training_data)
+    model.train_from_indexes(sequences)
 
     return model
 
-TRAINING_DATA, STATES, MAKAM_PITCHES = parse_symbtr_corpus(TRAINING_MAKAM)
-MODEL = train_model(TRAINING_DATA, STATES)
+def makam_pitch_from_record(record):
+    return Pitch(step=record['step'], octave=record['octave'], accidental=None,
+                 microtone=record['cents'] or None)
+
+def build_model():
+    sequences, states, makam_pitches = parse_symbtr_corpus(TRAINING_MAKAM)
+    model = train_model(sequences, states)
+    # the makam pitches (with their microtones) are needed to render generated notes
+    pitches = [{'step': name[0], 'octave': int(name[1:]), 'cents': cents} for name, cents in makam_pitches.items()]
+    return model, {'makam_pitches': pitches}
+
+# Uploaded phrases only teach transitions between makam pitches, other pitches have no tuning
+LEARN_NEW_STATES = False
+
+def get_model():
+    return get_or_load_model('turkish', build_model)[0]
 
 def generate_melody_pitch_to_makam_pitch_map(makam_pitches):
     d = {}
@@ -150,24 +138,41 @@ def generate_melody_pitch_to_makam_pitch_map(makam_pitches):
             d[p.nameWithOctave] = p
     return d
 
-PITCH_MAP = generate_melody_pitch_to_makam_pitch_map(MAKAM_PITCHES)
+@functools.lru_cache(maxsize=None)
+def get_pitch_map():
+    metadata = get_or_load_model('turkish', build_model)[1]
+    return generate_melody_pitch_to_makam_pitch_map(
+        [makam_pitch_from_record(record) for record in metadata['makam_pitches']]
+    )
 
 def makam_note_remap(pitch, duration):
-    return Note(PITCH_MAP[pitch], quarterLength=duration)
-
-def generate_melody(notes, length=15, max_bars=10, quarter_note_per_bar=4):
-    print(notes)
-    melody = []
-    new_notes = []
-    if len(notes) > 0:
+    return Note(get_pitch_map()[pitch], quarterLength=duration)
+
+@functools.lru_cache(maxsize=None)
+def makam_midi_pitch(pitch):
+    '''MIDI key number and cents offset of a generated pitch name tuned to the makam'''
+    makam_pitch = get_pitch_map()[pitch]
+    return makam_pitch.midi, makam_pitch.getCentShiftFromMidi()
+
+def generate_melody(ids, length=15, max_bars=10, quarter_note_per_bar=4, end_policy='clip', learned_phrases=()):
+    """
+    Args:
+        ids (numpy.ndarray): The melody so far as int32 ids of the shared state vocabulary.
+        learned_phrases (list or LearnedPhrases): Phrases to also learn from, see with_phrases, without changing the shared model.
+
+    Returns:
+        tuple: (ids of the melody with the new notes appended, ids of the new notes)
+    """
+    model = get_model().with_phrases(learned_phrases, new_states=LEARN_NEW_STATES)
+    if len(ids) > 0:
         try:
-            melody, new_notes = MODEL.generate(length, previous_sequence=notes, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar)
+            new_ids = model.generate_ids(length, previous_ids=ids, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar, end_policy=end_policy)
         except Exception as e:
-            print(">>>>>>> Error generating melody", e)
-            _, new_notes  = MODEL.generate(length, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar)
-            melody = notes + new_notes
+            trace('generate_melody_fallback', WARNING, style='turkish', error=str(e))
+            new_ids = model.generate_ids(length, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar, end_policy=end_policy)
     else:
-        melody, new_notes = MODEL.generate(length, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar)
-    print(melody)
+        new_ids = model.generate_ids(length, max_bars=max_bars, quarter_note_per_bar=quarter_note_per_bar, end_policy=end_policy)
+    if TRACER.enabled():
+        trace('generate_melody', style='turkish', notes=VOCABULARY.to_json(ids), new_notes=VOCABULARY.to_json(new_ids))
 
-    return melody, new_notes
\ No newline at end of file
+    return np.concatenate([ids, new_ids]), new_ids
@@ -1,32 +1,36 @@
 import os
-import uuid
 from music21 import note, stream, converter, midi
 
-from .turkish import makam_note_remap
+from .midiwriter import melody_to_midi_bytes, ids_to_midi_bytes
+from .metrics import STAGE_SECONDS
+from .midistore import MidiStore, melody_key, ids_key, bytes_key
+from .turkish import makam_note_remap, makam_midi_pitch
 
 # Create a directory for MIDI files if it doesn't exist
 MIDI_FOLDER = os.path.join(os.path.dirname(__file__), 'midi_files')
 os.makedirs(MIDI_FOLDER, exist_ok=True)
 
+# Files are named by a hash of their content, so identical melodies are stored once
+MIDI_STORE = MidiStore(MIDI_FOLDER)
+
 def save_midi_file(file):
     """
-    Saves a file from a Flask request with a UUID-based filename and returns the serving URL.
+    Saves a file from a Flask request under a content hash filename and returns the serving URL.
     
     Args:
         file: FileStorage object from Flask request.files
         
     Returns:
-        str: URL path to access the saved file (e.g., '/midi/123e4567-e89b-12d3-a456-426614174000.mid')
+        str: URL path to access the saved file (e.g., '/midi/3f2a...e1.mid')
+        str: Path of the saved file
     """
-    # Generate unique filename with uuid4
-    filename = f"{str(uuid.uuid4())}.mid"
-    
-    # Save the file
-    file_path = os.path.join(MIDI_FOLDER, filename)
-    file.save(file_path)
-    
-    # Return the URL path that can be used to serve the file
-    return f"/midi/{filename}", file_path
+    return save_midi_bytes(file.read())
+
+def save_midi_bytes(data):
+    """
+    Same as save_midi_file for the contents of a file already read into memory.
+    """
+    return MIDI_STORE.get_or_render(bytes_key(data), lambda: data)
 
 def midi_to_melody_note_sequence(midi_path):
     # Load the score
@@ -98,13 +102,43 @@ def melody_to_score(melody, is_makam_notes=None):
 
     return score
 
+def melody_to_midi_bytes_music21(melody, is_makam_notes=None):
+    """
+    Reference encoder going through a music21 Score, see midiwriter.melody_to_midi_bytes.
+    """
+    mf = midi.translate.music21ObjectToMidiFile(melody_to_score(melody, is_makam_notes))
+    return mf.writestr()
+
 def save_melody_to_midi(melody, is_makam_notes=None):
-    s = melody_to_score(melody, is_makam_notes)
-    mf = midi.translate.music21ObjectToMidiFile(s)
-    filename = f"{str(uuid.uuid4())}.mid"
-    file_path = os.path.join(MIDI_FOLDER, filename)
-    mf.open(file_path, 'wb')
-    mf.write()
-    mf.close()
-
-    return f"/midi/{filename}", file_path
\ No newline at end of file
+    """
+    Renders a melody to a MIDI file, reusing the stored file if the same melody was rendered before.
+
+    Returns:
+        str: URL path to access the file
+        str: Path of the file
+    """
+    return MIDI_STORE.get_or_render(
+        melody_key(melody, is_makam_notes),
+        lambda: render_melody(melody, is_makam_notes),
+    )
+
+def render_melody(melody, is_makam_notes=None):
+    with STAGE_SECONDS.time(stage='midi_render'):
+        return melody_to_midi_bytes(melody, is_makam_notes, makam_midi_pitch)
+
+def save_ids_to_midi(ids, is_makam_notes=None):
+    """
+    save_melody_to_midi for a melody of vocabulary state ids, storing the same file under the same key.
+
+    Returns:
+        str: URL path to access the file
+        str: Path of the file
+    """
+    return MIDI_STORE.get_or_render(
+        ids_key(ids, is_makam_notes),
+        lambda: render_ids(ids, is_makam_notes),
+    )
+
+def render_ids(ids, is_makam_notes=None):
+    with STAGE_SECONDS.time(stage='midi_render'):
+        return ids_to_midi_bytes(ids, is_makam_notes, makam_midi_pitch)
@@ -0,0 +1,41 @@
+"""
+Compares the in-memory MIDI upload reader with the music21 converter.parse path it replaced.
+
+    python -m benchmarks.midi_reader
+    python -m benchmarks.midi_reader api/Behag.mid --repeat 5
+"""
+import argparse
+import glob
+import os
+import warnings
+
+from api.midireader import midi_bytes_to_notes
+from api.utils import midi_to_notes
+
+from .midi_writer import best_time
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark reading uploaded MIDI files.')
+    parser.add_argument('files', nargs='*', help='MIDI files (default: the sample files in api/)')
+    parser.add_argument('--repeat', type=int, default=10, help='runs per measurement, the best is reported')
+    args = parser.parse_args(argv)
+    warnings.filterwarnings('ignore')
+
+    files = args.files or sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'api', '*.mid')))
+    print(f'{"file":>20} {"notes":>6} {"music21 ms":>11} {"direct ms":>10} {"speedup":>8} {"identical":>9}')
+    for path in files:
+        with open(path, 'rb') as f:
+            data = f.read()
+        reference = [(pitch, float(duration)) for pitch, duration in midi_to_notes(path)]
+        # no upload limits, any file music21 reads is compared
+        limits = dict(max_bytes=len(data), max_notes=float('inf'), max_quarter_notes=float('inf'),
+                      max_bars=float('inf'))
+        output = [(pitch, float(duration)) for pitch, duration in midi_bytes_to_notes(data, **limits)]
+
+        music21_time = best_time(lambda: midi_to_notes(path), args.repeat)
+        direct_time = best_time(lambda: midi_bytes_to_notes(data, **limits), args.repeat)
+        print(f'{os.path.basename(path):>20} {len(output):>6} {music21_time * 1e3:>11.2f} {direct_time * 1e3:>10.3f} '
+              f'{music21_time / direct_time:>7.0f}x {str(reference == output):>9}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Compares the direct MIDI writer with the music21 based encoder it replaced.
+
+    python -m benchmarks.midi_writer
+    python -m benchmarks.midi_writer --lengths 16 64 256 --repeat 50
+
+Melodies are sampled from a trained style model (see `python -m api.train`),
+makam melodies are included when the turkish model is available.
+"""
+import argparse
+import time
+import warnings
+
+import numpy as np
+
+from api.midiwriter import melody_to_midi_bytes
+from api.modelstore import get_or_load_model, has_saved_model
+from api.utils import melody_to_midi_bytes_music21
+
+def best_time(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def sample_melody(style, length):
+    module = __import__(f'api.{style}', fromlist=['build_model'])
+    model = get_or_load_model(style, module.build_model)[0]
+    return model.states_from_indexes(model.generate_batch(1, length)[0])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark MIDI encoding of generated melodies.')
+    parser.add_argument('--style', default='mozart', help='style model to sample melodies from (default: mozart)')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[8, 32, 128, 512],
+                        help='melody lengths in notes (default: 8 32 128 512)')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per measurement, the best is reported')
+    args = parser.parse_args(argv)
+    warnings.filterwarnings('ignore')
+    np.random.seed(0)
+
+    cases = [(args.style, False)]
+    if has_saved_model('turkish'):
+        from api.turkish import makam_midi_pitch
+        cases.append(('turkish', True))
+
+    print(f'{"style":>10} {"notes":>6} {"music21 ms":>11} {"direct ms":>10} {"speedup":>8} {"identical":>9}')
+    for style, is_makam in cases:
+        for length in args.lengths:
+            melody = sample_melody(style, length)
+            flags = [is_makam] * len(melody)
+            reference = melody_to_midi_bytes_music21(melody, flags)
+            output = melody_to_midi_bytes(melody, flags, makam_midi_pitch if is_makam else None)
+
+            music21_time = best_time(lambda: melody_to_midi_bytes_music21(melody, flags), args.repeat)
+            direct_time = best_time(lambda: melody_to_midi_bytes(melody, flags, makam_midi_pitch if is_makam else None),
+                                    args.repeat)
+            print(f'{style:>10} {length:>6} {music21_time * 1e3:>11.2f} {direct_time * 1e3:>10.3f} '
+                  f'{music21_time / direct_time:>7.0f}x {str(reference == output):>9}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""
+Benchmark suite for training, generation, learning uploaded phrases, bar fitting,
+MIDI rendering, upload parsing and end-to-end /api/update_melody latency.
+
+    python -m benchmarks.suite                                 # run, compare with benchmarks/baseline.json
+    python -m benchmarks.suite --output results.json           # also save the results
+    python -m benchmarks.suite --save-baseline                 # make these results the new baseline
+    python -m benchmarks.suite --only generation rendering --threshold 0.3
+
+Training and generation run on synthetic corpora, so they need no corpus files;
+parsing uses the bundled api/*.mid files. The end-to-end benchmark uses the
+trained mozart model when `python -m api.train` saved one, otherwise it only times
+the repeat-seed variation. Exits with status 1 if a metric regressed by more than
+--threshold compared to the baseline. Timings only compare on one machine, so no
+baseline is committed: run with --save-baseline on the machine the comparisons run
+on (e.g. the CI runner) first, until then the suite only reports its results.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+from .midi_writer import best_time
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+MIDI_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'api', '*.mid')))
+
+PITCHES = [f'{step}{octave}' for octave in (3, 4, 5) for step in ('C', 'D', 'E', 'F', 'G', 'A', 'B')] + ['Rest']
+DURATIONS = [0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 1 / 3]
+
+def metric(value, unit, better):
+    """
+    Args:
+        better (str): 'lower' or 'higher', which direction is an improvement.
+    """
+    return {'value': round(float(value), 6), 'unit': unit, 'better': better}
+
+def time_per_call(function, repeat, minimum=0.05):
+    """
+    Best time of one call, timing enough calls per run that short functions are not lost in timer noise.
+    """
+    start = time.perf_counter()
+    function()
+    loops = max(1, int(minimum / max(time.perf_counter() - start, 1e-6)))
+    return best_time(lambda: [function() for _ in range(loops)], repeat) / loops
+
+def synthetic_corpus(sequences, length, seed=0):
+    """
+    Random walk phrases over a fixed vocabulary, so the model has realistic sparsity.
+
+    Returns:
+        tuple: (list of state lists, list of states)
+    """
+    rng = random.Random(seed)
+    states = [(pitch, duration) for pitch in PITCHES for duration in DURATIONS]
+    corpus = []
+    for _ in range(sequences):
+        position = rng.randrange(len(PITCHES))
+        phrase = []
+        for _ in range(length):
+            position = min(max(position + rng.choice((-2, -1, -1, 0, 1, 1, 2)), 0), len(PITCHES) - 1)
+            phrase.append((PITCHES[position], rng.choice(DURATIONS)))
+        corpus.append(phrase)
+    return corpus, states
+
+def train_models(corpus, states):
+    from api.simplemelodygen.extensions import MultiInstanceTrainableMarkovChainMelodyGenerator
+    from api.simplemelodygen.variableorder import VariableOrderMarkovChainMelodyGenerator
+
+    first_order = MultiInstanceTrainableMarkovChainMelodyGenerator(list(states), sparse=True)
+    first_order.train_from_indexes([first_order.states_to_indexes(s) for s in corpus])
+    variable_order = VariableOrderMarkovChainMelodyGenerator(list(states), sparse=True, max_order=3)
+    variable_order.train_from_indexes([variable_order.states_to_indexes(s) for s in corpus])
+    return first_order, variable_order
+
+def bench_training(args):
+    corpus, states = synthetic_corpus(args.sequences, args.length)
+    notes = args.sequences * args.length
+    seconds = best_time(lambda: train_models(corpus, states), args.repeat)
+    return {
+        'train_seconds': metric(seconds, 's', 'lower'),
+        'train_notes_per_second': metric(notes / seconds, 'notes/s', 'higher'),
+    }
+
+def bench_generation(args):
+    corpus, states = synthetic_corpus(args.sequences, args.length)
+    first_order, variable_order = train_models(corpus, states)
+    context = corpus[0][:4]
+    results = {}
+    for name, model in (('first_order', first_order), ('variable_order', variable_order)):
+        melodies = []
+
+        def generate():
+            melodies.append(model.generate(1000, context, max_bars=8)[1])
+
+        np.random.seed(0)
+        seconds = best_time(generate, args.repeat)
+        results[f'generate_{name}_notes_per_second'] = metric(len(melodies[-1]) / seconds, 'notes/s', 'higher')
+
+        batch_seconds = best_time(lambda: model.generate_batch(64, 64, context), args.repeat)
+        results[f'generate_batch_{name}_notes_per_second'] = metric(64 * 64 / batch_seconds, 'notes/s', 'higher')
+    return results
+
+def bench_learning(args):
+    from api.simplemelodygen.vocabulary import VOCABULARY
+
+    corpus, states = synthetic_corpus(args.sequences, args.length)
+    _, variable_order = train_models(corpus, states)
+    uploads = [VOCABULARY.encode(phrase) for phrase in synthetic_corpus(64, args.length, seed=2)[0]]
+    notes = sum(len(ids) for ids in uploads)
+    seconds = best_time(lambda: [variable_order.learn_ids(ids) for ids in uploads], args.repeat)
+
+    # every row was learned into, so this is the slowest case of sampling merged rows
+    melodies = []
+    np.random.seed(0)
+    generate_seconds = best_time(lambda: melodies.append(variable_order.generate(1000, corpus[0][:4], max_bars=8)[1]),
+                                 args.repeat)
+    return {
+        'learn_notes_per_second': metric(notes / seconds, 'notes/s', 'higher'),
+        'generate_learned_notes_per_second': metric(len(melodies[-1]) / generate_seconds, 'notes/s', 'higher'),
+    }
+
+def bench_bars(args):
+    from api.simplemelodygen.bars import enforce_bars
+
+    corpus, _ = synthetic_corpus(256, 64, seed=1)
+    seconds = time_per_call(lambda: [enforce_bars(phrase, 8, '7/8') for phrase in corpus], args.repeat)
+    return {'enforce_bars_phrases_per_second': metric(len(corpus) / seconds, 'phrases/s', 'higher')}
+
+def bench_rendering(args):
+    from api import utils
+    from api.midistore import MidiStore
+    from api.simplemelodygen.vocabulary import VOCABULARY
+
+    corpus, _ = synthetic_corpus(64, 128, seed=2)
+    seconds = best_time(lambda: [utils.melody_to_midi_bytes(m) for m in corpus], args.repeat)
+    results = {'render_notes_per_second': metric(len(corpus) * 128 / seconds, 'notes/s', 'higher')}
+    ids = [VOCABULARY.encode(m) for m in corpus]
+    seconds = best_time(lambda: [utils.ids_to_midi_bytes(m) for m in ids], args.repeat)
+    results['render_ids_notes_per_second'] = metric(len(corpus) * 128 / seconds, 'notes/s', 'higher')
+
+    # through the store, once rendering and writing new files, once finding them stored
+    store = utils.MIDI_STORE
+    with tempfile.TemporaryDirectory() as folder:
+        utils.MIDI_STORE = MidiStore(folder)
+        try:
+            start = time.perf_counter()
+            for melody in corpus:
+                utils.save_melody_to_midi(melody)
+            results['save_melody_to_midi_new_ms'] = metric(
+                (time.perf_counter() - start) / len(corpus) * 1e3, 'ms', 'lower')
+            seconds = time_per_call(lambda: [utils.save_melody_to_midi(m) for m in corpus], args.repeat)
+            results['save_melody_to_midi_stored_ms'] = metric(seconds / len(corpus) * 1e3, 'ms', 'lower')
+        finally:
+            utils.MIDI_STORE = store
+    return results
+
+def bench_parsing(args):
+    from api.midireader import midi_bytes_to_notes
+    from api.utils import midi_to_notes
+
+    results = {}
+    for path in MIDI_FILES:
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, 'rb') as f:
+            data = f.read()
+        results[f'midi_to_notes_{name}_ms'] = metric(time_per_call(lambda: midi_to_notes(path), args.repeat) * 1e3,
+                                                     'ms', 'lower')
+        results[f'midi_bytes_to_notes_{name}_ms'] = metric(
+            time_per_call(lambda: midi_bytes_to_notes(data, max_bytes=len(data), max_notes=float('inf')),
+                          args.repeat) * 1e3, 'ms', 'lower')
+    return results
+
+def bench_endpoint(args):
+    os.environ.setdefault('MELODY_WARM_UP', '0')
+    from api import utils
+    from api.index import app
+    from api.midistore import MidiStore
+    from api.modelstore import has_saved_model
+
+    client = app.test_client()
+    seed_notes = [('C4', 1.0), ('E4', 1.0), ('G4', 1.0), ('C5', 1.0)]
+    variations = ['repeat-seed'] + (['mozart'] if has_saved_model('mozart') else [])
+    results = {}
+    store = utils.MIDI_STORE
+    with tempfile.TemporaryDirectory() as folder:
+        utils.MIDI_STORE = MidiStore(folder)
+        try:
+            for variation in variations:
+                body = {'seed_notes': seed_notes, 'current_notes': seed_notes, 'recent_notes': seed_notes,
+                        'is_makam_notes': [False] * len(seed_notes), 'requested_variation': variation}
+                latencies = []
+                for i in range(args.requests + 1):
+                    start = time.perf_counter()
+                    response = client.post('/api/update_melody', json=body)
+                    if response.status_code != 200:
+                        raise RuntimeError(f'/api/update_melody {variation}: {response.status_code} {response.json}')
+                    if i:  # the first request loads the model
+                        latencies.append(time.perf_counter() - start)
+                name = variation.replace('-', '_')
+                results[f'update_melody_{name}_p50_ms'] = metric(np.percentile(latencies, 50) * 1e3, 'ms', 'lower')
+                results[f'update_melody_{name}_p95_ms'] = metric(np.percentile(latencies, 95) * 1e3, 'ms', 'lower')
+        finally:
+            utils.MIDI_STORE = store
+    return results
+
+BENCHMARKS = {
+    'training': bench_training,
+    'generation': bench_generation,
+    'learning': bench_learning,
+    'bars': bench_bars,
+    'rendering': bench_rendering,
+    'parsing': bench_parsing,
+    'endpoint': bench_endpoint,
+}
+
+def compare(results, baseline, threshold):
+    """
+    Returns:
+        list: (name, baseline value, value, relative change) of every metric that got worse by more than threshold.
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None or previous['value'] == 0:
+            continue
+        change = current['value'] / previous['value'] - 1
+        worse = change > threshold if current['better'] == 'lower' else change < -threshold / (1 + threshold)
+        if worse:
+            regressions.append((name, previous['value'], current['value'], change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the benchmark suite and compare it with a baseline.')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=7, help='runs per measurement, the best is reported')
+    parser.add_argument('--requests', type=int, default=50, help='requests per end-to-end latency measurement')
+    parser.add_argument('--sequences', type=int, default=500, help='phrases in the synthetic training corpus')
+    parser.add_argument('--length', type=int, default=64, help='notes per synthetic phrase')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help=f'baseline to compare with (default: {BASELINE_PATH})')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative change that counts as a regression (default: 0.2)')
+    args = parser.parse_args(argv)
+    warnings.filterwarnings('ignore')
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        start = time.perf_counter()
+        metrics = BENCHMARKS[name](args)
+        print(f'{name} ({time.perf_counter() - start:.1f}s)')
+        for metric_name, value in metrics.items():
+            print(f'  {metric_name:<48} {value["value"]:>14.3f} {value["unit"]}')
+        results.update(metrics)
+
+    report = {'machine': platform.platform(), 'python': platform.python_version(), 'time': time.time(),
+              'metrics': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                previous = json.load(f)['metrics']
+            # keep the baseline of benchmarks that were not run
+            results = dict(previous, **results)
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(report, metrics=results), f, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save-baseline to create one')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline['metrics'], args.threshold)
+    if baseline.get('machine') != report['machine']:
+        print(f'Note: the baseline was measured on {baseline.get("machine")}')
+    for name, previous, current, change in regressions:
+        print(f'REGRESSION {name}: {previous:.3f} -> {current:.3f} ({change:+.0%})')
+    if not regressions:
+        print(f'No regressions beyond {args.threshold:.0%} compared to {args.baseline}')
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())